@@ -0,0 +1,41 @@
+'''
+Run one of the scripts in bin/ against the mock server:
+
+    MOCK_SALESFORCE_URL=https://127.0.0.1:8443 REQUESTS_CA_BUNDLE=<certificate> python bootstrap.py ../bin/export_attachments.py ...
+
+simple_salesforce always signs in at <domain>.salesforce.com, the login is redirected
+to MOCK_SALESFORCE_URL. Everything after the login uses the serverUrl returned by the mock.
+'''
+import atexit
+import os
+import runpy
+import sys
+
+import simple_salesforce.api
+
+salesforce_login = simple_salesforce.api.SalesforceLogin
+
+def mock_salesforce_login(**kwargs):
+    kwargs['scratch_url'] = os.environ['MOCK_SALESFORCE_URL']
+    return salesforce_login(**kwargs)
+
+def write_peak_rss(peak_rss_file):
+    # VmHWM starts over with exec, unlike ru_maxrss which a child inherits from the
+    # benchmark process that holds the whole mock org
+    with open('/proc/self/status') as status_file:
+        for line in status_file:
+            if line.startswith('VmHWM:'):
+                with open(peak_rss_file, 'w') as output_file:
+                    output_file.write(line.split()[1])
+
+def main():
+    simple_salesforce.api.SalesforceLogin = mock_salesforce_login
+    if os.environ.get('BENCHMARK_PEAK_RSS_FILE') and os.path.isfile('/proc/self/status'):
+        atexit.register(write_peak_rss, os.environ['BENCHMARK_PEAK_RSS_FILE'])
+    script = sys.argv[1]
+    sys.argv = sys.argv[1:]
+    sys.path.insert(0, os.path.dirname(os.path.realpath(script)))
+    runpy.run_path(script, run_name='__main__')
+
+if __name__ == "__main__":
+    main()
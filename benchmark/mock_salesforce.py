@@ -0,0 +1,600 @@
+#!/usr/bin/env python
+'''
+Local stand-in for the Salesforce endpoints used by the export and upload scripts:
+
+    SOAP login                      POST /services/Soap/u/<version>
+    query / queryMore               GET  /services/data/v<version>/query?q=...  and  .../query/<cursor>
+    Attachment body                 GET  /services/data/v<version>/sobjects/Attachment/<Id>/Body
+    ContentVersion version data     GET  /services/data/v<version>/sobjects/ContentVersion/<Id>/VersionData
+    Attachment create               POST /services/data/v<version>/sobjects/Attachment/ (JSON or multipart)
+    ContentVersion insert / upsert  POST .../sobjects/ContentVersion/  and  PATCH .../sobjects/ContentVersion/<key>/<value>
+    sObject Collections insert      POST /services/data/v<version>/composite/sobjects
+    Bulk API 2.0 query              POST/GET /services/data/v<version>/jobs/query[/<id>[/results]]
+
+The org content (number of records, file size distribution) and the behaviour
+(latency, error rate, throttling) are configurable. The server speaks HTTPS with a
+self-signed certificate, point REQUESTS_CA_BUNDLE at the generated certificate file.
+'''
+import argparse
+import base64
+import csv
+import datetime
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import ssl
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+BLOCK_SIZE = 64 * 1024
+QUERY_PAGE_SIZE = 2000
+COLLECTION_ID_PREFIXES = {'Attachment': '00P', 'ContentDocumentLink': '06A'}
+# requests which fail and get throttled by default, the scripts retry these
+FILE_REQUEST_TYPES = ('download', 'create', 'upsert', 'collection')
+
+class SizeDistribution(object):
+    '''
+    fixed:<bytes>, uniform:<min>:<max> or lognormal:<median>:<sigma>
+    '''
+    def __init__(self, spec):
+        parts = spec.split(':')
+        self.kind = parts[0]
+        self.params = [float(part) for part in parts[1:]]
+        if self.kind not in ('fixed', 'uniform', 'lognormal'):
+            raise ValueError("Unknown size distribution %s" % spec)
+
+    def sample(self, rng):
+        if self.kind == 'fixed':
+            return int(self.params[0])
+        if self.kind == 'uniform':
+            return rng.randint(int(self.params[0]), int(self.params[1]))
+        median, sigma = self.params
+        return max(0, int(rng.lognormvariate(0, sigma) * median))
+
+def parse_datetime(value):
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+def make_id(prefix, number):
+    # 15 characters plus the case checksum suffix of a real 18 character Id
+    record_id = '%s%012d' % (prefix, number)
+    suffix = ''
+    for i in range(0, 15, 5):
+        flags = sum(1 << j for j, character in enumerate(record_id[i:i + 5]) if character.isupper())
+        suffix += 'ABCDEFGHIJKLMNOPQRSTUVWXYZ012345'[flags]
+    return record_id + suffix
+
+class MockOrg(object):
+    '''
+    Deterministic org content: parents (Accounts), users, Attachments, ContentDocuments
+    with one ContentVersion and one ContentDocumentLink each.
+    Blobs are generated on the fly from the record Id, nothing is held in memory.
+    '''
+    def __init__(self, attachments=100, content_versions=100, parents=10, users=3,
+                 size_distribution='lognormal:20000:1.5', seed=1, api_version='59.0'):
+        rng = random.Random(seed)
+        sizes = SizeDistribution(size_distribution)
+        self.api_version = api_version
+        self.parents = [make_id('001', i) for i in range(parents)]
+        self.users = [make_id('005', i) for i in range(users)]
+        created = datetime.datetime(2020, 1, 1)
+        self.records = {'Account': [{'Id': parent_id} for parent_id in self.parents],
+                        'Attachment': [], 'ContentVersion': [], 'ContentDocumentLink': []}
+
+        for i in range(attachments):
+            record_id = make_id('00P', i)
+            timestamp = (created + datetime.timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%S.000+0000')
+            self.records['Attachment'].append({
+                'Id': record_id, 'ParentId': self.parents[i % parents], 'Name': 'attachment_%d.bin' % i,
+                'Body': '/services/data/v%s/sobjects/Attachment/%s/Body' % (api_version, record_id),
+                'BodyLength': sizes.sample(rng), 'ContentType': 'application/octet-stream',
+                'CreatedById': self.users[i % users], 'OwnerId': self.users[i % users],
+                'LastModifiedById': self.users[i % users], 'CreatedDate': timestamp,
+                'LastModifiedDate': timestamp, 'SystemModstamp': timestamp, 'Description': None,
+                'IsDeleted': False, 'IsPrivate': False})
+
+        for i in range(content_versions):
+            record_id = make_id('068', i)
+            document_id = make_id('069', i)
+            timestamp = (created + datetime.timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%S.000+0000')
+            self.records['ContentVersion'].append({
+                'Id': record_id, 'ContentDocumentId': document_id, 'Title': 'file_%d' % i,
+                'PathOnClient': 'file_%d.bin' % i, 'Description': None,
+                'VersionData': '/services/data/v%s/sobjects/ContentVersion/%s/VersionData' % (api_version, record_id),
+                'ContentSize': sizes.sample(rng), 'CreatedDate': timestamp, 'LastModifiedDate': timestamp,
+                'SystemModstamp': timestamp, 'ContentUrl': None, 'ReasonForChange': None,
+                'SharingOption': 'A', 'SharingPrivacy': 'N', 'Origin': 'C', 'ContentLocation': 'S',
+                'ExternalDocumentInfo1': None, 'ExternalDocumentInfo2': None, 'IsMajorVersion': True,
+                'IsLatest': True, 'FileExtension': 'bin', 'OwnerId': self.users[i % users]})
+            self.records['ContentDocumentLink'].append({
+                'Id': make_id('06A', i), 'ContentDocumentId': document_id, 'LinkedEntityId': self.parents[i % parents],
+                'ShareType': 'V', 'Visibility': 'AllUsers'})
+
+        self.lock = threading.Lock()
+        self.by_id = {}
+        for records in self.records.values():
+            for record in records:
+                self.by_id[record['Id']] = record
+
+    def blob_size(self, record):
+        return int(record.get('BodyLength', record.get('ContentSize')) or 0)
+
+    def blob_chunks(self, record_id, size):
+        block = hashlib.sha256(record_id.encode('utf-8')).digest() * (BLOCK_SIZE // 32)
+        remaining = size
+        while remaining > 0:
+            chunk = block[:min(remaining, BLOCK_SIZE)]
+            remaining -= len(chunk)
+            yield chunk
+
+    def query(self, soql):
+        '''
+        Just enough SOQL for the scripts: SELECT <fields> FROM <object>, filtered by
+        <field> IN ('value', ...) lists. Sub-queries (parent record filters) match everything.
+        '''
+        match = re.match(r"\s*SELECT\s+(.*?)\s+FROM\s+(\w+)(?:\s+WHERE\s+(.*))?\s*$", soql, re.IGNORECASE | re.DOTALL)
+        if not match:
+            raise ValueError("MALFORMED_QUERY: %s" % soql)
+        fields = [field.strip() for field in match.group(1).split(',')]
+        sobject = match.group(2)
+        where = match.group(3) or ''
+        records = self.records.get(sobject, [])
+
+        for field, values in re.findall(r"(\w+)\s+in\s*\(\s*('[^)]*')\s*\)", where, re.IGNORECASE):
+            wanted = set(re.findall(r"'([^']*)'", values))
+            records = [record for record in records if record.get(field) in wanted]
+
+        for field in re.findall(r"(\w+)\s*!=\s*null", where, re.IGNORECASE):
+            records = [record for record in records if record.get(field) not in (None, '')]
+
+        # datetime comparisons of delta exports, e.g. SystemModstamp > 2020-01-01T00:00:00Z
+        for field, value in re.findall(r"(\w+)\s*>\s*(\d{4}-\d\d-\d\dT[\d:.]+(?:Z|[+-]\d\d:?\d\d))", where):
+            after = parse_datetime(value)
+            records = [record for record in records if record.get(field) and parse_datetime(record[field]) > after]
+
+        return [dict([('attributes', {'type': sobject, 'url': '/services/data/v%s/sobjects/%s/%s' % (self.api_version, sobject, record['Id'])})] +
+                     [(field, self.field_value(record, field)) for field in fields])
+                for record in records]
+
+    def add_upload(self, sobject, record, upsert_field=None):
+        '''
+        Keep a record created by an upload, so pre-flight queries of the target find it.
+        An upsert replaces the record with the same upsert key value.
+        '''
+        with self.lock:
+            records = self.records.setdefault(sobject, [])
+            if upsert_field:
+                for i, existing in enumerate(records):
+                    if existing.get(upsert_field) == record[upsert_field]:
+                        records[i] = record
+                        return
+            records.append(record)
+
+    def field_value(self, record, field):
+        if field == 'Checksum' and 'Checksum' not in record:
+            # MD5 of the blob, computed on demand like the blob itself
+            md5 = hashlib.md5()
+            for chunk in self.blob_chunks(record['Id'], self.blob_size(record)):
+                md5.update(chunk)
+            return md5.hexdigest()
+        return record.get(field)
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.records = {}
+            self.bytes_out = 0
+            self.bytes_in = 0
+            self.errors = 0
+            self.throttled = 0
+            self.latencies = {}
+
+    def reject(self, throttled):
+        with self.lock:
+            if throttled:
+                self.throttled += 1
+            else:
+                self.errors += 1
+
+    def add(self, request_type, records=0, bytes_out=0, bytes_in=0, latency=None):
+        with self.lock:
+            self.requests[request_type] = self.requests.get(request_type, 0) + 1
+            self.records[request_type] = self.records.get(request_type, 0) + records
+            self.bytes_out += bytes_out
+            self.bytes_in += bytes_in
+            if latency is not None:
+                self.latencies.setdefault(request_type, []).append(latency)
+
+    def as_dict(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'records': dict(self.records),
+                    # rejected and failed requests count against the API limits as well
+                    'api_calls': sum(count for request_type, count in self.requests.items() if request_type not in ('login', 'invalid_session')) + self.errors + self.throttled,
+                    'bytes_out': self.bytes_out, 'bytes_in': self.bytes_in,
+                    'errors': self.errors, 'throttled': self.throttled}
+
+class MockSalesforceServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, org, port=0, latency_ms=0, jitter_ms=0, error_rate=0.0, max_concurrent=0,
+                 fault_request_types=FILE_REQUEST_TYPES, daily_api_limit=15000000, page_size=QUERY_PAGE_SIZE,
+                 bulk_page_size=50000, certificate=None, session_ttl=0):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), MockSalesforceHandler)
+        self.org = org
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.error_rate = error_rate
+        self.max_concurrent = max_concurrent
+        self.fault_request_types = fault_request_types
+        self.daily_api_limit = daily_api_limit
+        self.page_size = page_size
+        self.bulk_page_size = bulk_page_size
+        # seconds after which a session expires, 0 - never
+        self.session_ttl = session_ttl
+        self.sessions = {}
+        self.stats = Stats()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.api_usage = 0
+        self.cursors = {}
+        self.bulk_jobs = {}
+        self.created = {}
+        self.rng = random.Random(2)
+
+        self.certificate_file, key_file = certificate or create_self_signed_certificate()
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.certificate_file, key_file)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+    @property
+    def url(self):
+        return 'https://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def next_id(self, prefix):
+        with self.lock:
+            self.created[prefix] = self.created.get(prefix, 0) + 1
+            return make_id(prefix, 900000000000 + self.created[prefix])
+
+class MockSalesforceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+    def handle_request(self, method):
+        server = self.server
+        started = time.monotonic()
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = urlparse(self.path).path
+
+        if path.startswith('/services/Soap/'):
+            return self.login(started)
+
+        if not self.is_valid_session():
+            server.stats.add('invalid_session', latency=time.monotonic() - started)
+            return self.send_json(401, [{'errorCode': 'INVALID_SESSION_ID', 'message': 'Session expired or invalid'}])
+
+        parts = path.split('/')[4:]
+        request_type = self.request_type(method, parts)
+        faults = request_type in server.fault_request_types
+        with server.lock:
+            server.in_flight += 1
+            server.api_usage += 1
+            throttled = faults and server.max_concurrent and server.in_flight > server.max_concurrent
+            failed = faults and not throttled and server.rng.random() < server.error_rate
+        try:
+            if server.latency or server.jitter:
+                time.sleep(server.latency + server.rng.uniform(0, server.jitter))
+            if throttled:
+                server.stats.reject(throttled=True)
+                return self.send_json(403, [{'errorCode': 'REQUEST_LIMIT_EXCEEDED',
+                                             'message': 'ConcurrentPerOrgLongTxn Limit exceeded'}])
+            if failed:
+                server.stats.reject(throttled=False)
+                return self.send_json(503, [{'errorCode': 'SERVER_UNAVAILABLE', 'message': 'Mock server error'}])
+            return self.route(request_type, parts, body, started)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def is_valid_session(self):
+        server = self.server
+        session_id = (self.headers.get('Authorization') or ' ').split(' ', 1)[1]
+        with server.lock:
+            issued = server.sessions.get(session_id)
+        return issued is not None and not (server.session_ttl and time.monotonic() - issued > server.session_ttl)
+
+    def request_type(self, method, parts):
+        if parts[:1] == ['query'] and method == 'GET':
+            return 'queryMore' if len(parts) > 1 and parts[1] else 'query'
+        if parts[:1] == ['sobjects'] and method == 'GET' and len(parts) == 4 and parts[3] in ('Body', 'VersionData'):
+            return 'download'
+        if parts[:1] == ['sobjects'] and method == 'POST' and len(parts) >= 2:
+            return 'create'
+        if parts[:1] == ['sobjects'] and method == 'PATCH' and len(parts) == 4:
+            return 'upsert'
+        if parts[:2] == ['composite', 'sobjects'] and method == 'POST':
+            return 'collection'
+        if parts[:2] == ['jobs', 'query']:
+            return 'bulk'
+        if parts[:1] == ['limits'] and method == 'GET':
+            return 'limits'
+        return None
+
+    def route(self, request_type, parts, body, started):
+        if request_type == 'query':
+            return self.query(parse_qs(urlparse(self.path).query)['q'][0], started)
+        if request_type == 'queryMore':
+            return self.query_more(parts[1], started)
+        if request_type == 'download':
+            return self.download(parts[2], started)
+        if request_type == 'create':
+            return self.insert(parts[1], body, started)
+        if request_type == 'upsert':
+            return self.upsert(parts[1], body, started, parts[2], parts[3])
+        if request_type == 'collection':
+            return self.insert_collection(body, started)
+        if request_type == 'bulk':
+            return self.bulk(self.command, parts[2:], body, started)
+        if request_type == 'limits':
+            return self.limits(started)
+        return self.send_json(404, [{'errorCode': 'NOT_FOUND', 'message': 'Unknown resource %s' % self.path}])
+
+    def login(self, started):
+        server = self.server
+        session_id = '00DMOCK!' + base64.b32encode(os.urandom(10)).decode('ascii')
+        with server.lock:
+            server.sessions[session_id] = time.monotonic()
+        response = ('<?xml version="1.0" encoding="UTF-8"?>'
+                    '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns="urn:partner.soap.sforce.com">'
+                    '<soapenv:Body><loginResponse><result>'
+                    '<serverUrl>{url}/services/Soap/u/{version}/00DMOCK</serverUrl>'
+                    '<sessionId>{session_id}</sessionId>'
+                    '</result></loginResponse></soapenv:Body></soapenv:Envelope>').format(url=server.url, version=server.org.api_version, session_id=session_id)
+        server.stats.add('login', latency=time.monotonic() - started)
+        self.send_body(200, response.encode('utf-8'), 'text/xml')
+
+    def limits(self, started):
+        server = self.server
+        server.stats.add('limits', latency=time.monotonic() - started)
+        self.send_json(200, {'DailyApiRequests': {'Max': server.daily_api_limit,
+                                                  'Remaining': server.daily_api_limit - server.api_usage}})
+
+    def query(self, soql, started):
+        try:
+            records = self.server.org.query(soql)
+        except ValueError as ex:
+            return self.send_json(400, [{'errorCode': 'MALFORMED_QUERY', 'message': str(ex)}])
+        self.server.stats.add('query', latency=time.monotonic() - started)
+        self.send_page(records, 0)
+
+    def query_more(self, cursor, started):
+        cursor_id, offset = cursor.rsplit('-', 1)
+        records = self.server.cursors.get(cursor_id)
+        if records is None:
+            return self.send_json(400, [{'errorCode': 'INVALID_QUERY_LOCATOR', 'message': 'invalid query locator'}])
+        self.server.stats.add('queryMore', latency=time.monotonic() - started)
+        self.send_page(records, int(offset))
+
+    def send_page(self, records, offset):
+        server = self.server
+        page = records[offset:offset + server.page_size]
+        response = {'totalSize': len(records), 'done': offset + len(page) >= len(records), 'records': page}
+        if not response['done']:
+            cursor_id = '01gMOCK%d' % id(records)
+            server.cursors[cursor_id] = records
+            response['nextRecordsUrl'] = '/services/data/v%s/query/%s-%d' % (server.org.api_version, cursor_id, offset + len(page))
+        self.send_json(200, response)
+
+    def download(self, record_id, started):
+        server = self.server
+        record = server.org.by_id.get(record_id)
+        if record is None:
+            return self.send_json(404, [{'errorCode': 'NOT_FOUND', 'message': 'The requested resource does not exist'}])
+        size = server.org.blob_size(record)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.send_limit_info()
+        self.end_headers()
+        for chunk in server.org.blob_chunks(record_id, size):
+            self.wfile.write(chunk)
+        server.stats.add('download', records=1, bytes_out=size, latency=time.monotonic() - started)
+
+    def parse_entity(self, body):
+        '''
+        JSON body or the JSON part of a multipart body, plus the binary.
+        '''
+        content_type = self.headers.get('Content-Type', '')
+        # upload_content_versions.py sends JSON with a multipart Content-Type header
+        if content_type.startswith('multipart/form-data') and body.startswith(b'--'):
+            boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode('utf-8')
+            parts = [part for part in body.split(b'--' + boundary) if part.strip() not in (b'', b'--')]
+            entity = json.loads(parts[0].split(b'\r\n\r\n', 1)[1].strip().decode('utf-8'))
+            binary = parts[1].split(b'\r\n\r\n', 1)[1][:-2]
+            return entity, binary
+        entity = json.loads(body.decode('utf-8'))
+        return entity, base64.b64decode(entity.get('Body') or entity.get('VersionData') or '')
+
+    def uploaded_record(self, sobject, record_id, entity, binary):
+        record = dict((key, value) for (key, value) in entity.items() if key not in ('Body', 'VersionData', 'attributes'))
+        record.update({'Id': record_id, 'Checksum': hashlib.md5(binary).hexdigest()})
+        record['BodyLength' if sobject == 'Attachment' else 'ContentSize'] = len(binary)
+        if sobject == 'ContentVersion':
+            record['IsLatest'] = True
+            record.setdefault('ContentDocumentId', self.server.next_id('069'))
+        return record
+
+    def insert(self, sobject, body, started):
+        server = self.server
+        entity, binary = self.parse_entity(body)
+        record_id = server.next_id('00P' if sobject == 'Attachment' else '068')
+        server.org.add_upload(sobject, self.uploaded_record(sobject, record_id, entity, binary))
+        server.stats.add('create', records=1, bytes_in=len(binary), latency=time.monotonic() - started)
+        self.send_json(201, {'id': record_id, 'success': True, 'errors': []})
+
+    def upsert(self, sobject, body, started, upsert_field, upsert_value):
+        server = self.server
+        entity, binary = self.parse_entity(body)
+        record_id = server.next_id('068')
+        entity[upsert_field] = upsert_value
+        server.org.add_upload(sobject, self.uploaded_record(sobject, record_id, entity, binary), upsert_field)
+        server.stats.add('upsert', records=1, bytes_in=len(binary), latency=time.monotonic() - started)
+        self.send_json(201, {'id': record_id, 'success': True, 'errors': [], 'created': True})
+
+    def insert_collection(self, body, started):
+        server = self.server
+        request = json.loads(body.decode('utf-8'))
+        results = []
+        size = 0
+        for record in request['records']:
+            sobject = record['attributes']['type']
+            binary = base64.b64decode(record.get('Body') or '')
+            size += len(binary)
+            record_id = server.next_id(COLLECTION_ID_PREFIXES.get(sobject, '000'))
+            server.org.add_upload(sobject, self.uploaded_record(sobject, record_id, record, binary))
+            results.append({'id': record_id, 'success': True, 'errors': []})
+        server.stats.add('collection', records=len(results), bytes_in=size, latency=time.monotonic() - started)
+        self.send_json(200, results)
+
+    def bulk(self, method, parts, body, started):
+        server = self.server
+        if method == 'POST' and not parts:
+            request = json.loads(body.decode('utf-8'))
+            job_id = '750MOCK%06d' % (len(server.bulk_jobs) + 1)
+            server.bulk_jobs[job_id] = server.org.query(request['query'])
+            server.stats.add('bulk', latency=time.monotonic() - started)
+            return self.send_json(200, {'id': job_id, 'state': 'UploadComplete', 'operation': 'query'})
+        records = server.bulk_jobs.get(parts[0])
+        if records is None:
+            return self.send_json(404, [{'errorCode': 'NOT_FOUND', 'message': 'Unknown job'}])
+        server.stats.add('bulk', latency=time.monotonic() - started)
+        if len(parts) == 1:
+            return self.send_json(200, {'id': parts[0], 'state': 'JobComplete', 'numberRecordsProcessed': len(records)})
+
+        query = parse_qs(urlparse(self.path).query)
+        offset = int(query.get('locator', ['0'])[0])
+        max_records = int(query.get('maxRecords', [server.bulk_page_size])[0])
+        page = records[offset:offset + max_records]
+        output = io.StringIO()
+        fields = [field for field in (records[0].keys() if records else []) if field != 'attributes']
+        writer = csv.DictWriter(output, fields, extrasaction='ignore', quoting=csv.QUOTE_ALL, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows({field: '' if record[field] is None else record[field] for field in fields} for record in page)
+        locator = str(offset + len(page)) if offset + len(page) < len(records) else 'null'
+        self.send_body(200, output.getvalue().encode('utf-8'), 'text/csv', {'Sforce-Locator': locator})
+
+    def send_limit_info(self):
+        self.send_header('Sforce-Limit-Info', 'api-usage=%d/%d' % (self.server.api_usage, self.server.daily_api_limit))
+
+    def send_json(self, status, content):
+        self.send_body(status, json.dumps(content).encode('utf-8'), 'application/json;charset=UTF-8')
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_limit_info()
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+def create_self_signed_certificate(folder=None):
+    '''
+    Certificate for 127.0.0.1 / localhost, returns (certificate file, key file).
+    '''
+    import ipaddress
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    folder = folder or tempfile.mkdtemp(prefix='mock_salesforce_')
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, u'localhost')])
+    now = datetime.datetime.utcnow()
+    certificate = (x509.CertificateBuilder().subject_name(name).issuer_name(name)
+                   .public_key(key.public_key()).serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=30))
+                   .add_extension(x509.SubjectAlternativeName([x509.DNSName(u'localhost'),
+                                                               x509.IPAddress(ipaddress.ip_address(u'127.0.0.1'))]), critical=False)
+                   .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+                   .sign(key, hashes.SHA256()))
+    certificate_file = os.path.join(folder, 'certificate.pem')
+    key_file = os.path.join(folder, 'key.pem')
+    with open(certificate_file, 'wb') as output_file:
+        output_file.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_file, 'wb') as output_file:
+        output_file.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                            serialization.NoEncryption()))
+    return certificate_file, key_file
+
+def add_server_arguments(parser):
+    parser.add_argument("--attachments", type=int, default=200, help="Number of Attachments in the mock org")
+    parser.add_argument("--content-versions", type=int, default=200, help="Number of ContentVersions in the mock org")
+    parser.add_argument("--parents", type=int, default=20, help="Number of parent records")
+    parser.add_argument("--size-distribution", default='lognormal:20000:1.5',
+                        help="File sizes: fixed:<bytes>, uniform:<min>:<max> or lognormal:<median>:<sigma> (default: %(default)s)")
+    parser.add_argument("--latency-ms", type=float, default=20, help="Latency added to every API request")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="Random extra latency of up to this many ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of API requests failing with 503")
+    parser.add_argument("--max-concurrent", type=int, default=0,
+                        help="Requests beyond this concurrency fail with REQUEST_LIMIT_EXCEEDED (0 - unlimited)")
+    parser.add_argument("--fault-requests", default=','.join(FILE_REQUEST_TYPES),
+                        help="Request types affected by --error-rate and --max-concurrent, out of query, queryMore, "
+                             "download, create, upsert, collection and bulk (default: %(default)s)")
+    parser.add_argument("--session-ttl", type=float, default=0,
+                        help="Seconds after which a session expires and its requests fail with 401 INVALID_SESSION_ID (0 - never)")
+    parser.add_argument("--page-size", type=int, default=QUERY_PAGE_SIZE, help="Records per query page")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the generated org content")
+
+def create_server(args, port=0):
+    org = MockOrg(attachments=args.attachments, content_versions=args.content_versions, parents=args.parents,
+                  size_distribution=args.size_distribution, seed=args.seed)
+    return MockSalesforceServer(org, port=port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                                error_rate=args.error_rate, max_concurrent=args.max_concurrent,
+                                fault_request_types=args.fault_requests.split(','), page_size=args.page_size,
+                                session_ttl=args.session_ttl)
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mock of the Salesforce APIs used by the export and upload scripts')
+    parser.add_argument("--port", type=int, default=8443, help="Port to listen on")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = create_server(args, port=args.port)
+    print('Mock Salesforce listening on %s' % server.url)
+    print('export REQUESTS_CA_BUNDLE=%s' % server.certificate_file)
+    print('export MOCK_SALESFORCE_URL=%s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats.as_dict(), indent=2))
+
+if __name__ == "__main__":
+    main()
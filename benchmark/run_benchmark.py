@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+'''
+Throughput benchmark of the export and upload scripts against the local mock server.
+
+Every script runs in its own process, the upload scripts use the files written by the
+export scripts. For every script the benchmark reports files/s, MB/s, the peak RSS of
+the process and the number of API calls per file as counted by the mock server.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_salesforce import add_server_arguments, create_server
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+BIN_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), 'bin')
+SCRIPTS = ('export_attachments', 'export_content_version', 'upload_attachments', 'upload_content_versions', 'upload_content_document_links')
+UPLOAD_REQUEST_TYPES = ('create', 'upsert', 'collection')
+
+def write_salesforce_config(work_dir):
+    salesforce_config_file = os.path.join(work_dir, 'salesforce.ini')
+    # the scripts of a run share a session, the mock of an earlier run is gone with its sessions
+    session_cache_file = os.path.join(work_dir, 'salesforce_session.json')
+    if os.path.isfile(session_cache_file):
+        os.remove(session_cache_file)
+    with open(salesforce_config_file, 'w') as config_file:
+        config_file.write('[salesforce]\nusername = benchmark@example.com\npassword = password\n'
+                          'security_token = token\nconnect_to_sandbox = False\ndomain =\n'
+                          'session_cache = %s\n' % session_cache_file)
+    return salesforce_config_file
+
+def write_mappings(org, work_dir):
+    '''
+    Map the records of the mock org onto themselves, the upload only needs a target Id.
+    '''
+    mapping_files = []
+    for name, ids in (('parent_mapping.csv', org.parents), ('user_mapping.csv', org.users)):
+        mapping_file = os.path.join(work_dir, name)
+        with open(mapping_file, 'w') as output_file:
+            output_file.write('OriginalId,NewId\n')
+            for record_id in ids:
+                output_file.write('%s,%s\n' % (record_id, record_id))
+        mapping_files.append(mapping_file)
+    return mapping_files
+
+def script_arguments(script, args, work_dir, salesforce_config_file, parent_mapping, user_mapping):
+    export_folder = os.path.join(work_dir, 'export')
+    if script == 'export_attachments':
+        arguments = ['-q', 'SELECT Id FROM Account', '-o', export_folder, '-s', salesforce_config_file, '--restart']
+        return arguments + (['-c', args.attachment_config] if args.attachment_config else [])
+    if script == 'export_content_version':
+        arguments = ['-q', 'SELECT Id FROM Account', '-o', export_folder, '-s', salesforce_config_file, '--restart']
+        return arguments + (['-c', args.content_version_config] if args.content_version_config else [])
+
+    if script == 'upload_content_document_links':
+        # links the documents uploaded by upload_content_versions of the same run
+        arguments = ['-s', salesforce_config_file, '-t', str(args.max_in_flight), '-u', 'Source_Original_Id__c', '-p', parent_mapping,
+                     '-i', os.path.join(export_folder, 'content_document_link.csv'), '-c', os.path.join(export_folder, 'content_version.csv')]
+    else:
+        arguments = ['-s', salesforce_config_file, '-t', str(args.max_in_flight)] + (['-m'] if args.multipart else []) + (['--skip-existing'] if args.skip_existing else [])
+    if args.retry_failed:
+        # a rerun of the script only uploads the rows which failed in the previous run
+        result_file = os.path.join(work_dir, script + '_results.csv')
+        arguments += ['--result-file', result_file] + (['--retry-failed', result_file] if os.path.isfile(result_file) else [])
+    if script == 'upload_content_document_links':
+        return arguments
+    if script == 'upload_attachments':
+        return arguments + ['-i', os.path.join(export_folder, 'attachment.csv'), '-f', os.path.join(export_folder, 'Attachment'),
+                            '-u', user_mapping, '-p', parent_mapping, '-b', str(args.batch_threshold)]
+    return arguments + ['-i', os.path.join(export_folder, 'content_version.csv'), '-f', os.path.join(export_folder, 'ContentVersion'),
+                        '-u', 'Source_Original_Id__c']
+
+def run_script(script, arguments, server, work_dir):
+    '''
+    Run one script through bootstrap.py and return its measurements.
+    '''
+    metrics_file = os.path.join(work_dir, script + '_metrics.json')
+    peak_rss_file = os.path.join(work_dir, script + '_peak_rss')
+    if os.path.isfile(peak_rss_file):
+        os.remove(peak_rss_file)
+    environment = dict(os.environ, MOCK_SALESFORCE_URL=server.url, REQUESTS_CA_BUNDLE=server.certificate_file,
+                       BENCHMARK_PEAK_RSS_FILE=peak_rss_file)
+    command = [sys.executable, os.path.join(BENCHMARK_DIR, 'bootstrap.py'), os.path.join(BIN_DIR, script + '.py')] + arguments + ['--metrics-file', metrics_file]
+    server.stats.reset()
+    with open(os.path.join(work_dir, script + '.log'), 'w') as log_file:
+        started = time.monotonic()
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, env=environment)
+        # wait4 instead of wait() to get the resource usage of this process only
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        elapsed = time.monotonic() - started
+
+    stats = server.stats.as_dict()
+    if script.startswith('export'):
+        files = stats['records'].get('download', 0)
+        transferred = stats['bytes_out']
+    else:
+        files = sum(stats['records'].get(request_type, 0) for request_type in UPLOAD_REQUEST_TYPES)
+        transferred = stats['bytes_in']
+    return {'script': script, 'exit_code': process.returncode, 'seconds': elapsed, 'files': files,
+            'megabytes': transferred / 1024.0 / 1024.0,
+            'files_per_second': files / elapsed if elapsed else 0,
+            'megabytes_per_second': transferred / 1024.0 / 1024.0 / elapsed if elapsed else 0,
+            # both are in kilobytes on Linux
+            'peak_rss_mb': read_peak_rss(peak_rss_file, usage.ru_maxrss) / 1024.0,
+            'api_calls': stats['api_calls'], 'logins': stats['requests'].get('login', 0),
+            'api_calls_per_file': float(stats['api_calls']) / files if files else None,
+            'throttled': stats['throttled'], 'errors': stats['errors'], 'requests': stats['requests'],
+            # phase timing and latency histograms reported by the script itself
+            'script_metrics': read_script_metrics(metrics_file)}
+
+def read_peak_rss(peak_rss_file, default):
+    if not os.path.isfile(peak_rss_file):
+        return default
+    with open(peak_rss_file) as input_file:
+        return int(input_file.read())
+
+def read_script_metrics(metrics_file):
+    if not os.path.isfile(metrics_file):
+        return None
+    with open(metrics_file) as input_file:
+        return json.load(input_file)
+
+def print_results(results):
+    print('{0:<30} {1:>6} {2:>8} {3:>8} {4:>8} {5:>8} {6:>9} {7:>10} {8:>9} {9:>7}'.format(
+        'script', 'exit', 'files', 'seconds', 'files/s', 'MB/s', 'RSS (MB)', 'API calls', 'per file', 'logins'))
+    for result in results:
+        print('{script:<30} {exit_code:>6} {files:>8} {seconds:>8.2f} {files_per_second:>8.1f} {megabytes_per_second:>8.2f} '
+              '{peak_rss_mb:>9.1f} {api_calls:>10} {per_file:>9} {logins:>7}'.format(
+                  per_file='-' if result['api_calls_per_file'] is None else '%.2f' % result['api_calls_per_file'], **result))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the export and upload scripts against a local mock of Salesforce')
+    add_server_arguments(parser)
+    parser.add_argument("--scripts", default=','.join(SCRIPTS),
+                        help="Comma separated scripts to run, uploads need the export of the same run (default: %(default)s)")
+    parser.add_argument("--work-dir", help="Folder for the exported files and the script logs (default: temporary folder)")
+    parser.add_argument("--attachment-config", help="export_attachment.ini to use instead of the default one")
+    parser.add_argument("--content-version-config", help="export_content_version.ini to use instead of the default one")
+    parser.add_argument("-t", "--max-in-flight", type=int, default=8, help="-t of the upload scripts (default: %(default)s)")
+    parser.add_argument("-m", "--multipart", action='store_true', help="-m of the upload scripts")
+    parser.add_argument("--skip-existing", action='store_true', help="--skip-existing of the upload scripts, list an upload script twice in --scripts to measure a rerun")
+    parser.add_argument("--retry-failed", action='store_true', help="Write result files and retry the failed rows when an upload script runs again, list it twice in --scripts")
+    parser.add_argument("-b", "--batch-threshold", type=int, default=0, help="-b of upload_attachments.py (default: %(default)s)")
+    parser.add_argument("--json-output", help="Also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='salesforce_benchmark_')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    server = create_server(args).start()
+    salesforce_config_file = write_salesforce_config(work_dir)
+    parent_mapping, user_mapping = write_mappings(server.org, work_dir)
+
+    results = []
+    try:
+        for script in args.scripts.split(','):
+            script = script.strip()
+            if script not in SCRIPTS:
+                parser.error("Unknown script %s" % script)
+            arguments = script_arguments(script, args, work_dir, salesforce_config_file, parent_mapping, user_mapping)
+            results.append(run_script(script, arguments, server, work_dir))
+    finally:
+        server.shutdown()
+
+    print('Work folder: %s' % work_dir)
+    print_results(results)
+    if args.json_output:
+        with open(args.json_output, 'w') as output_file:
+            json.dump({'settings': vars(args), 'results': results}, output_file, indent=2)
+    if any(result['exit_code'] for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
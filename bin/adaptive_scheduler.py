@@ -0,0 +1,207 @@
+import logging
+import random
+import re
+import threading
+import time
+import requests
+from run_metrics import phase
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+# above this share of the daily API requests the concurrency is not increased any more
+DEFAULT_API_USAGE_THRESHOLD = 0.9
+
+TRANSIENT_STATUS_CODES = (429, 500, 502, 503, 504)
+THROTTLING_ERROR_CODES = ('REQUEST_LIMIT_EXCEEDED', 'SERVER_UNAVAILABLE', 'UNABLE_TO_LOCK_ROW')
+THROTTLING_MESSAGES = ('ConcurrentPerOrgLongTxn', 'TotalRequests Limit exceeded')
+# a create which failed any other way may have created its record, so only these
+# rejections are retried for creates
+CREATE_RETRY_STATUS_CODES = (429, 503)
+CREATE_RETRY_ERROR_CODES = ('REQUEST_LIMIT_EXCEEDED', 'UNABLE_TO_LOCK_ROW')
+
+TRANSIENT_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)
+
+class TransientError(Exception):
+   '''
+   Raised by a scheduled call to have it retried after a backoff.
+   '''
+   def __init__(self, message, throttled=True):
+      super(TransientError, self).__init__(message)
+      self.throttled = throttled
+
+class AdaptiveScheduler(object):
+   '''
+   Shared gate for all requests to one org.
+   The number of requests allowed in flight grows by one per round of successful
+   requests and is halved when Salesforce throttles (AIMD), so a run settles close to
+   what the org allows instead of using a hand tuned worker count.
+   Transient failures are retried with exponential backoff and full jitter. The time
+   calls wait for a slot or back off is the scheduler_wait phase of metrics.
+   '''
+   def __init__(self, max_concurrency, min_concurrency=1, initial_concurrency=None,
+                max_retries=DEFAULT_MAX_RETRIES, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                api_usage_threshold=DEFAULT_API_USAGE_THRESHOLD, metrics=None):
+      self.max_concurrency = max(1, max_concurrency)
+      self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+      self.limit = float(initial_concurrency or self.max_concurrency)
+      self.max_retries = max_retries
+      self.base_delay = base_delay
+      self.max_delay = max_delay
+      self.api_usage_threshold = api_usage_threshold
+      self.api_usage = None
+      self.metrics = metrics
+      self.in_flight = 0
+      self.last_decrease = 0
+      self.condition = threading.Condition()
+
+   def acquire(self):
+      with self.condition:
+         while self.in_flight >= int(self.limit):
+            self.condition.wait()
+         self.in_flight += 1
+
+   def release(self, throttled=False, succeeded=True):
+      with self.condition:
+         self.in_flight -= 1
+         if throttled:
+            self.decrease()
+         elif succeeded and not self.near_api_limit():
+            # additive increase: +1 after about limit successful requests
+            self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+         self.condition.notify_all()
+
+   def decrease(self):
+      # requests already in flight fail together, only back off once per backoff period
+      now = time.monotonic()
+      if now - self.last_decrease < self.base_delay:
+         return
+      self.last_decrease = now
+      previous_limit = int(self.limit)
+      self.limit = max(self.min_concurrency, self.limit / 2)
+      if int(self.limit) < previous_limit:
+         logging.warning("Salesforce is throttling requests, concurrency reduced to {0}".format(int(self.limit)))
+
+   def near_api_limit(self):
+      return self.api_usage is not None and self.api_usage >= self.api_usage_threshold
+
+   def observe_limit_info(self, limit_info):
+      '''
+      Track the Sforce-Limit-Info header, e.g. "api-usage=25/15000".
+      '''
+      usage = parse_limit_info(limit_info)
+      if usage:
+         self.api_usage = float(usage[0]) / usage[1] if usage[1] else None
+
+   def backoff(self, attempt):
+      return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+   def call(self, function, *args, **kwargs):
+      '''
+      Run function within the concurrency limit. TransientError makes the call
+      retry after a jittered backoff, up to max_retries times.
+      Any other exception is passed to the caller untouched.
+      '''
+      attempt = 0
+      while True:
+         with phase(self.metrics, 'scheduler_wait'):
+            self.acquire()
+         try:
+            result = function(*args, **kwargs)
+         except TransientError as ex:
+            # only successful calls make the limit grow
+            self.release(throttled=ex.throttled, succeeded=False)
+            if attempt >= self.max_retries:
+               raise
+            delay = self.backoff(attempt)
+            attempt += 1
+            logging.debug("Retry {0}/{1} in {2:.1f}s: {3}".format(attempt, self.max_retries, delay, ex))
+            with phase(self.metrics, 'scheduler_wait', 'backoff'):
+               time.sleep(delay)
+            continue
+         except Exception:
+            self.release(succeeded=False)
+            raise
+         self.release()
+         return result
+
+   def call_api(self, function, *args, **kwargs):
+      '''
+      call() for simple_salesforce methods: throttling errors are retried and, when
+      the retries are exhausted, the original exception is raised to the caller.
+      '''
+      return self.call_salesforce(function, args, kwargs)
+
+   def call_create(self, function, *args, **kwargs):
+      '''
+      call_api() for requests which insert records. Only clear rejections are retried:
+      after a timeout, a dropped connection or a server error the records may have been
+      created, so the exception is raised at once and the caller fails the rows.
+      '''
+      return self.call_salesforce(function, args, kwargs, idempotent=False)
+
+   def call_salesforce(self, function, args, kwargs, idempotent=True):
+      def attempt():
+         try:
+            result = function(*args, **kwargs)
+         except Exception as ex:
+            if is_throttling_exception(ex, idempotent):
+               raise TransientError(str(ex), throttled=not isinstance(ex, TRANSIENT_EXCEPTIONS)) from ex
+            if not idempotent and is_throttling_exception(ex):
+               logging.warning("Not retried, the records may have been created: {0}".format(ex))
+            raise
+         # SFType and Salesforce objects keep the last Sforce-Limit-Info in api_usage
+         method = getattr(function, '__wrapped__', function)
+         usage = getattr(getattr(method, '__self__', None), 'api_usage', {}).get('api-usage')
+         if usage and usage.total:
+            self.api_usage = float(usage.used) / usage.total
+         return result
+
+      try:
+         return self.call(attempt)
+      except TransientError as ex:
+         raise ex.__cause__
+
+def call_api(scheduler, function, *args, **kwargs):
+   if scheduler is None:
+      return function(*args, **kwargs)
+   return scheduler.call_api(function, *args, **kwargs)
+
+def call_create(scheduler, function, *args, **kwargs):
+   if scheduler is None:
+      return function(*args, **kwargs)
+   return scheduler.call_create(function, *args, **kwargs)
+
+def parse_limit_info(limit_info):
+   # the org usage, not per-app-api-usage of a connected app
+   match = re.search(r'(?<![\w-])api-usage=(\d+)/(\d+)', limit_info or '')
+   if match:
+      return int(match.group(1)), int(match.group(2))
+   return None
+
+def is_throttling_response(status_code, content, idempotent=True):
+   '''
+   True for responses which should be retried: 429/5xx and the
+   REQUEST_LIMIT_EXCEEDED family of errors (e.g. ConcurrentPerOrgLongTxn).
+   Requests which are not idempotent are only retried when Salesforce rejected them.
+   '''
+   status_codes = TRANSIENT_STATUS_CODES if idempotent else CREATE_RETRY_STATUS_CODES
+   error_codes = THROTTLING_ERROR_CODES if idempotent else CREATE_RETRY_ERROR_CODES
+   if status_code in status_codes:
+      return True
+   text = content if isinstance(content, str) else repr(content)
+   return any(code in text for code in error_codes + THROTTLING_MESSAGES)
+
+def is_throttling_exception(ex, idempotent=True):
+   '''
+   Same classification for the exceptions raised by simple_salesforce and requests.
+   A timeout or a dropped connection doesn't tell whether Salesforce ran the request.
+   '''
+   if hasattr(ex, 'status') and hasattr(ex, 'content'):
+      return is_throttling_response(ex.status, ex.content, idempotent)
+   return idempotent and isinstance(ex, TRANSIENT_EXCEPTIONS)
+
+def read_scheduler_config(config_section):
+   return {'max_retries': int(config_section.get('max_retries', DEFAULT_MAX_RETRIES)),
+           'base_delay': float(config_section.get('retry_base_delay', DEFAULT_BASE_DELAY)),
+           'min_concurrency': int(config_section.get('min_workers', 1))}
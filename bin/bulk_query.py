@@ -0,0 +1,138 @@
+import codecs
+import csv
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+import requests
+
+DEFAULT_MAX_RECORDS = 50000
+RESULT_CHUNK_SIZE = 64 * 1024
+POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 10
+
+class BulkQueryError(Exception):
+    pass
+
+class BulkQuery(object):
+    '''
+    Minimal Bulk API 2.0 query client.
+    The result CSV of a job is read page by page (Sforce-Locator) from the streamed
+    response, so records can be processed while the rest of the result is still
+    being downloaded and the whole result is never held in memory.
+    base_url is the REST base URL of the org, e.g. sf.base_url
+    (https://<instance>/services/data/vXX.X/).
+    '''
+    def __init__(self, base_url, session_id, session=None, max_records=DEFAULT_MAX_RECORDS):
+        self.jobs_url = base_url.rstrip('/') + '/jobs/query'
+        self.session = session or requests.Session()
+        self.headers = {'Authorization': 'Bearer ' + session_id}
+        self.max_records = max_records
+
+    def submit(self, query):
+        response = self.session.post(self.jobs_url, json={'operation': 'query', 'query': query},
+                                     headers=self.headers)
+        if not response.ok:
+            raise BulkQueryError("Couldn't create Bulk API query job: %s" % response.text)
+        return response.json()['id']
+
+    def wait(self, job_id):
+        poll_interval = POLL_INTERVAL
+        while True:
+            response = self.session.get(self.jobs_url + '/' + job_id, headers=self.headers)
+            if not response.ok:
+                raise BulkQueryError("Couldn't get state of Bulk API job %s: %s" % (job_id, response.text))
+            job = response.json()
+            if job['state'] == 'JobComplete':
+                return job
+            if job['state'] in ('Failed', 'Aborted'):
+                raise BulkQueryError("Bulk API job %s %s: %s" % (job_id, job['state'], job.get('errorMessage')))
+            logging.debug("Bulk API job {0} is {1}, {2} records processed".format(job_id, job['state'], job.get('numberRecordsProcessed')))
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, MAX_POLL_INTERVAL)
+
+    def results(self, job_id):
+        '''
+        Yield the records of a completed job as dictionaries, page by page.
+        '''
+        locator = None
+        while True:
+            params = {'maxRecords': self.max_records}
+            if locator:
+                params['locator'] = locator
+            with self.session.get(self.jobs_url + '/' + job_id + '/results', params=params,
+                                  headers=dict(self.headers, Accept='text/csv'), stream=True) as response:
+                if not response.ok:
+                    raise BulkQueryError("Couldn't get results of Bulk API job %s: %s" % (job_id, response.text))
+                locator = response.headers.get('Sforce-Locator')
+                for record in csv.DictReader(iter_lines(response)):
+                    yield record
+            if not locator or locator == 'null':
+                return
+
+    def query(self, query):
+        job_id = self.submit(query)
+        logging.info("Bulk API query job {0} submitted".format(job_id))
+        self.wait(job_id)
+        return self.results(job_id)
+
+def iter_lines(response):
+    '''
+    Lines of a streamed text response including their line endings, so that csv can
+    still parse quoted values with line breaks.
+    '''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    for chunk in response.iter_content(chunk_size=RESULT_CHUNK_SIZE):
+        pending += decoder.decode(chunk)
+        lines = pending.splitlines(keepends=True)
+        pending = lines.pop() if lines and not lines[-1].endswith(('\n', '\r')) else ''
+        for line in lines:
+            yield line
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+class SeenValues(object):
+    '''
+    Set of the values seen so far in a temporary SQLite database, so finding the distinct
+    values of millions of records doesn't need memory for all of them.
+    '''
+    def __init__(self):
+        handle, self.database_file = tempfile.mkstemp(prefix='seen_values_', suffix='.sqlite')
+        os.close(handle)
+        self.connection = sqlite3.connect(self.database_file, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('CREATE TABLE seen (value TEXT PRIMARY KEY) WITHOUT ROWID')
+        # a single transaction which is never committed, the database is thrown away
+        self.connection.execute('BEGIN')
+
+    def add(self, value):
+        '''
+        Add value, True if it wasn't seen before.
+        '''
+        return self.connection.execute('INSERT OR IGNORE INTO seen VALUES (?)', (value,)).rowcount == 1
+
+    def close(self):
+        self.connection.close()
+        if os.path.isfile(self.database_file):
+            os.remove(self.database_file)
+
+def unique_values(records, field, on_record=None):
+    '''
+    Yield the distinct values of field, calling on_record for every record on the way.
+    '''
+    seen = SeenValues()
+    try:
+        for record in records:
+            if on_record:
+                on_record(record)
+            if seen.add(record[field]):
+                yield record[field]
+    finally:
+        seen.close()
+
+def read_bulk_config(config_section):
+    return config_section.get('id_query_backend', 'rest') == 'bulk', int(config_section.get('bulk_max_records', DEFAULT_MAX_RECORDS))
@@ -0,0 +1,271 @@
+import json
+import logging
+import statistics
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+from composite_upload import group_small_files
+from query_planner import plan_id_batches, build_id_query, query_all_pages, DEFAULT_MAX_QUERY_LENGTH
+from run_metrics import phase, format_duration
+
+# upper bounds of the file size buckets of the report
+SIZE_BUCKETS = (10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024, 100 * 1024 * 1024, 1024 * 1024 * 1024)
+DEFAULT_CONCURRENCIES = (1, 2, 4, 8, 16, 32)
+# per request, used unless the metrics of a previous run are given
+ASSUMED_BANDWIDTH = 5 * 1024 * 1024
+LATENCY_PROBES = 3
+MIN_TRANSFER_SHARE = 0.5
+
+def format_bytes(size):
+   if size < 1024:
+      return '{0} B'.format(int(size))
+   for unit in ('KB', 'MB', 'GB'):
+      size /= 1024.0
+      if size < 1024:
+         return '{0:.1f} {1}'.format(size, unit)
+   return '{0:.1f} TB'.format(size / 1024.0)
+
+def request_type_of(response):
+   path = urlparse(response.url).path
+   if '/jobs/query' in path:
+      return 'bulk_query'
+   if '/query' in path:
+      # a query and its queryMore pages
+      return 'query'
+   if path.rstrip('/').endswith('/limits'):
+      return 'limits'
+   return 'other'
+
+class CapacityPlan(object):
+   '''
+   Dry-run estimate of an export or upload: file count, bytes and size distribution,
+   the API calls it needs and its runtime at different concurrencies. The runtime of a
+   request is modelled as the measured request latency plus its bytes over the bandwidth
+   of one request, so n requests at concurrency c take about
+   max(sum of request times / c, longest request), and no less than the metadata queries.
+   '''
+   def __init__(self, name, concurrency=None):
+      self.name = name
+      self.concurrency = concurrency
+      self.files = 0
+      self.bytes = 0
+      self.largest = 0
+      self.missing = 0
+      self.skipped = 0
+      self.buckets = [[0, 0] for _ in range(len(SIZE_BUCKETS) + 1)]
+      self.calls = {}
+      self.lock = threading.Lock()
+      self.transfers = 0
+      self.transfer_bytes = 0
+      self.largest_transfer = 0
+      self.latencies = {}
+      self.metadata_seconds = 0.0
+      self.bandwidth = None
+      self.transfer_latency = None
+      self.api_requests = None
+
+   def add_file(self, size):
+      size = int(size or 0)
+      self.files += 1
+      self.bytes += size
+      self.largest = max(self.largest, size)
+      bucket = next((i for i, bound in enumerate(SIZE_BUCKETS) if size < bound), len(SIZE_BUCKETS))
+      self.buckets[bucket][0] += 1
+      self.buckets[bucket][1] += size
+
+   def add_missing(self):
+      self.missing += 1
+
+   def add_skipped(self):
+      self.skipped += 1
+
+   def add_calls(self, request_type, count=1):
+      with self.lock:
+         self.calls[request_type] = self.calls.get(request_type, 0) + count
+
+   def count_requests(self, session):
+      '''
+      Count the API calls which the dry run makes through session by type, they are the
+      calls the real run makes before its transfers.
+      '''
+      session.hooks['response'].append(lambda response, *args, **kwargs: self.add_calls(request_type_of(response)))
+
+   def add_transfer(self, request_type, size):
+      '''
+      One request which sends or receives size bytes, a download or an upload.
+      '''
+      self.add_calls(request_type)
+      self.transfers += 1
+      self.transfer_bytes += size
+      self.largest_transfer = max(self.largest_transfer, size)
+
+   def observe_latency(self, request_type, seconds):
+      self.latencies.setdefault(request_type, []).append(seconds)
+
+   def add_metadata_time(self, seconds):
+      self.metadata_seconds += seconds
+
+   def latency(self):
+      # the round trip of the cheapest measured request, without query processing
+      samples = self.latencies.get('limits') or [seconds for samples in self.latencies.values() for seconds in samples]
+      return statistics.median(samples) if samples else 0.0
+
+   def calibrate(self, metrics_file, phase_name):
+      '''
+      Bandwidth of one request from the metrics (--metrics-file, JSON) of a previous run:
+      its bytes over the time its transfer requests were busy, less their latency.
+      '''
+      with open(metrics_file) as input_file:
+         metrics = json.load(input_file)
+      transfer_phase = metrics.get('phases', {}).get(phase_name)
+      if not transfer_phase or not transfer_phase['seconds'] or not metrics.get('bytes'):
+         logging.warning('No {0} phase in {1}, assuming {2}/s per request'.format(phase_name, metrics_file, format_bytes(ASSUMED_BANDWIDTH)))
+         return
+      # the probes can take longer than the transfers on the warm connections of a run,
+      # at least MIN_TRANSFER_SHARE of the time of a transfer is put down to its bytes
+      request_seconds = transfer_phase['seconds'] / max(transfer_phase['count'], 1)
+      self.transfer_latency = min(self.latency(), request_seconds * (1 - MIN_TRANSFER_SHARE))
+      self.bandwidth = metrics['bytes'] / (transfer_phase['seconds'] - transfer_phase['count'] * self.transfer_latency)
+
+   def probe(self, sf, probes=LATENCY_PROBES):
+      '''
+      Measure the request latency with calls of the limits resource, which also tells
+      how many API requests of the day are left.
+      '''
+      for _ in range(probes):
+         started = time.monotonic()
+         try:
+            limits = sf.limits()
+         except Exception as ex:
+            logging.warning("Couldn't read the limits of the org: {0}".format(ex))
+            return
+         self.observe_latency('limits', time.monotonic() - started)
+      daily_api_requests = limits.get('DailyApiRequests', {})
+      if 'Remaining' in daily_api_requests:
+         self.api_requests = (daily_api_requests['Remaining'], daily_api_requests.get('Max'))
+
+   def api_calls(self):
+      return sum(count for request_type, count in self.calls.items() if request_type != 'limits')
+
+   def runtime(self, concurrency):
+      bandwidth = self.bandwidth or ASSUMED_BANDWIDTH
+      latency = self.transfer_latency if self.transfer_latency is not None else self.latency()
+      busy = self.transfers * latency + self.transfer_bytes / bandwidth
+      longest = latency + self.largest_transfer / bandwidth if self.transfers else 0
+      return max(busy / concurrency, longest, self.metadata_seconds)
+
+   def concurrencies(self):
+      return sorted(set(DEFAULT_CONCURRENCIES) | set([self.concurrency] if self.concurrency else []))
+
+   def as_dict(self):
+      return {'name': self.name, 'files': self.files, 'bytes': self.bytes, 'largest_file': self.largest,
+              'missing_files': self.missing, 'skipped_files': self.skipped,
+              'size_buckets': dict(('<' + format_bytes(bound) if i < len(SIZE_BUCKETS) else '>=' + format_bytes(SIZE_BUCKETS[-1]),
+                                    {'files': files, 'bytes': size})
+                                   for i, (bound, (files, size)) in enumerate(zip(SIZE_BUCKETS + (None,), self.buckets))),
+              'api_calls': self.api_calls(), 'api_calls_by_type': dict(self.calls),
+              'api_requests_remaining': self.api_requests[0] if self.api_requests else None,
+              'latency_seconds': self.latency(), 'transfer_latency_seconds': self.transfer_latency, 'metadata_seconds': self.metadata_seconds,
+              'bandwidth_bytes_per_second': self.bandwidth or ASSUMED_BANDWIDTH, 'bandwidth_measured': self.bandwidth is not None,
+              'runtime_seconds': dict((str(concurrency), self.runtime(concurrency)) for concurrency in self.concurrencies())}
+
+   def report(self, stream=sys.stdout):
+      lines = ['Capacity plan of {0} (dry run, no file was transferred)'.format(self.name), '',
+               '{0:<24}{1:,}'.format('Files', self.files),
+               '{0:<24}{1}'.format('Total size', format_bytes(self.bytes)),
+               '{0:<24}{1}'.format('Largest file', format_bytes(self.largest))]
+      if self.missing:
+         lines.append('{0:<24}{1:,}'.format('Missing files', self.missing))
+      if self.skipped:
+         lines.append('{0:<24}{1:,}'.format('Skipped files', self.skipped))
+      lines.append('Size distribution')
+      lower = 0
+      for bound, (files, size) in zip(SIZE_BUCKETS + (None,), self.buckets):
+         label = '{0} - {1}'.format(format_bytes(lower), format_bytes(bound)) if bound else '>= ' + format_bytes(lower)
+         lines.append('  {0:<22}{1:>12,} files {2:>12}'.format(label, files, format_bytes(size)))
+         lower = bound
+      lines.append('{0:<24}{1:,} ({2})'.format('API calls', self.api_calls(), ', '.join(
+         '{0} {1:,}'.format(request_type, count) for request_type, count in sorted(self.calls.items()) if request_type != 'limits')))
+      if self.api_requests:
+         lines.append('{0:<24}{1:,} of {2:,} remaining today'.format('Daily API requests', self.api_requests[0], self.api_requests[1] or 0))
+         if self.api_calls() > self.api_requests[0]:
+            lines.append('{0:<24}the run needs more API calls than are left today'.format('WARNING'))
+      lines.append('{0:<24}{1:.3f} s per request (measured)'.format('Latency', self.latency()))
+      if self.transfer_latency is not None:
+         lines.append('{0:<24}{1:.3f} s per request (previous run)'.format('Transfer latency', self.transfer_latency))
+      lines.append('{0:<24}{1}/s per request ({2})'.format('Bandwidth', format_bytes(self.bandwidth or ASSUMED_BANDWIDTH),
+                                                          'measured by a previous run' if self.bandwidth else 'assumed, pass --plan-metrics to measure it'))
+      if self.metadata_seconds:
+         lines.append('{0:<24}{1} (measured)'.format('Metadata queries', format_duration(self.metadata_seconds)))
+      lines += ['', '{0:>12}  {1}'.format('Concurrency', 'Estimated runtime')]
+      for concurrency in self.concurrencies():
+         lines.append('{0:>12}  {1}{2}'.format(concurrency, format_duration(self.runtime(concurrency)),
+                                              '  (configured)' if concurrency == self.concurrency else ''))
+      stream.write('\n'.join(lines) + '\n')
+
+   def write(self, path):
+      with open(path, 'w') as output_file:
+         json.dump(self.as_dict(), output_file, indent=2)
+
+def plan_export(plan, sf, query_prefix, ids, size_field, batch_size, max_query_length=DEFAULT_MAX_QUERY_LENGTH, metrics=None):
+   '''
+   Run the metadata queries of an export in the batches of the real run, without writing
+   or downloading anything: every record is a file of size_field bytes and a download.
+   '''
+   started = time.monotonic()
+   for batch in plan_id_batches(query_prefix, ids, max_query_length=max_query_length, max_ids=batch_size):
+      with phase(metrics, 'metadata_query', 'query'):
+         records = query_all_pages(sf, build_id_query(query_prefix, batch))
+      for record in records:
+         size = int(record.get(size_field) or 0)
+         plan.add_file(size)
+         plan.add_transfer('download', size)
+   # the real run prefetches metadata while it downloads, so it can't finish sooner
+   plan.add_metadata_time(time.monotonic() - started)
+
+def plan_upload(plan, rows, store, request_type, batch_threshold=0, skip=None):
+   '''
+   Size the upload of rows from the files in store without sending anything: a request
+   per file, or per group of files smaller than batch_threshold bytes for a collection
+   request. Rows for which skip(row) is true are skipped like in the real run.
+   '''
+   def file_size(row):
+      return store.size(row['Id'])
+
+   def uploaded_rows():
+      for row in rows:
+         if skip and skip(row):
+            plan.add_skipped()
+         else:
+            yield row
+
+   items = uploaded_rows()
+   if batch_threshold > 0:
+      items = group_small_files(items, file_size, batch_threshold)
+   for item in items:
+      group = item if isinstance(item, list) else [item]
+      files = 0
+      group_size = 0
+      for row in group:
+         try:
+            size = file_size(row)
+         except OSError:
+            # the real run fails the row without a request
+            plan.add_missing()
+            continue
+         plan.add_file(size)
+         files += 1
+         group_size += size
+      if files:
+         plan.add_transfer('collection' if isinstance(item, list) else request_type, group_size)
+
+def finish_plan(plan, metrics_file=None, transfer_phase='download', plan_file=None):
+   '''
+   Print the report of plan, with the bandwidth of the previous run in metrics_file.
+   '''
+   if metrics_file:
+      plan.calibrate(metrics_file, transfer_phase)
+   plan.report()
+   if plan_file:
+      plan.write(plan_file)
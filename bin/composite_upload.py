@@ -0,0 +1,72 @@
+# limits of the sObject Collections resource
+COLLECTION_MAX_RECORDS = 200
+# keep well below the REST API request size limit, base64 adds a third to every file
+COLLECTION_MAX_PAYLOAD = 30 * 1024 * 1024
+DEFAULT_BATCH_THRESHOLD = 0
+
+def insert_collection(sf, sobject, records, all_or_none=False):
+   '''
+   Insert up to 200 records with one sObject Collections request.
+   Returns one result per record, in the order of the records, e.g.
+   {'id': '00P...', 'success': True, 'errors': []}
+   '''
+   request_body = {'allOrNone': all_or_none,
+                   'records': [dict(record, attributes={'type': sobject}) for record in records]}
+   return sf.restful('composite/sobjects', method='POST', json=request_body)
+
+def collection_error(result):
+   if result.get('success'):
+      return ''
+   return '; '.join('{0}: {1}'.format(error.get('statusCode'), error.get('message')) for error in result.get('errors', []))
+
+def collection_error_code(result):
+   # status code of the first error of a failed record
+   errors = [] if result.get('success') else result.get('errors', [])
+   return errors[0].get('statusCode', '') if errors else ''
+
+def encoded_size(file_size):
+   # size of the base64 encoded file plus some room for the other fields of the record
+   return (file_size + 2) // 3 * 4 + 1024
+
+def group_small_files(rows, file_size_of, threshold, max_records=COLLECTION_MAX_RECORDS, max_payload=COLLECTION_MAX_PAYLOAD):
+   '''
+   Group consecutive rows whose file is smaller than threshold bytes into lists which fit
+   into one collection request. Other rows are yielded on their own.
+   Rows keep their order, so a large file closes the group collected before it.
+   '''
+   group = []
+   group_payload = 0
+   for row in rows:
+      try:
+         file_size = file_size_of(row)
+      except OSError:
+         file_size = None
+
+      if file_size is None or file_size >= threshold:
+         if group:
+            yield group
+            group, group_payload = [], 0
+         yield row
+         continue
+
+      row_payload = encoded_size(file_size)
+      if group and (len(group) >= max_records or group_payload + row_payload > max_payload):
+         yield group
+         group, group_payload = [], 0
+      group.append(row)
+      group_payload += row_payload
+   if group:
+      yield group
+
+def group_rows(rows, max_records=COLLECTION_MAX_RECORDS):
+   '''
+   Group consecutive rows of records without a file into lists for one collection request each.
+   '''
+   group = []
+   for row in rows:
+      group.append(row)
+      if len(group) >= max_records:
+         yield group
+         group = []
+   if group:
+      yield group
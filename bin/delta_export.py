@@ -0,0 +1,110 @@
+import configparser
+import csv
+import datetime
+import email.utils
+import logging
+import os
+
+DEFAULT_WATERMARK_FIELD = 'SystemModstamp'
+DELTA_FILE_SUFFIX = '.delta'
+# seconds the next delta reaches back before the start of the export, for records
+# saved by transactions which were still running when the Id query started
+DEFAULT_WATERMARK_OVERLAP = 300
+
+class Watermark(object):
+    '''
+    High-water mark of the last complete export of an sObject, kept in a section per
+    sObject of an ini file in the output folder. A delta export queries only the records
+    modified after the previous mark. The new mark is the server time at the start of the
+    export less an overlap, not the latest value of field seen: a record can be saved with
+    an earlier SystemModstamp after the Id query has passed it.
+    '''
+    def __init__(self, path, sobject, field=DEFAULT_WATERMARK_FIELD, overlap=DEFAULT_WATERMARK_OVERLAP):
+        self.path = path
+        self.sobject = sobject
+        self.field = field
+        self.overlap = overlap
+
+        self.config = configparser.ConfigParser()
+        self.config.optionxform = str
+        self.config.read(path)
+        self.previous = self.config.get(sobject, field, fallback=None) or None
+        self.latest = None
+
+    def condition(self):
+        '''
+        SOQL condition for the records modified since the previous export, None for a
+        first, full export. The mark is cut to seconds, so records of the same second
+        are exported again rather than missed.
+        '''
+        if not self.previous:
+            return None
+        return '{0} > {1}'.format(self.field, soql_datetime(self.previous))
+
+    def start(self, sf):
+        '''
+        Take the mark for the next delta, call it before the Id query of the export.
+        Records modified in the overlap are exported again and replace their rows.
+        '''
+        started = server_time(sf) - datetime.timedelta(seconds=self.overlap)
+        self.latest = format_datetime(started)
+
+    def save(self):
+        if not self.latest:
+            return
+        if not self.config.has_section(self.sobject):
+            self.config.add_section(self.sobject)
+        self.config.set(self.sobject, self.field, self.latest)
+        with open(self.path, 'w') as output_file:
+            self.config.write(output_file)
+
+def parse_datetime(value):
+    # Salesforce returns datetimes like 2023-05-01T12:30:00.000+0000
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f%z')
+
+def format_datetime(value):
+    return value.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.') + '{0:03d}+0000'.format(value.microsecond // 1000)
+
+def server_time(sf):
+    '''
+    Time of the Salesforce server from the Date header of a limits request, so the mark
+    doesn't depend on the clock of this machine.
+    '''
+    try:
+        response = sf.session.get(sf.base_url + 'limits/', headers=sf.headers)
+        if response.headers.get('Date'):
+            return email.utils.parsedate_to_datetime(response.headers['Date'])
+    except Exception as ex:
+        logging.warning("Couldn't read the server time: {0}".format(ex))
+    logging.warning('Using the local time for the watermark')
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def soql_datetime(value):
+    return parse_datetime(value).astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def merge_csv(output_file_name, delta_file_name, key_field='Id'):
+    '''
+    Merge the rows of a delta export into the CSV of the previous export: rows with
+    the key of a delta row are replaced by it, new rows are appended. Only the delta
+    is held in memory, the previous CSV is streamed into a new file.
+    '''
+    if not os.path.isfile(output_file_name):
+        os.replace(delta_file_name, output_file_name)
+        return
+
+    with open(delta_file_name, 'r', newline='') as delta_file:
+        delta_reader = csv.DictReader(delta_file)
+        delta_fields = delta_reader.fieldnames or []
+        delta_rows = dict((row[key_field], row) for row in delta_reader)
+
+    merged_file_name = output_file_name + '.merged'
+    with open(output_file_name, 'r', newline='') as input_file, open(merged_file_name, 'w', newline='') as output_file:
+        reader = csv.DictReader(input_file)
+        fields = list(reader.fieldnames or []) + [field for field in delta_fields if field not in (reader.fieldnames or [])]
+        writer = csv.DictWriter(output_file, fields, quoting=csv.QUOTE_ALL, restval='')
+        writer.writeheader()
+        for row in reader:
+            writer.writerow(delta_rows.pop(row[key_field], row))
+        writer.writerows(delta_rows.values())
+    os.replace(merged_file_name, output_file_name)
+    os.remove(delta_file_name)
@@ -1,7 +1,13 @@
 #!/usr/bin/env python
-import concurrent.futures
-from simple_salesforce import Salesforce
-import requests
+from session_broker import connect, login_count
+from transfer_engine import TransferEngine, read_engine_config
+from file_store import create_store, read_store_config
+from delta_export import Watermark, merge_csv, DEFAULT_WATERMARK_FIELD, DEFAULT_WATERMARK_OVERLAP, DELTA_FILE_SUFFIX
+from query_planner import plan_id_batches, build_id_query, query_all_pages, query_pages, query_parent_chunks, spool_records, read_chunk_config, DEFAULT_MAX_QUERY_LENGTH
+from bulk_query import BulkQuery, read_bulk_config
+from export_manifest import ExportManifest, STATE_COMPLETE
+from run_metrics import RunMetrics, phase, FILE_FAILED
+from capacity_plan import CapacityPlan, plan_export, finish_plan
 import os
 import csv
 import re
@@ -11,42 +17,6 @@ import sys
 SCRIPT_FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
 DEFAULT_EXPORT_ATTACHMENT_CONFIG = SCRIPT_FOLDER_PATH + '/../etc/export_attachment.ini'
 
-def get_attachment_ids(attachments):
-    attachment_ids = set()
-    if attachments:
-       for attachment in attachments:
-          attachment_ids.add(attachment["Id"])
-
-    return attachment_ids
-
-def get_content_document_ids(content_document_links):
-    content_document_ids = set()
-
-    for content_document_link in content_document_links:
-       content_document_ids.add(content_document_link["ContentDocumentId"])
-
-    return content_document_ids
-
-def download_file(args):
-    record, output_folder, sf = args
-    filename = os.path.join(output_folder, record['Id'])
-    url = "https://%s%s" % (sf.sf_instance, record["Body"])
-
-    logging.debug("Downloading from " + url)
-    response = requests.get(url, headers={"Authorization": "OAuth " + sf.session_id,
-                                          "Content-Type": "application/octet-stream"})
-
-    if response.ok:
-        # Save File
-        if not os.path.isdir(output_folder):
-           os.mkdir(output_folder)
-
-        with open(filename, "wb") as output_file:
-            output_file.write(response.content)
-        return "Saved file to %s" % filename
-    else:
-        return "Couldn't download %s" % url
-
 '''
 def fetch_attachments(sf, records, output_folder):
     logging.info("Downloading file {0} out of {1}".format(i, len(batches)))
@@ -62,41 +32,29 @@ def fetch_attachments(sf, records, output_folder):
        logging.debug("No files to download")
 '''
 
-def split_into_batches(items, batch_size):
-    full_list = list(items)
-    for i in range(0, len(full_list), batch_size):
-        yield full_list[i:i + batch_size]
-
-def fetch_attachments(sf, query_string, output_file_name, output_folder, attachment_ids=None, batch_size=100):
-    # Divide the full list of files into batches of 100 ids
-    batches = list(split_into_batches(attachment_ids, batch_size))
-
-    i = 0
-    for batch in batches:
-        i = i + 1
-        logging.info("Processing batch {0}/{1}".format(i, len(batches)))
-        batch_query = query_string + ' WHERE Id  in (' + ",".join("'" + item + "'" for item in batch) + ')'
-        query_response = sf.query(batch_query)
-        records_to_process = get_records_from_response(query_response)
-        if records_to_process:
-           if(i == 1):
-              with open(output_file_name, 'w') as output_file:
-                 print_as_csv(records_to_process, output_file)
-           else:
-              with open(output_file_name, 'a') as output_file:
-                 print_as_csv(records_to_process, output_file, write_header = False)
-
-           records_to_process = len(get_records_from_response(query_response))
-           logging.debug("Content Version Query found {0} results".format(records_to_process))
-
-           while query_response:
-              with concurrent.futures.ProcessPoolExecutor() as executor:
-                 args = ((record, output_folder, sf) for record in query_response["records"])
-                 for result in executor.map(download_file, args):
-                    logging.debug(result)
-              break
-
-        logging.debug('All files in batch {0} downloaded'.format(i))
+def fetch_attachments(sf, engine, query_string, output_file_name, store, attachment_ids=(), batch_size=2000, max_query_length=DEFAULT_MAX_QUERY_LENGTH, metrics=None):
+    # Pack as many ids into every query as the query length allows, at most batch_size.
+    # The ids are streamed from the Id query, batches are formed while the ids arrive
+    batch_query_prefix = query_string + ' WHERE Id  in ('
+    batches = plan_id_batches(batch_query_prefix, attachment_ids, max_query_length=max_query_length, max_ids=batch_size)
+
+    def query_batch(batch):
+        # follow nextRecordsUrl, a batch can return more records than fit on one page
+        with phase(metrics, 'metadata_query', 'query'):
+            records = query_all_pages(sf, build_id_query(batch_query_prefix, batch))
+        return remove_key_from_dict_array(records, 'attributes')
+
+    # CSV rows are written by the consumer in batch order, while the metadata of the
+    # following batches is prefetched and the blobs of earlier ones are still downloading
+    def write_records(i, records_to_process):
+        logging.info("Processing batch {0}".format(i))
+        with phase(metrics, 'write'):
+            print_as_csv(records_to_process, output_file, write_header = output_file.tell() == 0)
+        logging.debug("Query found {0} results".format(len(records_to_process)))
+
+    with open(output_file_name, 'w') as output_file:
+        for result in engine.pipeline(query_batch, batches, "Body", "BodyLength", store, on_records=write_records):
+            logging.debug(result)
     logging.debug('All batches complete')
 
 def print_as_csv(list_of_dicts, csv_file = sys.stdout, write_header = True):
@@ -105,14 +63,6 @@ def print_as_csv(list_of_dicts, csv_file = sys.stdout, write_header = True):
        writer.writeheader()
     writer.writerows(list_of_dicts)
 
-def get_records_from_response(result):
-    if 'totalSize' in result and result['totalSize'] > 0 and 'records' in result:
-        # remove 'attributes' so that we can convert dictionary to CSV
-        records = remove_key_from_dict_array(result['records'], 'attributes')
-        return records
-    else:
-        return None
-
 def remove_key_from_dict_array(dict_array, key):
     for record in dict_array:
         record.pop(key, None)
@@ -138,6 +88,30 @@ def main():
         "-c", "--basic-config-file", dest="basic_config_file",
         help="Optional parameter to override default basic configuration of the script", required=False)
 
+    parser.add_argument(
+        "--restart", dest="restart", action='store_true',
+        help="Ignore the manifest of a previous run and download all files again", required=False)
+
+    parser.add_argument(
+        "--delta", dest="delta", action='store_true',
+        help="Export only the records modified since the last complete export into the output folder and merge them into its CSV and files", required=False)
+
+    parser.add_argument(
+        "--metrics-file", dest="metrics_file",
+        help="Write timing and throughput metrics of the run to this file, in the Prometheus text format for *.prom files, JSON otherwise", required=False)
+
+    parser.add_argument(
+        "--dry-run", dest="dry_run", action='store_true',
+        help="Only run the metadata queries and print a plan with the files, bytes, API calls and estimated runtime of the export", required=False)
+
+    parser.add_argument(
+        "--plan-metrics", dest="plan_metrics",
+        help="JSON metrics file (--metrics-file) of a previous run, the dry run estimates the download bandwidth from it", required=False)
+
+    parser.add_argument(
+        "--plan-file", dest="plan_file",
+        help="Also write the plan of the dry run to this file as JSON", required=False)
+
     args = parser.parse_args()
 
     if not os.path.isdir(args.output_folder):
@@ -164,8 +138,17 @@ def main():
        export_attachment_config.read(DEFAULT_EXPORT_ATTACHMENT_CONFIG)
 
     attachment_output_file = os.path.join(args.output_folder, export_attachment_config['export_attachment']['attachment_output_file'])
+    attachment_manifest_file = os.path.join(args.output_folder, export_attachment_config['export_attachment'].get('attachment_manifest_file', 'attachment_manifest.csv'))
+    attachment_watermark_file = os.path.join(args.output_folder, export_attachment_config['export_attachment'].get('attachment_watermark_file', 'attachment_watermark.ini'))
+    watermark_field = export_attachment_config['export_attachment'].get('watermark_field', DEFAULT_WATERMARK_FIELD)
+    watermark_overlap = int(export_attachment_config['export_attachment'].get('watermark_overlap', DEFAULT_WATERMARK_OVERLAP))
     attachment_query_fields = export_attachment_config['export_attachment']['attachment_query_fields']
     batch_size = int(export_attachment_config['export_attachment']['batch_size'])
+    max_query_length = int(export_attachment_config['export_attachment'].get('max_query_length', DEFAULT_MAX_QUERY_LENGTH))
+    engine_config = read_engine_config(export_attachment_config['export_attachment'])
+    store_config = read_store_config(export_attachment_config['export_attachment'])
+    use_bulk_api, bulk_max_records = read_bulk_config(export_attachment_config['export_attachment'])
+    parent_chunking, parent_chunk_size, parent_chunk_workers = read_chunk_config(export_attachment_config['export_attachment'])
     loglevel = logging.getLevelName(export_attachment_config['export_attachment']['loglevel'])
     logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=loglevel)
 
@@ -173,6 +156,14 @@ def main():
                              'FROM Attachment ' \
                              'WHERE ParentId in ({0})'.format(args.query)
 
+    # a delta export only looks for the attachments modified since the last complete export
+    watermark = Watermark(attachment_watermark_file, 'Attachment', watermark_field, watermark_overlap)
+    delta_condition = watermark.condition() if args.delta else None
+    attachment_ids_query_suffix = ')'
+    if delta_condition:
+       attachment_ids_query = attachment_ids_query + ' AND ' + delta_condition
+       attachment_ids_query_suffix = ') AND ' + delta_condition
+
     attachment_query = "SELECT " + attachment_query_fields + " FROM Attachment"
     attachment_output = export_attachment_config['export_attachment']['attachment_output_dir']
 
@@ -181,35 +172,92 @@ def main():
     logging.info('Username: ' + username)
     logging.info('Signing in at: https://'+ domain + '.salesforce.com')
     logging.info('Output directory: ' + attachment_output)
+    logging.info('Storage layout: ' + store_config['layout'])
+    if delta_condition:
+       logging.info('Delta export of the attachments modified after ' + watermark.previous)
+    elif args.delta:
+       logging.info('No previous export in the output folder, exporting all attachments')
+
+    metrics = RunMetrics(os.path.basename(__file__))
 
     # Connect
-    sf = Salesforce(username=username, password=password, security_token=token, domain=domain)
+    with phase(metrics, 'login'):
+       sf = connect(username, password, token, domain, salesforce_config['salesforce'].get('session_cache'))
     logging.debug("Connected successfully to {0}".format(sf.sf_instance))
 
+    plan = None
+    if args.dry_run:
+       # every download lane works at the same time
+       plan = CapacityPlan(os.path.basename(__file__), engine_config['max_workers'] + engine_config['large_file_workers'])
+       plan.count_requests(sf.session)
+       # a cached session was used without signing in
+       if login_count(sf):
+          plan.add_calls('login', login_count(sf))
+       plan.probe(sf)
+    else:
+       # the next delta starts from the server time before the Id query
+       watermark.start(sf)
+
     # Get Content Document Ids
     logging.debug("Querying to get attachments IDs...")
     
-    attachments = None
-    attachment_ids = None
-    if attachment_query:
-       attachments_response = sf.query_all(attachment_ids_query)
-       
-       if(attachments_response):
-          attachments = get_records_from_response(attachments_response)
-          attachment_ids = get_attachment_ids(attachments)
-          
-       '''
-          with open(attachment_output_file, 'w') as output_file:
-             print_as_csv(attachments, output_file)
-       '''
-
-    if attachments:
-       logging.info("Found {0} total files".format(len(attachments)))
+    # the ids are streamed page by page from the query result straight into the download
+    # batches, so downloads start with the first page and the ids are never all in memory
+    if parent_chunking:
+       # only the parent query runs on its own, the Attachments are queried for chunks of its Ids
+       if use_bulk_api:
+          bulk_query = BulkQuery(sf.base_url, sf.session_id, session=sf.session, max_records=bulk_max_records)
+          with phase(metrics, 'id_query', 'bulk_query'):
+             parents = bulk_query.query(args.query)
+       else:
+          with phase(metrics, 'id_query', 'query'):
+             parent_count, parents = query_pages(sf, args.query)
+          logging.info("Found {0} parent records".format(parent_count))
+       attachments = query_parent_chunks(sf, parents, 'SELECT Id FROM Attachment WHERE ParentId in (', attachment_ids_query_suffix,
+                                         chunk_size=parent_chunk_size, workers=parent_chunk_workers, max_query_length=max_query_length, metrics=metrics)
+       logging.info("Files are found while the Attachments of {0} parents at a time are queried on {1} threads".format(parent_chunk_size, parent_chunk_workers))
+    elif use_bulk_api:
+       bulk_query = BulkQuery(sf.base_url, sf.session_id, session=sf.session, max_records=bulk_max_records)
+       with phase(metrics, 'id_query', 'bulk_query'):
+          attachments = bulk_query.query(attachment_ids_query)
+       logging.info("Files are found while the Bulk API results are read")
     else:
-       logging.info("Found {0} total files".format(0))
+       with phase(metrics, 'id_query', 'query'):
+          total_size, attachments = query_pages(sf, attachment_ids_query)
+       logging.info("Found {0} total files".format(total_size))
+       if total_size:
+          metrics.set_total(total_size)
+    # the query is read to its end on its own thread, its cursor doesn't wait for downloads
+    attachments = spool_records(attachments)
+    # Attachment Ids are unique, they don't need to be deduplicated
+    attachment_ids = (attachment['Id'] for attachment in attachments)
+
+    if plan:
+       plan_export(plan, sf, attachment_query + ' WHERE Id  in (', attachment_ids, 'BodyLength', batch_size, max_query_length, metrics)
+       finish_plan(plan, args.plan_metrics, 'download', args.plan_file)
+       return
 
     # Begin Downloads
-    fetch_attachments(sf=sf, query_string = attachment_query, attachment_ids = attachment_ids, output_file_name = attachment_output_file, output_folder = os.path.join(args.output_folder, attachment_output), batch_size = batch_size)
+    if args.restart and os.path.isfile(attachment_manifest_file):
+       os.remove(attachment_manifest_file)
+
+    with ExportManifest(attachment_manifest_file) as manifest:
+       logging.info("Manifest lists {0} files already downloaded".format(manifest.count(STATE_COMPLETE)))
+       # modified attachments keep their Id, so the files of a delta are downloaded again
+       with metrics, create_store(os.path.join(args.output_folder, attachment_output), **store_config) as store, \
+             TransferEngine(sf, manifest=manifest, metrics=metrics, resume=not delta_condition, **engine_config) as engine:
+          fetch_attachments(sf=sf, engine=engine, query_string = attachment_query, attachment_ids = attachment_ids, output_file_name = attachment_output_file + DELTA_FILE_SUFFIX if delta_condition else attachment_output_file, store = store, batch_size = batch_size, max_query_length = max_query_length, metrics = metrics)
+       if delta_condition:
+          merge_csv(attachment_output_file, attachment_output_file + DELTA_FILE_SUFFIX, 'Id')
+       failed = metrics.files[FILE_FAILED]
+       logging.info("{0} files failed to download - rerun the export to retry them".format(failed))
+       # the next delta starts from here only once every file of this run is complete,
+       # the manifest also lists failures of earlier runs which this run didn't query
+       if failed == 0:
+          watermark.save()
+
+    if args.metrics_file:
+       metrics.write(args.metrics_file)
    
 if __name__ == "__main__":
     main()
@@ -1,7 +1,13 @@
 #!/usr/bin/env python
-import concurrent.futures
-from simple_salesforce import Salesforce
-import requests
+from session_broker import connect, login_count
+from transfer_engine import TransferEngine, read_engine_config
+from file_store import create_store, read_store_config
+from delta_export import Watermark, merge_csv, DEFAULT_WATERMARK_FIELD, DEFAULT_WATERMARK_OVERLAP, DELTA_FILE_SUFFIX
+from query_planner import plan_id_batches, build_id_query, query_all_pages, query_pages, query_parent_chunks, spool_records, read_chunk_config, DEFAULT_MAX_QUERY_LENGTH
+from bulk_query import BulkQuery, read_bulk_config, unique_values
+from export_manifest import ExportManifest, STATE_COMPLETE
+from run_metrics import RunMetrics, phase, FILE_FAILED
+from capacity_plan import CapacityPlan, plan_export, finish_plan
 import os
 import csv
 import re
@@ -11,69 +17,29 @@ import sys
 SCRIPT_FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
 DEFAULT_EXPORT_CONTENT_VERSION_CONFIG = SCRIPT_FOLDER_PATH + '/../etc/export_content_version.ini'
 
-def split_into_batches(items, batch_size):
-    full_list = list(items)
-    for i in range(0, len(full_list), batch_size):
-        yield full_list[i:i + batch_size]
-
-def get_content_document_ids(content_document_links):
-    content_document_ids = set()
-
-    for content_document_link in content_document_links:
-       content_document_ids.add(content_document_link["ContentDocumentId"])
-
-    return content_document_ids
-
-def download_file(args):
-    record, output_directory, sf = args
-    filename = os.path.join(output_directory, record['Id'])
-    url = "https://%s%s" % (sf.sf_instance, record["VersionData"])
-
-    logging.debug("Downloading from " + url)
-    response = requests.get(url, headers={"Authorization": "OAuth " + sf.session_id,
-                                          "Content-Type": "application/octet-stream"})
-
-    if response.ok:
-        # Save File
-        if not os.path.isdir(output_directory):
-           os.mkdir(output_directory)
-
-        with open(filename, "wb") as output_file:
-            output_file.write(response.content)
-        return "Saved file to %s" % filename
-    else:
-        return "Couldn't download %s" % url
-
-def fetch_content_versions(sf, query_string, output_file_name, output_directory, valid_content_document_ids=None, batch_size=100):
-    # Divide the full list of files into batches of 100 ids
-    batches = list(split_into_batches(valid_content_document_ids, batch_size))
-
-    i = 0
-    for batch in batches:
-        i = i + 1
-        logging.info("Processing batch {0}/{1}".format(i, len(batches)))
-        batch_query = query_string + ' AND ContentDocumentId in (' + ",".join("'" + item + "'" for item in batch) + ')'
-        query_response = sf.query(batch_query)
-        records_to_process = get_records_from_response(query_response)
-        if records_to_process:
-           if(i == 1):
-              with open(output_file_name, 'w') as output_file:
-                 print_as_csv(records_to_process, output_file)
-           else:
-              with open(output_file_name, 'a') as output_file:
-                 print_as_csv(records_to_process, output_file, write_header = False)
-
-           records_to_process = len(get_records_from_response(query_response))
-           logging.debug("Content Version Query found {0} results".format(records_to_process))
-
-           while query_response:
-              with concurrent.futures.ProcessPoolExecutor() as executor:
-                 args = ((record, output_directory, sf) for record in query_response["records"])
-                 for result in executor.map(download_file, args):
-                    logging.debug(result)
-              break
-
-        logging.debug('All files in batch {0} downloaded'.format(i))
+def fetch_content_versions(sf, engine, query_string, output_file_name, store, valid_content_document_ids=(), batch_size=2000, max_query_length=DEFAULT_MAX_QUERY_LENGTH, metrics=None):
+    # Pack as many ids into every query as the query length allows, at most batch_size.
+    # The ids are streamed from the ContentDocumentLink query, batches are formed while the ids arrive
+    batch_query_prefix = query_string + ' AND ContentDocumentId in ('
+    batches = plan_id_batches(batch_query_prefix, valid_content_document_ids, max_query_length=max_query_length, max_ids=batch_size)
+
+    def query_batch(batch):
+        # follow nextRecordsUrl, a batch can return more records than fit on one page
+        with phase(metrics, 'metadata_query', 'query'):
+            records = query_all_pages(sf, build_id_query(batch_query_prefix, batch))
+        return remove_key_from_dict_array(records, 'attributes')
+
+    # CSV rows are written by the consumer in batch order, while the metadata of the
+    # following batches is prefetched and the blobs of earlier ones are still downloading
+    def write_records(i, records_to_process):
+        logging.info("Processing batch {0}".format(i))
+        with phase(metrics, 'write'):
+            print_as_csv(records_to_process, output_file, write_header = output_file.tell() == 0)
+        logging.debug("Query found {0} results".format(len(records_to_process)))
+
+    with open(output_file_name, 'w') as output_file:
+        for result in engine.pipeline(query_batch, batches, "VersionData", "ContentSize", store, on_records=write_records, checksum_field="Checksum"):
+            logging.debug(result)
     logging.debug('All batches complete')
 
 
@@ -83,14 +49,6 @@ def print_as_csv(list_of_dicts, csv_file = sys.stdout, write_header = True):
        writer.writeheader()
     writer.writerows(list_of_dicts)
 
-def get_records_from_response(result):
-    if 'totalSize' in result and result['totalSize'] > 0 and 'records' in result:
-        # remove 'attributes' so that we can convert dictionary to CSV
-        records = remove_key_from_dict_array(result['records'], 'attributes')
-        return records
-    else:
-        return None
-
 def remove_key_from_dict_array(dict_array, key):
     for record in dict_array:
         record.pop(key, None)
@@ -119,10 +77,34 @@ def main():
         "-c", "--basic-config-file", dest="basic_config_file",
         help="Optional parameter to override default basic configuration of the script", required=False)
 
+    parser.add_argument(
+        "--restart", dest="restart", action='store_true',
+        help="Ignore the manifest of a previous run and download all files again", required=False)
+
+    parser.add_argument(
+        "--delta", dest="delta", action='store_true',
+        help="Export only the records modified since the last complete export into the output folder and merge them into its CSV and files", required=False)
+
+    parser.add_argument(
+        "--metrics-file", dest="metrics_file",
+        help="Write timing and throughput metrics of the run to this file, in the Prometheus text format for *.prom files, JSON otherwise", required=False)
+
     parser.add_argument(
         "--include-notes", dest="include_notes", default=True,
         help="By default notes are included in the export - set this flag to False if you want to exclude them", required=False)
 
+    parser.add_argument(
+        "--dry-run", dest="dry_run", action='store_true',
+        help="Only run the metadata queries and print a plan with the files, bytes, API calls and estimated runtime of the export", required=False)
+
+    parser.add_argument(
+        "--plan-metrics", dest="plan_metrics",
+        help="JSON metrics file (--metrics-file) of a previous run, the dry run estimates the download bandwidth from it", required=False)
+
+    parser.add_argument(
+        "--plan-file", dest="plan_file",
+        help="Also write the plan of the dry run to this file as JSON", required=False)
+
     args = parser.parse_args()
 
     if not os.path.isdir(args.output_folder):
@@ -153,48 +135,137 @@ def main():
     content_document_link_output_file = os.path.join(args.output_folder, export_content_version_config['export_content_version']['content_document_link_output_file'])
     content_document_link_query_fields = export_content_version_config['export_content_version']['content_document_link_query_fields']
     content_version_output_file = os.path.join(args.output_folder, export_content_version_config['export_content_version']['content_version_output_file'])
+    content_version_manifest_file = os.path.join(args.output_folder, export_content_version_config['export_content_version'].get('content_version_manifest_file', 'content_version_manifest.csv'))
+    content_version_watermark_file = os.path.join(args.output_folder, export_content_version_config['export_content_version'].get('content_version_watermark_file', 'content_version_watermark.ini'))
+    watermark_field = export_content_version_config['export_content_version'].get('watermark_field', DEFAULT_WATERMARK_FIELD)
+    watermark_overlap = int(export_content_version_config['export_content_version'].get('watermark_overlap', DEFAULT_WATERMARK_OVERLAP))
     content_version_query_fields = export_content_version_config['export_content_version']['content_version_query_fields']
 
     batch_size = int(export_content_version_config['export_content_version']['batch_size'])
+    max_query_length = int(export_content_version_config['export_content_version'].get('max_query_length', DEFAULT_MAX_QUERY_LENGTH))
+    engine_config = read_engine_config(export_content_version_config['export_content_version'])
+    store_config = read_store_config(export_content_version_config['export_content_version'])
+    use_bulk_api, bulk_max_records = read_bulk_config(export_content_version_config['export_content_version'])
+    parent_chunking, parent_chunk_size, parent_chunk_workers = read_chunk_config(export_content_version_config['export_content_version'])
     loglevel = logging.getLevelName(export_content_version_config['export_content_version']['loglevel'])
     logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=loglevel)
 
-    content_document_link_query = 'SELECT ' + content_document_link_query_fields + ' ' \
+    content_document_link_query_prefix = 'SELECT ' + content_document_link_query_fields + ' ' \
                              'FROM ContentDocumentLink ' \
-                             'WHERE LinkedEntityId in ({0})'.format(args.query)
+                             'WHERE LinkedEntityId in ('
+    content_document_link_query = content_document_link_query_prefix + args.query + ')'
     content_version_output = export_content_version_config['export_content_version']['content_version_output_dir']
     content_version_query = "SELECT " + content_version_query_fields + " FROM ContentVersion " \
             "WHERE IsLatest = True"
     if not args.include_notes:
        content_version_query = content_version_query + " AND FileExtension != 'snote'"
+    # a delta export still reads all ContentDocumentLinks, but only the versions modified
+    # since the last complete export
+    watermark = Watermark(content_version_watermark_file, 'ContentVersion', watermark_field, watermark_overlap)
+    delta_condition = watermark.condition() if args.delta else None
+    if delta_condition:
+       content_version_query = content_version_query + ' AND ' + delta_condition
 
     # Output
     logging.info('Export ContentVersion (Files) from Salesforce')
     logging.info('Username: ' + username)
     logging.info('Signing in at: https://'+ domain + '.salesforce.com')
     logging.info('Output directory: ' + content_version_output)
+    logging.info('Storage layout: ' + store_config['layout'])
+    if delta_condition:
+       logging.info('Delta export of the content versions modified after ' + watermark.previous)
+    elif args.delta:
+       logging.info('No previous export in the output folder, exporting all content versions')
+
+    metrics = RunMetrics(os.path.basename(__file__))
 
     # Connect
-    sf = Salesforce(username=username, password=password, security_token=token, domain=domain)
+    with phase(metrics, 'login'):
+       sf = connect(username, password, token, domain, salesforce_config['salesforce'].get('session_cache'))
     logging.debug("Connected successfully to {0}".format(sf.sf_instance))
 
+    plan = None
+    if args.dry_run:
+       # every download lane works at the same time
+       plan = CapacityPlan(os.path.basename(__file__), engine_config['max_workers'] + engine_config['large_file_workers'])
+       plan.count_requests(sf.session)
+       # a cached session was used without signing in
+       if login_count(sf):
+          plan.add_calls('login', login_count(sf))
+       plan.probe(sf)
+    else:
+       # the next delta starts from the server time before the Id query
+       watermark.start(sf)
+
     # Get Content Document Ids
     logging.debug("Querying to get Content Document Ids...")
     
-    valid_content_document_ids = None
-    if content_document_link_query:
-       content_document_link_response = sf.query_all(content_document_link_query)
-       if(content_document_link_response):
-          content_document_links = get_records_from_response(content_document_link_response)
-          valid_content_document_ids = get_content_document_ids(content_document_links)
-          
-          with open(content_document_link_output_file, 'w') as output_file:
-                  print_as_csv(content_document_links, output_file)
-
-    logging.info("Found {0} total files".format(len(valid_content_document_ids)))
+    # links are written to the CSV and their ContentDocumentIds fed into the download batches
+    # while the query result is read page by page, so downloads start with the first page
+    # and the links are never all in memory
+    # a dry run writes no CSV
+    content_document_link_output = None if plan else open(content_document_link_output_file, 'w')
+    def write_content_document_link(content_document_link):
+       # remove 'attributes' so that we can convert dictionary to CSV
+       content_document_link.pop('attributes', None)
+       print_as_csv([content_document_link], content_document_link_output, write_header = content_document_link_output.tell() == 0)
+
+    if parent_chunking:
+       # only the parent query runs on its own, the links are queried for chunks of its Ids
+       if use_bulk_api:
+          bulk_query = BulkQuery(sf.base_url, sf.session_id, session=sf.session, max_records=bulk_max_records)
+          with phase(metrics, 'id_query', 'bulk_query'):
+             parents = bulk_query.query(args.query)
+       else:
+          with phase(metrics, 'id_query', 'query'):
+             parent_count, parents = query_pages(sf, args.query)
+          logging.info("Found {0} parent records".format(parent_count))
+       content_document_links = query_parent_chunks(sf, parents, content_document_link_query_prefix,
+                                                    chunk_size=parent_chunk_size, workers=parent_chunk_workers, max_query_length=max_query_length, metrics=metrics)
+       logging.info("Files are found while the ContentDocumentLinks of {0} parents at a time are queried on {1} threads".format(parent_chunk_size, parent_chunk_workers))
+    elif use_bulk_api:
+       bulk_query = BulkQuery(sf.base_url, sf.session_id, session=sf.session, max_records=bulk_max_records)
+       with phase(metrics, 'id_query', 'bulk_query'):
+          content_document_links = bulk_query.query(content_document_link_query)
+       logging.info("Files are found while the Bulk API results are read")
+    else:
+       with phase(metrics, 'id_query', 'query'):
+          total_size, content_document_links = query_pages(sf, content_document_link_query)
+       # a document can be linked to several parents, so this is not the number of files
+       logging.info("Found {0} ContentDocumentLinks, files are found while they are read".format(total_size))
+    # the query is read to its end on its own thread, its cursor doesn't wait for downloads
+    content_document_links = spool_records(content_document_links)
+    # the ContentDocumentIds seen so far are kept on disk
+    valid_content_document_ids = unique_values(content_document_links, 'ContentDocumentId', on_record=write_content_document_link if content_document_link_output else None)
+
+    if plan:
+       plan_export(plan, sf, content_version_query + ' AND ContentDocumentId in (', valid_content_document_ids, 'ContentSize', batch_size, max_query_length, metrics)
+       finish_plan(plan, args.plan_metrics, 'download', args.plan_file)
+       return
 
     # Begin Downloads
-    fetch_content_versions(sf=sf, query_string=content_version_query, valid_content_document_ids=valid_content_document_ids, output_file_name=content_version_output_file , output_directory=os.path.join(args.output_folder, content_version_output), batch_size=batch_size)
+    if args.restart and os.path.isfile(content_version_manifest_file):
+       os.remove(content_version_manifest_file)
+
+    with ExportManifest(content_version_manifest_file) as manifest:
+       logging.info("Manifest lists {0} files already downloaded".format(manifest.count(STATE_COMPLETE)))
+       with metrics, create_store(os.path.join(args.output_folder, content_version_output), **store_config) as store, \
+             TransferEngine(sf, manifest=manifest, metrics=metrics, resume=not delta_condition, **engine_config) as engine:
+          fetch_content_versions(sf=sf, engine=engine, query_string=content_version_query, valid_content_document_ids=valid_content_document_ids, output_file_name=content_version_output_file + DELTA_FILE_SUFFIX if delta_condition else content_version_output_file, store=store, batch_size=batch_size, max_query_length=max_query_length, metrics=metrics)
+       if delta_condition:
+          # a new version of a document replaces the row of its previous latest version
+          merge_csv(content_version_output_file, content_version_output_file + DELTA_FILE_SUFFIX, 'ContentDocumentId')
+       failed = metrics.files[FILE_FAILED]
+       logging.info("{0} files failed to download - rerun the export to retry them".format(failed))
+       # the next delta starts from here only once every file of this run is complete,
+       # the manifest also lists failures of earlier runs which this run didn't query
+       if failed == 0:
+          watermark.save()
+
+    content_document_link_output.close()
+
+    if args.metrics_file:
+       metrics.write(args.metrics_file)
    
 if __name__ == "__main__":
     main()
@@ -0,0 +1,65 @@
+import csv
+import os
+import threading
+
+STATE_COMPLETE = 'complete'
+STATE_FAILED = 'failed'
+MANIFEST_FIELDS = ['Id', 'Size', 'State']
+
+class ExportManifest(object):
+    '''
+    Append-only record of the download state of every exported file.
+    The manifest lives in the output folder, so a rerun of the export can skip
+    the files that are already complete and retry only the missing or failed ones.
+    The last line written for an Id wins.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        if os.path.isfile(path):
+           with open(path, 'r', newline='') as manifest_file:
+              for row in csv.DictReader(manifest_file):
+                 self.entries[row['Id']] = (row['Size'], row['State'])
+
+        write_header = not os.path.isfile(path) or os.path.getsize(path) == 0
+        self.manifest_file = open(path, 'a', newline='')
+        self.writer = csv.DictWriter(self.manifest_file, MANIFEST_FIELDS, quoting=csv.QUOTE_ALL)
+        if write_header:
+           self.writer.writeheader()
+           self.manifest_file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.manifest_file.close()
+
+    def is_complete(self, record_id, expected_size, store):
+        '''
+        A file counts as complete only if the manifest says so and the file in the
+        store still has the size that was recorded and that Salesforce reports.
+        '''
+        entry = self.entries.get(record_id)
+        if entry is None or entry[1] != STATE_COMPLETE:
+           return False
+        if expected_size not in (None, '') and str(expected_size) != entry[0]:
+           return False
+        try:
+           return str(store.size(record_id)) == entry[0]
+        except OSError:
+           return False
+
+    def record(self, record_id, size, state):
+        size = '' if size is None else str(size)
+        with self.lock:
+           self.entries[record_id] = (size, state)
+           self.writer.writerow({'Id': record_id, 'Size': size, 'State': state})
+           self.manifest_file.flush()
+
+    def count(self, state):
+        return sum(1 for entry in self.entries.values() if entry[1] == state)
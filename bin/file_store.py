@@ -0,0 +1,413 @@
+import configparser
+import csv
+import hashlib
+import io
+import mmap
+import os
+import threading
+
+LAYOUT_FLAT = 'flat'
+LAYOUT_SHARDED = 'sharded'
+LAYOUT_PACK = 'pack'
+LAYOUTS = (LAYOUT_FLAT, LAYOUT_SHARDED, LAYOUT_PACK)
+
+# written into every output folder, so the upload scripts know how to read it
+STORE_CONFIG_FILE = 'store.ini'
+PARTIAL_FILE_SUFFIX = '.part'
+DEFAULT_SHARD_DEPTH = 2
+DEFAULT_PACK_MAX_SIZE = 1024 * 1024 * 1024
+PACK_INDEX_FILE = 'pack_index.csv'
+PACK_INDEX_FIELDS = ['Id', 'Pack', 'Offset', 'Length', 'MD5']
+# MD5 of the files of the flat and sharded layouts, the pack index has its own column
+CHECKSUM_INDEX_FILE = 'checksums.csv'
+CHECKSUM_INDEX_FIELDS = ['Id', 'MD5']
+
+class ChecksumError(ValueError):
+    pass
+
+class IndexFile(object):
+    '''
+    Append-only CSV index of a store. The last line written for an Id wins.
+    '''
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = fields
+        self.lock = threading.Lock()
+        self.output_file = None
+        self.writer = None
+
+    def read(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'r', newline='') as index_file:
+            for row in csv.DictReader(index_file):
+                yield row
+
+    def append(self, row):
+        with self.lock:
+            if self.writer is None:
+                write_header = not os.path.isfile(self.path) or os.path.getsize(self.path) == 0
+                self.output_file = open(self.path, 'a', newline='')
+                self.writer = csv.DictWriter(self.output_file, self.fields, quoting=csv.QUOTE_ALL)
+                if write_header:
+                    self.writer.writeheader()
+            self.writer.writerow(row)
+            self.output_file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.output_file:
+                self.output_file.close()
+                self.output_file = None
+                self.writer = None
+
+class FlatStore(object):
+    '''
+    One file per record, named by Id, directly in the folder.
+    '''
+    layout = LAYOUT_FLAT
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.checksums = IndexFile(os.path.join(folder, CHECKSUM_INDEX_FILE), CHECKSUM_INDEX_FIELDS)
+        self.checksum_index = dict((row['Id'], row['MD5']) for row in self.checksums.read())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.checksums.close()
+
+    def checksum(self, record_id):
+        '''
+        MD5 recorded when the file was downloaded, None for files without one.
+        '''
+        return self.checksum_index.get(record_id) or None
+
+    def add_checksum(self, record_id, checksum):
+        self.checksum_index[record_id] = checksum
+        self.checksums.append({'Id': record_id, 'MD5': checksum})
+
+    def path(self, record_id):
+        return os.path.join(self.folder, record_id)
+
+    def location(self, record_id):
+        return self.path(record_id)
+
+    def size(self, record_id):
+        return os.path.getsize(self.path(record_id))
+
+    def open(self, record_id):
+        return open(self.path(record_id), 'rb')
+
+    def read(self, record_id):
+        with self.open(record_id) as binary_file:
+            return binary_file.read()
+
+    def writer(self, record_id):
+        # written to a temporary file first and renamed only once complete, so an
+        # interrupted transfer never leaves a complete-looking file
+        return PartialFileWriter(self, record_id, self.path(record_id))
+
+class ShardedStore(FlatStore):
+    '''
+    One file per record in a fan-out tree of shard_depth levels of directories named
+    by the leading bytes of the MD5 of the Id, e.g. 3f/a2/00P..., so no directory
+    holds more than a few thousand entries even for millions of files.
+    '''
+    layout = LAYOUT_SHARDED
+
+    def __init__(self, folder, shard_depth=DEFAULT_SHARD_DEPTH):
+        FlatStore.__init__(self, folder)
+        self.shard_depth = shard_depth
+
+    def path(self, record_id):
+        digest = hashlib.md5(record_id.encode('utf-8')).hexdigest()
+        shards = [digest[2 * level:2 * level + 2] for level in range(self.shard_depth)]
+        return os.path.join(self.folder, *(shards + [record_id]))
+
+class PackStore(object):
+    '''
+    Append-only pack files plus an index (Id, Pack, Offset, Length, MD5).
+    Every writing thread appends to its own pack, so downloads stream straight into
+    the pack without locking; only index lines are written under a lock. A pack is
+    closed once it reaches max_pack_size. The last index line written for an Id wins.
+    Readers memory map the packs and read the blobs as slices of the map.
+    '''
+    layout = LAYOUT_PACK
+
+    def __init__(self, folder, max_pack_size=DEFAULT_PACK_MAX_SIZE):
+        self.folder = folder
+        self.max_pack_size = max_pack_size
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.open_packs = []
+        self.maps = {}
+
+        self.index_file = IndexFile(os.path.join(folder, PACK_INDEX_FILE), PACK_INDEX_FIELDS)
+        self.index = dict((row['Id'], (row['Pack'], int(row['Offset']), int(row['Length']), row['MD5'])) for row in self.index_file.read())
+        self.pack_count = len([name for name in os.listdir(folder) if name.endswith('.pack')]) if os.path.isdir(folder) else 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            for pack_file in self.open_packs:
+                pack_file.close()
+            self.open_packs = []
+            for pack_map in self.maps.values():
+                pack_map.close()
+            self.maps = {}
+        self.index_file.close()
+
+    def location(self, record_id):
+        pack, offset, length, md5 = self.entry(record_id)
+        return '{0}@{1}'.format(os.path.join(self.folder, pack), offset)
+
+    def entry(self, record_id):
+        entry = self.index.get(record_id)
+        if entry is None:
+            raise FileNotFoundError("No entry for {0} in {1}".format(record_id, os.path.join(self.folder, PACK_INDEX_FILE)))
+        return entry
+
+    def size(self, record_id):
+        return self.entry(record_id)[2]
+
+    def checksum(self, record_id):
+        entry = self.index.get(record_id)
+        if entry is None:
+            return None
+        return entry[3] or None
+
+    def open(self, record_id):
+        pack, offset, length, md5 = self.entry(record_id)
+        return PackSlice(self.map(pack) if length else b'', offset, length)
+
+    def read(self, record_id):
+        pack, offset, length, md5 = self.entry(record_id)
+        if not length:
+            return b''
+        return self.map(pack)[offset:offset + length]
+
+    def map(self, pack):
+        with self.lock:
+            if pack not in self.maps:
+                with open(os.path.join(self.folder, pack), 'rb') as pack_file:
+                    self.maps[pack] = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.maps[pack]
+
+    def pack_file(self):
+        '''
+        The pack of the current thread, a new one once it is full.
+        '''
+        pack_file = getattr(self.local, 'pack_file', None)
+        if pack_file is None or pack_file.tell() >= self.max_pack_size:
+            with self.lock:
+                self.pack_count += 1
+                name = 'pack-{0:05d}.pack'.format(self.pack_count)
+                pack_file = open(os.path.join(self.folder, name), 'ab')
+                self.open_packs.append(pack_file)
+            self.local.pack_file = pack_file
+        return pack_file
+
+    def writer(self, record_id):
+        return PackWriter(self, record_id, self.pack_file())
+
+    def add(self, record_id, pack, offset, length, md5):
+        self.index[record_id] = (pack, offset, length, md5)
+        self.index_file.append({'Id': record_id, 'Pack': pack, 'Offset': offset, 'Length': length, 'MD5': md5})
+
+class PartialFileWriter(object):
+    '''
+    Writable file which becomes filename when the block completes without an exception
+    and is removed otherwise. The checksum set by the writer is added to the store
+    together with the file.
+    '''
+    def __init__(self, store, record_id, filename):
+        self.store = store
+        self.record_id = record_id
+        self.filename = filename
+        self.partial_filename = filename + PARTIAL_FILE_SUFFIX
+        self.output_file = None
+        self.checksum = None
+
+    def __enter__(self):
+        output_folder = os.path.dirname(self.partial_filename)
+        if output_folder and not os.path.isdir(output_folder):
+            os.makedirs(output_folder, exist_ok=True)
+        self.output_file = open(self.partial_filename, 'wb')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.output_file.close()
+        if exc_type is None:
+            os.replace(self.partial_filename, self.filename)
+            if self.checksum:
+                self.store.add_checksum(self.record_id, self.checksum)
+        else:
+            remove_partial_file(self.partial_filename)
+
+    def write(self, data):
+        return self.output_file.write(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.output_file.seek(offset, whence)
+
+    def truncate(self):
+        return self.output_file.truncate()
+
+    def tell(self):
+        return self.output_file.tell()
+
+class PackWriter(object):
+    '''
+    Appends one blob to a pack. seek(0) and truncate() go back to the start of the
+    blob (a retried download starts over), the index entry with the checksum set by
+    the writer is added on success and the pack is cut back to where the blob started
+    otherwise.
+    '''
+    def __init__(self, store, record_id, pack_file):
+        self.store = store
+        self.record_id = record_id
+        self.pack_file = pack_file
+        self.start = pack_file.tell()
+        self.checksum = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        length = self.pack_file.tell() - self.start
+        if exc_type is None:
+            self.pack_file.flush()
+            self.store.add(self.record_id, os.path.basename(self.pack_file.name), self.start, length, self.checksum or '')
+        else:
+            self.truncate()
+
+    def write(self, data):
+        return self.pack_file.write(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # only rewinding to the start of the blob is supported
+        self.pack_file.seek(self.start + offset)
+
+    def truncate(self):
+        self.pack_file.truncate(self.start)
+        self.pack_file.seek(self.start)
+
+    def tell(self):
+        return self.pack_file.tell() - self.start
+
+class PackSlice(io.RawIOBase):
+    '''
+    Read-only file over one blob of a memory mapped pack.
+    '''
+    def __init__(self, pack_map, offset, length):
+        self.pack_map = pack_map
+        self.offset = offset
+        self.length = length
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length - self.position
+        size = max(0, min(size, self.length - self.position))
+        start = self.offset + self.position
+        self.position += size
+        return self.pack_map[start:start + size]
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.position = max(0, min(offset, self.length))
+        return self.position
+
+    def tell(self):
+        return self.position
+
+def verify_checksum(record_id, checksum, expected_checksum):
+    '''
+    Raises ChecksumError unless the MD5 checksum matches expected_checksum.
+    Nothing is verified without an expected checksum.
+    '''
+    if expected_checksum and checksum != expected_checksum.lower():
+        raise ChecksumError("MD5 of {0} is {1}, expected {2}".format(record_id, checksum, expected_checksum))
+
+def remove_partial_file(partial_filename):
+    try:
+        os.remove(partial_filename)
+    except FileNotFoundError:
+        pass
+
+def create_store(folder, layout=LAYOUT_FLAT, shard_depth=DEFAULT_SHARD_DEPTH, max_pack_size=DEFAULT_PACK_MAX_SIZE):
+    '''
+    Store for an export into folder. The layout is recorded in folder/store.ini, an
+    export can't continue in a folder written with a different layout.
+    '''
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    store_config_file = os.path.join(folder, STORE_CONFIG_FILE)
+    if os.path.isfile(store_config_file):
+        existing = read_store_settings(folder)
+        if existing['layout'] != layout or (layout == LAYOUT_SHARDED and existing['shard_depth'] != shard_depth):
+            raise ValueError("{0} was exported with storage layout {1}, not {2}".format(folder, existing['layout'], layout))
+    elif os.listdir(folder) and layout != LAYOUT_FLAT:
+        raise ValueError("{0} already contains files in the flat layout, not {1}".format(folder, layout))
+    else:
+        store_config = configparser.ConfigParser()
+        store_config['store'] = {'layout': layout, 'shard_depth': str(shard_depth)}
+        with open(store_config_file, 'w') as output_file:
+            store_config.write(output_file)
+
+    if layout == LAYOUT_SHARDED:
+        return ShardedStore(folder, shard_depth)
+    if layout == LAYOUT_PACK:
+        return PackStore(folder, max_pack_size)
+    return FlatStore(folder)
+
+def read_store_settings(folder):
+    store_config = configparser.ConfigParser()
+    store_config.read(os.path.join(folder, STORE_CONFIG_FILE))
+    # folders exported before the layouts existed have no store.ini and are flat
+    section = store_config['store'] if store_config.has_section('store') else {}
+    return {'layout': section.get('layout', LAYOUT_FLAT),
+            'shard_depth': int(section.get('shard_depth', DEFAULT_SHARD_DEPTH))}
+
+def open_store(folder):
+    '''
+    Store to read the files of an export folder, whatever its layout.
+    '''
+    settings = read_store_settings(folder)
+    if settings['layout'] == LAYOUT_SHARDED:
+        return ShardedStore(folder, settings['shard_depth'])
+    if settings['layout'] == LAYOUT_PACK:
+        return PackStore(folder)
+    return FlatStore(folder)
+
+def read_store_config(config_section):
+    layout = config_section.get('storage_layout', LAYOUT_FLAT)
+    if layout not in LAYOUTS:
+        raise ValueError("storage_layout must be one of {0}, not {1}".format(', '.join(LAYOUTS), layout))
+    return {'layout': layout,
+            'shard_depth': int(config_section.get('shard_depth', DEFAULT_SHARD_DEPTH)),
+            'max_pack_size': int(config_section.get('pack_max_size', DEFAULT_PACK_MAX_SIZE))}
@@ -0,0 +1,136 @@
+import csv
+import hashlib
+import os
+import sqlite3
+import threading
+
+# the databases are built in a cache folder, the folder of the CSV can be read-only or shared
+DEFAULT_CACHE_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'salesforce-file-export-import', 'mappings')
+MAPPING_DATABASE_SUFFIX = '.sqlite'
+INSERT_BATCH_SIZE = 10000
+ID_SUFFIX_CHARACTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ012345'
+
+def normalize_id(record_id):
+   '''
+   18 character form of a Salesforce Id. The three suffix characters encode the case
+   of the 15 character Id, so both forms of an Id map to the same key.
+   Values which are not Ids are returned unchanged.
+   '''
+   record_id = record_id.strip()
+   if len(record_id) != 15 or not record_id.isalnum():
+      return record_id
+   suffix = ''
+   for i in range(0, 15, 5):
+      flags = 0
+      for j, character in enumerate(record_id[i:i + 5]):
+         if 'A' <= character <= 'Z':
+            flags |= 1 << j
+      suffix += ID_SUFFIX_CHARACTERS[flags]
+   return record_id + suffix
+
+class IdMapping(object):
+   '''
+   Read-only OriginalId -> NewId mapping in an SQLite database with the Ids in their
+   18 character form. Nothing is loaded into memory, every thread looks Ids up with
+   its own connection. Supports the dict operations the upload scripts use
+   (in, [], get) with 15 or 18 character Ids.
+   '''
+   def __init__(self, database_file):
+      self.database_file = database_file
+      self.local = threading.local()
+
+   def connection(self):
+      connection = getattr(self.local, 'connection', None)
+      if connection is None:
+         connection = sqlite3.connect('file:{0}?mode=ro'.format(self.database_file), uri=True)
+         self.local.connection = connection
+      return connection
+
+   def get(self, original_id, default=None):
+      if not original_id:
+         return default
+      row = self.connection().execute('SELECT new_id FROM mapping WHERE original_id = ?', (normalize_id(original_id),)).fetchone()
+      return row[0] if row else default
+
+   def __contains__(self, original_id):
+      return self.get(original_id) is not None
+
+   def __getitem__(self, original_id):
+      new_id = self.get(original_id)
+      if new_id is None:
+         raise KeyError(original_id)
+      return new_id
+
+   def __len__(self):
+      return self.connection().execute('SELECT COUNT(*) FROM mapping').fetchone()[0]
+
+def source_signature(mapping_file, key_field_name, value_field_name):
+   # the database is rebuilt when the CSV or the mapped columns change
+   status = os.stat(mapping_file)
+   return '{0}:{1}:{2}:{3}'.format(status.st_size, status.st_mtime_ns, key_field_name, value_field_name)
+
+def read_signature(database_file):
+   if not os.path.isfile(database_file):
+      return None
+   try:
+      connection = sqlite3.connect('file:{0}?mode=ro'.format(database_file), uri=True)
+      try:
+         row = connection.execute("SELECT value FROM meta WHERE name = 'source'").fetchone()
+      finally:
+         connection.close()
+   except sqlite3.Error:
+      return None
+   return row[0] if row else None
+
+def build_mapping(mapping_file, database_file, key_field_name, value_field_name):
+   '''
+   Stream the mapping CSV into a new database. The last row of an Id wins, like
+   it did for the dict the mapping used to be loaded into.
+   '''
+   # runs which build the same database at the same time each write their own file
+   partial_database_file = '{0}.{1}.part'.format(database_file, os.getpid())
+   if os.path.isfile(partial_database_file):
+      os.remove(partial_database_file)
+   connection = sqlite3.connect(partial_database_file)
+   try:
+      connection.execute('PRAGMA journal_mode = OFF')
+      connection.execute('PRAGMA synchronous = OFF')
+      connection.execute('CREATE TABLE mapping (original_id TEXT PRIMARY KEY, new_id TEXT NOT NULL) WITHOUT ROWID')
+      connection.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)')
+      with open(mapping_file, mode='r', newline='') as mapping_csv_file:
+         rows = []
+         for row in csv.DictReader(mapping_csv_file):
+            if not row[key_field_name] or not row[value_field_name]:
+               continue
+            rows.append((normalize_id(row[key_field_name]), normalize_id(row[value_field_name])))
+            if len(rows) >= INSERT_BATCH_SIZE:
+               connection.executemany('INSERT OR REPLACE INTO mapping VALUES (?, ?)', rows)
+               rows = []
+         connection.executemany('INSERT OR REPLACE INTO mapping VALUES (?, ?)', rows)
+      connection.execute("INSERT INTO meta VALUES ('source', ?)", (source_signature(mapping_file, key_field_name, value_field_name),))
+      connection.commit()
+   finally:
+      connection.close()
+   os.replace(partial_database_file, database_file)
+
+def mapping_database_file(mapping_file, key_field_name, value_field_name, cache_folder=DEFAULT_CACHE_FOLDER):
+   '''
+   Database of a mapping CSV in cache_folder, named after the absolute path of the CSV
+   and the mapped columns. Its content is checked against the signature of the CSV.
+   '''
+   key = '{0}:{1}:{2}'.format(os.path.abspath(mapping_file), key_field_name, value_field_name)
+   name = os.path.basename(mapping_file) + '_' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+   return os.path.join(cache_folder, name + MAPPING_DATABASE_SUFFIX)
+
+def open_mapping(mapping_file, key_field_name='OriginalId', value_field_name='NewId', database_file=None, cache_folder=DEFAULT_CACHE_FOLDER):
+   '''
+   IdMapping of the mapping CSV. The database is built on the first run and reused
+   by later runs as long as the CSV is unchanged.
+   '''
+   database_file = database_file or mapping_database_file(mapping_file, key_field_name, value_field_name, cache_folder)
+   folder = os.path.dirname(database_file)
+   if folder and not os.path.isdir(folder):
+      os.makedirs(folder, exist_ok=True)
+   if read_signature(database_file) != source_signature(mapping_file, key_field_name, value_field_name):
+      build_mapping(mapping_file, database_file, key_field_name, value_field_name)
+   return IdMapping(database_file)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+import base64, os, argparse, configparser, tempfile
+import session_broker
+import logging as log
+from transfer_engine import TransferEngine, read_engine_config, DOWNLOAD_ERRORS
+from upload_engine import UploadEngine, DEFAULT_MAX_IN_FLIGHT
+from adaptive_scheduler import call_api, call_create, DEFAULT_MAX_RETRIES
+from multipart_upload import insert_with_binary
+from query_planner import plan_id_batches, build_id_query, query_all_pages, query_pages, spool_records, DEFAULT_MAX_QUERY_LENGTH
+from bulk_query import unique_values
+from run_metrics import RunMetrics, phase, timed, FILE_COMPLETE, FILE_FAILED, FILE_SKIPPED
+from upload_attachments import create_attachment_request_body
+from id_mapping import open_mapping
+from upload_content_versions import create_content_version_request_body
+
+SCRIPT_FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
+# files up to this size are spooled in memory, larger files spill to a temporary file
+DEFAULT_SPOOL_SIZE = 8 * 1024 * 1024
+# largest file whose base64 encoding fits into a JSON request of the REST API
+MAX_JSON_FILE_SIZE = int(37.5 * 1024 * 1024)
+
+# the queries, fields and binary of each migrated sObject, the export settings are reused
+SOBJECTS = {
+   'Attachment': {'config_file': SCRIPT_FOLDER_PATH + '/../etc/export_attachment.ini', 'section': 'export_attachment',
+                  'query_fields': 'attachment_query_fields',
+                  'ids_query': 'SELECT Id FROM Attachment WHERE ParentId in ({0})', 'id_field': 'Id',
+                  'query': 'SELECT {0} FROM Attachment', 'batch_prefix': ' WHERE Id  in (',
+                  'body_field': 'Body', 'size_field': 'BodyLength', 'name_field': 'Name', 'checksum_field': None},
+   'ContentVersion': {'config_file': SCRIPT_FOLDER_PATH + '/../etc/export_content_version.ini', 'section': 'export_content_version',
+                      'query_fields': 'content_version_query_fields',
+                      'ids_query': 'SELECT ContentDocumentId FROM ContentDocumentLink WHERE LinkedEntityId in ({0})', 'id_field': 'ContentDocumentId',
+                      'query': 'SELECT {0} FROM ContentVersion WHERE IsLatest = True', 'batch_prefix': ' AND ContentDocumentId in (',
+                      'body_field': 'VersionData', 'size_field': 'ContentSize', 'name_field': 'PathOnClient', 'checksum_field': 'Checksum'}}
+
+def connect(salesforce_config_file):
+   salesforce_config = configparser.ConfigParser(allow_no_value=True)
+   salesforce_config.read(salesforce_config_file)
+
+   username = salesforce_config['salesforce']['username']
+   password = salesforce_config['salesforce']['password']
+   token = salesforce_config['salesforce']['security_token']
+   is_sandbox = salesforce_config['salesforce']['connect_to_sandbox']
+   domain = salesforce_config['salesforce'].get('domain')
+
+   if not domain:
+      if is_sandbox == 'True':
+         domain = 'test'
+      else:
+         domain = 'login'
+
+   log.info('Signing in as {0} at: https://{1}.salesforce.com'.format(username, domain))
+   return session_broker.connect(username, password, token, domain, salesforce_config['salesforce'].get('session_cache'))
+
+def as_row(record):
+   # same values as a row of the CSV written by the export scripts
+   return dict((key, '' if value is None else str(value)) for (key, value) in record.items() if key != 'attributes')
+
+def query_source_rows(source, engine, sobject, query, query_fields, batch_size, max_query_length, metrics=None):
+   '''
+   Rows of the source records, queried in batches of ids on the query thread of the engine.
+   '''
+   settings = SOBJECTS[sobject]
+   # the ids are streamed page by page into the batches, the distinct ones are kept on disk
+   with phase(metrics, 'id_query', 'query'):
+      total_size, records = query_pages(source, settings['ids_query'].format(query))
+   # read to its end on its own thread, the cursor doesn't wait for the migrated files
+   ids = unique_values(spool_records(records), settings['id_field'])
+   log.info("The Id query found {0} records".format(total_size))
+   if metrics and total_size and settings['id_field'] == 'Id':
+      metrics.set_total(total_size)
+
+   batch_query_prefix = settings['query'].format(query_fields) + settings['batch_prefix']
+   def query_batch(batch):
+      with phase(metrics, 'metadata_query', 'query'):
+         return query_all_pages(source, build_id_query(batch_query_prefix, batch))
+
+   batches = plan_id_batches(batch_query_prefix, ids, max_query_length=max_query_length, max_ids=batch_size)
+   for records in engine.prefetch(query_batch, batches):
+      for record in records:
+         yield as_row(record)
+
+def find_by_upsert_key(target, sobject, upsert_key, value, scheduler=None, metrics=None):
+   '''
+   Latest records of sobject in the target org with value in upsert_key, with their checksum.
+   '''
+   query = "SELECT Id, Checksum FROM {0} WHERE IsLatest = True AND {1} IN ('{2}')".format(sobject, upsert_key, value)
+   return call_api(scheduler, timed(metrics, 'preflight', 'query', target.query), query)['records']
+
+def migrate_file(engine, target, sobject, row, request_body, upsert_key=None, spool_size=DEFAULT_SPOOL_SIZE, multipart=False, scheduler=None, metrics=None):
+   '''
+   Stream the binary of row from the source org into a spool and send it to the target
+   org with request_body. Only files larger than spool_size touch the disk, and only the
+   files held in memory are sent base64 encoded in JSON, larger ones are streamed from
+   the spool in a multipart request.
+   '''
+   settings = SOBJECTS[sobject]
+   body_field = settings['body_field']
+   error = ''
+   size = None
+   skipped = False
+   with tempfile.SpooledTemporaryFile(max_size=spool_size) as spool:
+      try:
+         expected_checksum = row.get(settings['checksum_field']) if settings['checksum_field'] else None
+         size, checksum = engine.download_into(row[body_field], spool, row[settings['size_field']], expected_checksum)
+      except DOWNLOAD_ERRORS as ex:
+         error = "Couldn't download {0}: {1}".format(row[body_field], ex)
+
+      if not error:
+         try:
+            if multipart or size > min(spool_size, MAX_JSON_FILE_SIZE):
+               # multipart requests can only insert, so the upsert key is sent as a field of the new record
+               request_body.pop(body_field, None)
+               existing = []
+               if upsert_key:
+                  request_body[upsert_key] = row['Id']
+                  # a record inserted by a previous run is not inserted a second time
+                  existing = find_by_upsert_key(target, sobject, upsert_key, row['Id'], scheduler, metrics)
+               if not existing:
+                  call_create(scheduler, timed(metrics, 'upload', 'multipart_create', insert_with_binary), target, sobject, request_body, body_field, spool, row[settings['name_field']] or row['Id'])
+               elif all((record.get('Checksum') or '').lower() == checksum for record in existing):
+                  log.info('Skipping file with Id = \'{0}\', it is already in the target org'.format(row['Id']))
+                  skipped = True
+               else:
+                  error = 'Already in the target org with a different file, a multipart request would insert it a second time'
+            else:
+               with phase(metrics, 'encode'):
+                  spool.seek(0)
+                  request_body[body_field] = base64.b64encode(spool.read()).decode('utf-8')
+               if upsert_key:
+                  call_api(scheduler, timed(metrics, 'upload', 'upsert', getattr(target, sobject).upsert), upsert_key + '/' + row['Id'], request_body)
+               else:
+                  call_create(scheduler, timed(metrics, 'upload', 'create', getattr(target, sobject).create), request_body)
+         except Exception as ex:
+            error = ex.content[0]['message'] if hasattr(ex, 'content') else ex
+
+   if metrics:
+      metrics.add_file(size, FILE_SKIPPED if skipped else FILE_FAILED if error else FILE_COMPLETE)
+   request_body['error'] = error
+   # replace base64 string by the source of the binary
+   request_body[body_field] = row[body_field]
+   return request_body
+
+def migrate_attachment(engine, target, attachment, user_mapping, parent_mapping, spool_size=DEFAULT_SPOOL_SIZE, multipart=False, scheduler=None, metrics=None):
+   log.info('Migrating file {body} with Id = \'{id}\''.format(body = attachment['Body'], id = attachment['Id']))
+   # mapped before the download, attachments of unmapped parents are skipped
+   attachment_request_body = create_attachment_request_body(attachment, None, user_mapping, parent_mapping)
+   if not attachment_request_body:
+      if metrics:
+         metrics.add_file(state=FILE_SKIPPED)
+      return None
+   return migrate_file(engine, target, 'Attachment', attachment, attachment_request_body, None, spool_size, multipart, scheduler, metrics)
+
+def migrate_content_version(engine, target, content_version, upsert_key, spool_size=DEFAULT_SPOOL_SIZE, multipart=False, scheduler=None, metrics=None):
+   log.info('Migrating file {path_on_client} with Id = \'{id}\''.format(path_on_client = content_version['PathOnClient'], id = content_version['Id']))
+   content_version_request_body = create_content_version_request_body(content_version, None)
+   return migrate_file(engine, target, 'ContentVersion', content_version, content_version_request_body, upsert_key, spool_size, multipart, scheduler, metrics)
+
+def main():
+   parser = argparse.ArgumentParser(description='Script which migrates Attachments or ContentVersions (Files) related to parent records directly from one org to another,\n' +
+                                                'without writing the files to an export folder first:\n' +
+                                                'Example:\n' +
+                                                '\t' + os.path.basename(__file__) + ' -o Attachment -q "SELECT Id FROM Account" -s source.ini -d target.ini -u user_mapping.csv -p parent_mapping.csv\n' +
+                                                '\t' + os.path.basename(__file__) + ' -o ContentVersion -q "SELECT Id FROM Account" -s source.ini -d target.ini -k Source_Original_Id__c',
+						formatter_class=argparse.RawTextHelpFormatter)
+
+   parser.add_argument(
+        "-o", "--sobject", dest="sobject", choices=sorted(SOBJECTS), required=True,
+        help="Files to migrate")
+
+   parser.add_argument('-q', '--query', metavar='query', required=True,
+                        help='SOQL on the source org to limit the files. Must return the Ids of parent objects.')
+
+   parser.add_argument(
+        "-s", "--source-config-file", dest="source_config_file",
+        help="Salesforce config file with login info of the source org", required=True)
+
+   parser.add_argument(
+        "-d", "--target-config-file", dest="target_config_file",
+        help="Salesforce config file with login info of the target org", required=True)
+
+   parser.add_argument(
+        "-c", "--basic-config-file", dest="basic_config_file",
+        help="Optional parameter to override the default export configuration of the sObject (query fields, batches, downloads)")
+
+   parser.add_argument(
+        "-u", "--user-mapping", dest="user_mapping",
+        help="User ID mapping in CSV format (Attachment)")
+
+   parser.add_argument(
+        "-p", "--parent-mapping", dest="parent_mapping",
+        help="Parent ID mapping in CSV format (Attachment)")
+
+   parser.add_argument(
+        "-k", "--upsert-key", dest="upsert_key",
+        help="Upsert key (ContentVersion)")
+
+   parser.add_argument(
+        "-v", "--verbose", dest="verbose", action='store_true',
+        help="Verbose")
+
+   parser.add_argument(
+        "-t", "--max-in-flight", dest="max_in_flight", type=int, default=DEFAULT_MAX_IN_FLIGHT,
+        help="Maximum number of files migrated at the same time (default: %(default)s)")
+
+   parser.add_argument(
+        "-r", "--max-retries", dest="max_retries", type=int, default=DEFAULT_MAX_RETRIES,
+        help="Retries of a request throttled by Salesforce (REQUEST_LIMIT_EXCEEDED, 503, ...) (default: %(default)s)")
+
+   parser.add_argument(
+        "-m", "--multipart", dest="multipart", action='store_true',
+        help="Stream the binary of every file in a multipart request instead of sending the files held in memory\n" +
+             "base64 encoded in JSON. Multipart requests insert new ContentVersions, the upsert key is stored on the\n" +
+             "inserted record unless a ContentVersion with the key is already in the target org")
+
+   parser.add_argument(
+        "--spool-size", dest="spool_size", type=int, default=DEFAULT_SPOOL_SIZE,
+        help="Files up to this number of bytes are held in memory between download and upload, larger files are spooled to a temporary file (default: %(default)s)")
+
+   parser.add_argument(
+        "--metrics-file", dest="metrics_file",
+        help="Write timing and throughput metrics of the run to this file, in the Prometheus text format for *.prom files, JSON otherwise")
+
+   args = parser.parse_args()
+
+   if args.sobject == 'Attachment' and not (args.user_mapping and args.parent_mapping):
+      parser.error("Attachments need --user-mapping and --parent-mapping")
+   if args.sobject == 'ContentVersion' and not args.upsert_key:
+      parser.error("ContentVersions need --upsert-key")
+
+   if args.verbose:
+      log.basicConfig(format="%(levelname)s: %(message)s", level=log.DEBUG)
+   else:
+      log.basicConfig(format="%(levelname)s: %(message)s", level=log.INFO)
+
+   settings = SOBJECTS[args.sobject]
+   migrate_config = configparser.ConfigParser(allow_no_value=True)
+   migrate_config.read(args.basic_config_file or settings['config_file'])
+   config_section = migrate_config[settings['section']]
+   query_fields = config_section[settings['query_fields']]
+   batch_size = int(config_section['batch_size'])
+   max_query_length = int(config_section.get('max_query_length', DEFAULT_MAX_QUERY_LENGTH))
+   engine_config = read_engine_config(config_section)
+
+   metrics = RunMetrics(os.path.basename(__file__))
+   with phase(metrics, 'login'):
+      source = connect(args.source_config_file)
+      target = connect(args.target_config_file)
+
+   user_mapping = {}
+   parent_mapping = {}
+   if args.sobject == 'Attachment':
+      parent_mapping = open_mapping(args.parent_mapping, 'OriginalId', 'NewId')
+      user_mapping = open_mapping(args.user_mapping, 'OriginalId', 'NewId')
+
+   # the source engine downloads, the upload engine bounds the files in flight and with
+   # them the memory used by the spools (max_in_flight * spool_size at most)
+   with metrics, TransferEngine(source, metrics=metrics, **engine_config) as engine, UploadEngine(args.max_in_flight, args.max_retries, metrics) as upload_engine:
+      def migrate(row):
+         if args.sobject == 'Attachment':
+            return migrate_attachment(engine, target, row, user_mapping, parent_mapping, args.spool_size, args.multipart, upload_engine.scheduler, metrics)
+         return migrate_content_version(engine, target, row, args.upsert_key, args.spool_size, args.multipart, upload_engine.scheduler, metrics)
+
+      rows = query_source_rows(source, engine, args.sobject, args.query, query_fields, batch_size, max_query_length, metrics)
+      for request_body in upload_engine.map(migrate, rows):
+         if request_body:
+            result_row = ', '.join("{!s}={!r}".format(key, val) for (key, val) in request_body.items())
+            print(result_row)
+
+   if args.metrics_file:
+      metrics.write(args.metrics_file)
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,116 @@
+import hashlib
+import io
+import json
+import os
+import uuid
+from simple_salesforce.util import exception_handler
+from file_store import verify_checksum
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# name of the JSON part expected by Salesforce for each sObject
+ENTITY_PART_NAMES = {'ContentVersion': 'entity_content', 'Document': 'entity_document', 'Attachment': 'entity_attachment'}
+
+class MultipartBody(object):
+   '''
+   File-like multipart/form-data body for the sObject REST resources.
+   The first part is the small JSON entity, the second part is the binary file which
+   is read from disk chunk by chunk while requests sends the body, so the file is
+   never held in memory nor base64 encoded.
+   binary is the path of the file or an open binary file, which is read from its start.
+   With a checksum the MD5 of the binary is computed while it is sent and the request
+   is aborted with ChecksumError before its end if the file doesn't match.
+   '''
+   def __init__(self, entity_part_name, entity, binary_part_name, binary, file_name, checksum=None):
+      self.boundary = 'boundary_' + uuid.uuid4().hex
+      self.binary = binary
+      self.file_name = file_name
+      self.checksum = checksum
+      self.md5 = hashlib.md5() if checksum else None
+      self.head = ('--{boundary}\r\n'
+                   'Content-Disposition: form-data; name="{entity_part_name}"\r\n'
+                   'Content-Type: application/json\r\n\r\n'
+                   '{entity}\r\n'
+                   '--{boundary}\r\n'
+                   'Content-Disposition: form-data; name="{binary_part_name}"; filename="{file_name}"\r\n'
+                   'Content-Type: application/octet-stream\r\n\r\n').format(boundary=self.boundary,
+                                                                            entity_part_name=entity_part_name,
+                                                                            entity=json.dumps(entity),
+                                                                            binary_part_name=binary_part_name,
+                                                                            file_name=file_name.replace('"', '')).encode('utf-8')
+      self.tail = ('\r\n--{boundary}--\r\n'.format(boundary=self.boundary)).encode('utf-8')
+      if hasattr(binary, 'read'):
+         binary.seek(0, os.SEEK_END)
+         binary_size = binary.tell()
+         binary.seek(0)
+      else:
+         binary_size = os.path.getsize(binary)
+      self.length = len(self.head) + binary_size + len(self.tail)
+      self.parts = [self.head, None, self.tail]
+      self.binary_file = None
+
+   def __len__(self):
+      return self.length
+
+   @property
+   def content_type(self):
+      return 'multipart/form-data; boundary="{0}"'.format(self.boundary)
+
+   def read(self, size=-1):
+      if size is None or size < 0:
+         size = UPLOAD_CHUNK_SIZE
+      while self.parts:
+         part = self.parts[0]
+         if part is None:
+            if self.binary_file is None:
+               self.binary_file = self.binary if hasattr(self.binary, 'read') else open(self.binary, 'rb')
+            chunk = self.binary_file.read(size)
+            if chunk:
+               if self.md5:
+                  self.md5.update(chunk)
+               return chunk
+            self.close()
+            if self.md5:
+               verify_checksum(self.file_name, self.md5.hexdigest(), self.checksum)
+            self.parts.pop(0)
+         elif part:
+            self.parts[0] = part[size:]
+            return part[:size]
+         else:
+            self.parts.pop(0)
+      return b''
+
+   def seek(self, offset, whence=os.SEEK_SET):
+      # only back to the start, to send the body again
+      if offset != 0 or whence != os.SEEK_SET:
+         raise io.UnsupportedOperation('A multipart body can only go back to its start')
+      self.close()
+      self.binary_file = None
+      if hasattr(self.binary, 'read'):
+         self.binary.seek(0)
+      self.md5 = hashlib.md5() if self.checksum else None
+      self.parts = [self.head, None, self.tail]
+      return 0
+
+   def close(self):
+      # an open file passed in by the caller stays open
+      if self.binary_file is not None and self.binary_file is not self.binary:
+         self.binary_file.close()
+
+def insert_with_binary(sf, sobject, entity, binary_field, binary, file_name, checksum=None):
+   '''
+   Insert a record of sobject (Attachment, ContentVersion, Document) using a multipart
+   request with the binary streamed from binary (a file path or an open binary file) into binary_field.
+   Salesforce only accepts multipart bodies for insert, not for upsert by external Id.
+   Raises the same simple_salesforce exceptions as sf.<sobject>.create and ChecksumError
+   if the MD5 of the binary doesn't match checksum.
+   '''
+   body = MultipartBody(ENTITY_PART_NAMES.get(sobject, 'entity_' + sobject.lower()), entity, binary_field, binary, file_name, checksum)
+   try:
+      response = sf.session.post(sf.base_url + 'sobjects/' + sobject + '/', data=body,
+                                 headers={'Authorization': 'Bearer ' + sf.session_id,
+                                          'Content-Type': body.content_type})
+   finally:
+      body.close()
+   if response.status_code >= 300:
+      exception_handler(response, sobject)
+   return response.json()
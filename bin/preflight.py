@@ -0,0 +1,140 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import logging as log
+from bulk_query import BulkQuery, DEFAULT_MAX_RECORDS
+from query_planner import plan_id_batches, build_id_query, query_pages, DEFAULT_MAX_QUERY_LENGTH
+
+INSERT_BATCH_SIZE = 10000
+
+class ExistingRecords(object):
+   '''
+   Records which already exist in the target org, key -> (size, checksum), in a
+   temporary SQLite database filled by a query before the upload starts, so the
+   index of millions of records doesn't have to fit into memory. Every record is
+   kept, several records can share a key.
+   '''
+   def __init__(self):
+      handle, self.database_file = tempfile.mkstemp(prefix='existing_records_', suffix='.sqlite')
+      os.close(handle)
+      self.local = threading.local()
+      self.writer = None
+      self.count = 0
+      with sqlite3.connect(self.database_file) as connection:
+         connection.execute('CREATE TABLE existing (key TEXT NOT NULL, size INTEGER, checksum TEXT, matched INTEGER NOT NULL DEFAULT 0)')
+         connection.execute('CREATE INDEX existing_key ON existing (key)')
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      self.close()
+
+   def close(self):
+      if self.writer is not None:
+         self.writer.close()
+      if os.path.isfile(self.database_file):
+         os.remove(self.database_file)
+
+   def add_all(self, entries):
+      connection = sqlite3.connect(self.database_file)
+      try:
+         connection.execute('PRAGMA journal_mode = OFF')
+         connection.execute('PRAGMA synchronous = OFF')
+         rows = []
+         for entry in entries:
+            rows.append(entry)
+            if len(rows) >= INSERT_BATCH_SIZE:
+               connection.executemany('INSERT INTO existing (key, size, checksum) VALUES (?, ?, ?)', rows)
+               self.count += len(rows)
+               rows = []
+         connection.executemany('INSERT INTO existing (key, size, checksum) VALUES (?, ?, ?)', rows)
+         self.count += len(rows)
+         connection.commit()
+      finally:
+         connection.close()
+
+   def connection(self):
+      connection = getattr(self.local, 'connection', None)
+      if connection is None:
+         connection = sqlite3.connect('file:{0}?mode=ro'.format(self.database_file), uri=True)
+         self.local.connection = connection
+      return connection
+
+   def get(self, key):
+      return self.connection().execute('SELECT size, checksum FROM existing WHERE key = ?', (key,)).fetchone()
+
+   def __contains__(self, key):
+      return self.get(key) is not None
+
+   def is_current(self, key, size, checksum=None):
+      '''
+      True if a record exists under key with the same file: the same checksum if both
+      sides have one, the same size otherwise.
+      '''
+      entries = self.connection().execute('SELECT size, checksum FROM existing WHERE key = ?', (key,))
+      return any(is_same_file(entry, size, checksum) for entry in entries)
+
+   def match(self, key, size, checksum=None):
+      '''
+      Like is_current, but the record found is taken: every record of the target matches
+      one file only, so of two files under the same key only as many are found as exist.
+      Called from one thread only.
+      '''
+      if self.writer is None:
+         self.writer = sqlite3.connect(self.database_file)
+      entries = self.writer.execute('SELECT rowid, size, checksum FROM existing WHERE key = ? AND matched = 0', (key,)).fetchall()
+      for entry in entries:
+         if is_same_file(entry[1:], size, checksum):
+            self.writer.execute('UPDATE existing SET matched = 1 WHERE rowid = ?', (entry[0],))
+            self.writer.commit()
+            return True
+      return False
+
+def is_same_file(entry, size, checksum=None):
+   existing_size, existing_checksum = entry
+   if checksum and existing_checksum:
+      return checksum.lower() == existing_checksum.lower()
+   return size is not None and existing_size == size
+
+def as_int(value):
+   return int(value) if value not in (None, '') else None
+
+def index_records(records, key_of, size_field, checksum_field=None):
+   existing = ExistingRecords()
+   existing.add_all((key_of(record), as_int(record.get(size_field)), record.get(checksum_field) if checksum_field else None)
+                    for record in records if key_of(record))
+   log.info('Found {0} records already in the target org'.format(existing.count))
+   return existing
+
+def query_existing(sf, query, key_of, size_field, checksum_field=None, max_records=DEFAULT_MAX_RECORDS):
+   '''
+   Run query as a Bulk API 2.0 job on the target org and index its records by key_of(record).
+   '''
+   records = BulkQuery(sf.base_url, sf.session_id, session=sf.session, max_records=max_records).query(query)
+   return index_records(records, key_of, size_field, checksum_field)
+
+def query_existing_by_id(sf, query_prefix, ids, key_of, size_field, checksum_field=None, max_query_length=DEFAULT_MAX_QUERY_LENGTH):
+   '''
+   Like query_existing, but only for the records of ids: query_prefix ends with
+   "IN (" and is run for batches of the ids, e.g. the parents of the uploaded files.
+   '''
+   records = (record for batch in plan_id_batches(query_prefix, ids, max_query_length=max_query_length)
+              for record in query_pages(sf, build_id_query(query_prefix, batch))[1])
+   return index_records(records, key_of, size_field, checksum_field)
+
+def is_uploaded(existing, key, store, record_id, checksum=None, match=False):
+   '''
+   True if the file of record_id in store already exists in the target under key.
+   With match, the record found is taken by this file, for keys several files share.
+   '''
+   if existing is None or not key:
+      return False
+   try:
+      size = store.size(record_id)
+   except OSError:
+      return False
+   if match:
+      return existing.match(key, size, checksum)
+   return existing.is_current(key, size, checksum)
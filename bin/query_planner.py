@@ -0,0 +1,188 @@
+import collections
+import concurrent.futures
+import json
+import os
+import tempfile
+import threading
+from urllib.parse import quote_plus
+from bulk_query import SeenValues
+from run_metrics import phase
+
+# REST queries are sent as GET parameter, the whole request URI must stay below 16,384
+# characters, so leave some room for the instance URL and the API version
+DEFAULT_MAX_QUERY_LENGTH = 15000
+# SOQL statements are limited to 100,000 characters
+MAX_SOQL_LENGTH = 100000
+DEFAULT_PARENT_CHUNK_SIZE = 500
+DEFAULT_PARENT_CHUNK_WORKERS = 4
+
+def plan_id_batches(query_prefix, ids, query_suffix=')', max_query_length=DEFAULT_MAX_QUERY_LENGTH, max_ids=None):
+   '''
+   Split ids into batches for queries of the form query_prefix + 'id1','id2',... + query_suffix,
+   packing as many ids into every batch as the URL encoded query allows.
+   max_ids optionally caps the number of ids per batch.
+   '''
+   base_length = len(quote_plus(query_prefix + query_suffix))
+   base_soql_length = len(query_prefix + query_suffix)
+   batch = []
+   length = base_length
+   soql_length = base_soql_length
+   for item in ids:
+      item_length = len(quote_plus("'" + item + "',"))
+      item_soql_length = len(item) + 3
+      if batch and (length + item_length > max_query_length
+                    or soql_length + item_soql_length > MAX_SOQL_LENGTH
+                    or (max_ids and len(batch) >= max_ids)):
+         yield batch
+         batch = []
+         length = base_length
+         soql_length = base_soql_length
+      batch.append(item)
+      length += item_length
+      soql_length += item_soql_length
+   if batch:
+      yield batch
+
+def build_id_query(query_prefix, batch, query_suffix=')'):
+   return query_prefix + ",".join("'" + item + "'" for item in batch) + query_suffix
+
+def query_all_pages(sf, query):
+   '''
+   Run query and follow nextRecordsUrl until the last page, returning all records.
+   '''
+   return list(iter_records(sf, sf.query(query)))
+
+def query_pages(sf, query):
+   '''
+   Run query and return its totalSize and an iterator over its records, which follows
+   nextRecordsUrl only when the records of the current page are consumed, so a single
+   page is held in memory at a time. The first page is requested before this returns.
+   '''
+   response = sf.query(query)
+   return response.get('totalSize', 0), iter_records(sf, response)
+
+def iter_records(sf, response):
+   while True:
+      for record in response.get('records', []):
+         yield record
+      if response.get('done', True) or not response.get('nextRecordsUrl'):
+         return
+      response = sf.query_more(response['nextRecordsUrl'], identifier_is_url=True)
+
+def distinct_parent_ids(records):
+   '''
+   Distinct values of the single field of the records of a parent query, e.g. the Ids
+   of SELECT Id FROM Account or the AccountIds of SELECT AccountId FROM Contact.
+   '''
+   seen = SeenValues()
+   try:
+      for record in records:
+         value = next((value for (key, value) in record.items() if key != 'attributes'), None)
+         if value and seen.add(value):
+            yield value
+   finally:
+      seen.close()
+
+def map_ahead(executor, function, items, depth):
+   # results in the order of the items, with up to depth calls running ahead of the consumer
+   pending = collections.deque()
+   for item in items:
+      pending.append(executor.submit(function, item))
+      if len(pending) >= depth:
+         yield pending.popleft().result()
+   while pending:
+      yield pending.popleft().result()
+
+def query_parent_chunks(sf, parent_records, query_prefix, query_suffix=')', chunk_size=DEFAULT_PARENT_CHUNK_SIZE,
+                        workers=DEFAULT_PARENT_CHUNK_WORKERS, max_query_length=DEFAULT_MAX_QUERY_LENGTH, metrics=None):
+   '''
+   Records of query_prefix + 'id1','id2',... + query_suffix for chunks of the parent Ids
+   in parent_records, e.g. the Attachments of chunks of Account Ids, instead of one
+   semi-join on the parent query which times out on parents with tens of millions of rows.
+   The chunks are formed while the parent records arrive and the queries of up to
+   workers chunks run at the same time. Records are yielded chunk by chunk.
+   '''
+   def query_chunk(chunk):
+      with phase(metrics, 'id_query', 'query'):
+         return query_all_pages(sf, build_id_query(query_prefix, chunk, query_suffix))
+
+   chunks = plan_id_batches(query_prefix, distinct_parent_ids(parent_records), query_suffix,
+                            max_query_length=max_query_length, max_ids=chunk_size)
+   with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='parent-chunk') as executor:
+      for records in map_ahead(executor, query_chunk, chunks, 2 * workers):
+         for record in records:
+            yield record
+
+class RecordSpool(object):
+   '''
+   Records of a query, read to the end on a thread of their own into a temporary file
+   and handed to the consumer from there. The query cursor is never left idle while the
+   consumer waits for downloads, Salesforce drops cursors idle for about 15 minutes.
+   '''
+   def __init__(self, records):
+      handle, self.path = tempfile.mkstemp(prefix='query_records_', suffix='.jsonl')
+      self.output_file = os.fdopen(handle, 'w')
+      self.condition = threading.Condition()
+      self.written = 0
+      self.done = False
+      self.stopped = False
+      self.error = None
+      self.thread = threading.Thread(target=self.drain, args=(records,), name='query-spool', daemon=True)
+      self.thread.start()
+
+   def drain(self, records):
+      try:
+         for record in records:
+            if self.stopped:
+               break
+            self.output_file.write(json.dumps(record) + '\n')
+            self.output_file.flush()
+            with self.condition:
+               self.written += 1
+               self.condition.notify_all()
+      except Exception as ex:
+         self.error = ex
+      finally:
+         self.output_file.close()
+         with self.condition:
+            self.done = True
+            self.condition.notify_all()
+            if self.stopped:
+               self.remove()
+
+   def __iter__(self):
+      read = 0
+      try:
+         with open(self.path) as input_file:
+            while True:
+               with self.condition:
+                  while read >= self.written and not self.done:
+                     self.condition.wait()
+                  available = self.written
+               if read >= available:
+                  break
+               for _ in range(available - read):
+                  yield json.loads(input_file.readline())
+               read = available
+         if self.error:
+            raise self.error
+      finally:
+         with self.condition:
+            self.stopped = True
+            if self.done:
+               self.remove()
+
+   def remove(self):
+      if os.path.isfile(self.path):
+         os.remove(self.path)
+
+def spool_records(records):
+   '''
+   Iterator over records which reads them ahead on its own thread, see RecordSpool.
+   '''
+   return iter(RecordSpool(records))
+
+def read_chunk_config(config_section):
+   return (config_section.get('parent_chunking', 'false').lower() == 'true',
+           int(config_section.get('parent_chunk_size', DEFAULT_PARENT_CHUNK_SIZE)),
+           int(config_section.get('parent_chunk_workers', DEFAULT_PARENT_CHUNK_WORKERS)))
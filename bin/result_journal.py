@@ -0,0 +1,118 @@
+import csv
+import json
+import os
+import threading
+import time
+from preflight import ExistingRecords
+
+# OriginalId and NewId like the mapping CSVs, so a journal can be used as a mapping
+JOURNAL_FIELDS = ['OriginalId', 'NewId', 'Status', 'ErrorCode', 'Error', 'ElapsedSeconds', 'File']
+JSON_LINES_SUFFIXES = ('.jsonl', '.ndjson')
+DEFAULT_FLUSH_ROWS = 1000
+DEFAULT_FLUSH_INTERVAL = 5
+
+STATUS_SUCCESS = 'Success'
+STATUS_FAILED = 'Failed'
+# the file is already in the target org
+STATUS_SKIPPED = 'Skipped'
+# rows which a retry doesn't send again
+DONE_STATUSES = (STATUS_SUCCESS, STATUS_SKIPPED)
+
+def is_json_lines(path):
+   return path.lower().endswith(JSON_LINES_SUFFIXES)
+
+def error_details(error):
+   '''
+   (error code, message) of an exception raised by simple_salesforce, requests or the
+   file store, or of an error message.
+   '''
+   if not error:
+      return '', ''
+   content = getattr(error, 'content', None)
+   if isinstance(content, list) and content and isinstance(content[0], dict):
+      return content[0].get('errorCode', ''), content[0].get('message', '')
+   if isinstance(error, str):
+      return '', error
+   return type(error).__name__, str(error)
+
+class ResultJournal(object):
+   '''
+   One row per input row of an upload with the original Id, the new Id, the status,
+   the error and the time spent on the row, as CSV or, for *.jsonl files, JSON lines.
+   Rows are added from the upload threads and written in blocks, at the latest every
+   flush_interval seconds. With append the rows are added to an existing journal.
+   '''
+   def __init__(self, path, append=False, flush_rows=DEFAULT_FLUSH_ROWS, flush_interval=DEFAULT_FLUSH_INTERVAL):
+      self.path = path
+      self.json_lines = is_json_lines(path)
+      self.flush_rows = flush_rows
+      self.flush_interval = flush_interval
+      self.lock = threading.Lock()
+      self.rows = []
+      self.flushed = time.monotonic()
+      write_header = not (append and os.path.isfile(path) and os.path.getsize(path) > 0)
+      self.file = open(path, 'a' if append else 'w', newline='')
+      self.writer = None
+      if not self.json_lines:
+         self.writer = csv.DictWriter(self.file, JOURNAL_FIELDS, quoting=csv.QUOTE_ALL)
+         if write_header:
+            self.writer.writeheader()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      self.close()
+
+   def add(self, original_id, status, new_id=None, error=None, elapsed=None, file_name=None, error_code=None):
+      code, message = error_details(error)
+      row = {'OriginalId': original_id, 'NewId': new_id or '', 'Status': status,
+             'ErrorCode': error_code or code, 'Error': message,
+             'ElapsedSeconds': round(elapsed, 3) if elapsed is not None else '', 'File': file_name or ''}
+      with self.lock:
+         self.rows.append(row)
+         if len(self.rows) >= self.flush_rows or time.monotonic() - self.flushed >= self.flush_interval:
+            self.write_rows()
+
+   def write_rows(self):
+      if self.json_lines:
+         self.file.writelines(json.dumps(row) + '\n' for row in self.rows)
+      else:
+         self.writer.writerows(self.rows)
+      self.file.flush()
+      self.rows = []
+      self.flushed = time.monotonic()
+
+   def flush(self):
+      with self.lock:
+         self.write_rows()
+
+   def close(self):
+      if not self.file.closed:
+         self.flush()
+         self.file.close()
+
+def read_journal(path):
+   with open(path, 'r', newline='') as journal_file:
+      if is_json_lines(path):
+         for line in journal_file:
+            if line.strip():
+               yield json.loads(line)
+      else:
+         for row in csv.DictReader(journal_file):
+            yield row
+
+def completed_rows(path):
+   '''
+   Index of the OriginalIds which a previous run uploaded or found in the target org,
+   the input rows missing from it are the failed ones and the ones the run never got to.
+   '''
+   completed = ExistingRecords()
+   completed.add_all((row['OriginalId'], None, None) for row in read_journal(path)
+                     if row.get('OriginalId') and row.get('Status') in DONE_STATUSES)
+   return completed
+
+def open_journal(path, retry_path=None):
+   # a retry of the journal it writes to adds its rows to the previous ones
+   append = bool(retry_path) and os.path.abspath(retry_path) == os.path.abspath(path)
+   return ResultJournal(path, append)
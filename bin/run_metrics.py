@@ -0,0 +1,212 @@
+import contextlib
+import functools
+import json
+import logging
+import sys
+import threading
+import time
+
+# upper bounds of the request latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DEFAULT_PROGRESS_INTERVAL = 5
+METRIC_PREFIX = 'salesforce_migration'
+
+FILE_COMPLETE = 'complete'
+FILE_FAILED = 'failed'
+FILE_SKIPPED = 'skipped'
+
+class Histogram(object):
+   def __init__(self, buckets=LATENCY_BUCKETS):
+      self.buckets = buckets
+      self.counts = [0] * len(buckets)
+      self.count = 0
+      self.sum = 0.0
+      self.max = 0.0
+
+   def observe(self, value):
+      for i, bound in enumerate(self.buckets):
+         if value <= bound:
+            self.counts[i] += 1
+            break
+      self.count += 1
+      self.sum += value
+      self.max = max(self.max, value)
+
+   def cumulative_counts(self):
+      total = 0
+      for bound, count in zip(self.buckets, self.counts):
+         total += count
+         yield bound, total
+
+   def as_dict(self):
+      return {'count': self.count, 'sum': self.sum, 'max': self.max,
+              'mean': self.sum / self.count if self.count else None,
+              'buckets': dict((str(bound), count) for bound, count in self.cumulative_counts())}
+
+class RunMetrics(object):
+   '''
+   Timing of the phases of a run (login, id_query, metadata_query, download, write,
+   encode, upload), latency histograms per request type and file/byte counters.
+   Phase times are summed over all threads, so for the concurrent phases they are
+   busy time rather than wall clock time.
+   While the run is active a progress line with rates and ETA is shown; at the end
+   the metrics can be written as JSON or in the Prometheus text format.
+   '''
+   def __init__(self, name, progress_interval=DEFAULT_PROGRESS_INTERVAL, progress_stream=sys.stderr):
+      self.name = name
+      self.progress_interval = progress_interval
+      self.progress_stream = progress_stream
+      self.lock = threading.Lock()
+      self.started = time.monotonic()
+      self.phases = {}
+      self.histograms = {}
+      self.files = {FILE_COMPLETE: 0, FILE_FAILED: 0, FILE_SKIPPED: 0}
+      self.bytes = 0
+      self.total_files = None
+      self.stopped = threading.Event()
+      self.progress_thread = None
+
+   def __enter__(self):
+      self.start_progress()
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      self.stop_progress()
+
+   @contextlib.contextmanager
+   def phase(self, name, request_type=None):
+      '''
+      Time the block as part of phase name. request_type, when given, selects the
+      latency histogram, e.g. the upload phase has create, upsert and collection requests.
+      '''
+      started = time.monotonic()
+      try:
+         yield
+      finally:
+         self.observe(name, time.monotonic() - started, request_type)
+
+   def observe(self, name, seconds, request_type=None):
+      with self.lock:
+         phase = self.phases.setdefault(name, {'seconds': 0.0, 'count': 0})
+         phase['seconds'] += seconds
+         phase['count'] += 1
+         self.histograms.setdefault(request_type or name, Histogram()).observe(seconds)
+
+   def add_file(self, size=0, state=FILE_COMPLETE):
+      with self.lock:
+         self.files[state] += 1
+         if state == FILE_COMPLETE:
+            self.bytes += int(size or 0)
+
+   def set_total(self, files):
+      self.total_files = files
+
+   def elapsed(self):
+      return time.monotonic() - self.started
+
+   def progress_line(self):
+      elapsed = self.elapsed()
+      with self.lock:
+         done = sum(self.files.values())
+         complete_bytes = self.bytes
+         failed = self.files[FILE_FAILED]
+      files_per_second = done / elapsed if elapsed else 0
+      megabytes_per_second = complete_bytes / 1024.0 / 1024.0 / elapsed if elapsed else 0
+      if self.total_files:
+         progress = '{0}/{1} files ({2:.0%})'.format(done, self.total_files, float(done) / self.total_files)
+         eta = format_duration((self.total_files - done) / files_per_second) if files_per_second and done < self.total_files else '-'
+      else:
+         progress = '{0} files'.format(done)
+         eta = '?'
+      return '{0}: {1}, {2} failed, {3:.1f} files/s, {4:.2f} MB/s, elapsed {5}, ETA {6}'.format(
+         self.name, progress, failed, files_per_second, megabytes_per_second, format_duration(elapsed), eta)
+
+   def show_progress(self, final=False):
+      if self.progress_stream.isatty():
+         # a live line on a terminal, rewritten in place
+         self.progress_stream.write('\r' + self.progress_line() + ('\n' if final else ''))
+         self.progress_stream.flush()
+      else:
+         logging.info(self.progress_line())
+
+   def start_progress(self):
+      if not self.progress_interval:
+         return
+      def report():
+         while not self.stopped.wait(self.progress_interval):
+            self.show_progress()
+      self.progress_thread = threading.Thread(target=report, daemon=True)
+      self.progress_thread.start()
+
+   def stop_progress(self):
+      self.stopped.set()
+      if self.progress_thread:
+         self.progress_thread.join()
+         self.show_progress(final=True)
+
+   def as_dict(self):
+      elapsed = self.elapsed()
+      with self.lock:
+         return {'name': self.name, 'elapsed_seconds': elapsed,
+                 'files': dict(self.files), 'total_files': self.total_files, 'bytes': self.bytes,
+                 'files_per_second': self.files[FILE_COMPLETE] / elapsed if elapsed else 0,
+                 'bytes_per_second': self.bytes / elapsed if elapsed else 0,
+                 'phases': dict((name, dict(phase)) for name, phase in self.phases.items()),
+                 'latency_seconds': dict((name, histogram.as_dict()) for name, histogram in self.histograms.items())}
+
+   def prometheus_text(self):
+      metrics = self.as_dict()
+      labels = 'script="{0}"'.format(self.name)
+      lines = ['# TYPE {0}_elapsed_seconds gauge'.format(METRIC_PREFIX),
+               '{0}_elapsed_seconds{{{1}}} {2}'.format(METRIC_PREFIX, labels, metrics['elapsed_seconds']),
+               '# TYPE {0}_files_total counter'.format(METRIC_PREFIX)]
+      for state, count in sorted(metrics['files'].items()):
+         lines.append('{0}_files_total{{{1},state="{2}"}} {3}'.format(METRIC_PREFIX, labels, state, count))
+      lines += ['# TYPE {0}_bytes_total counter'.format(METRIC_PREFIX),
+                '{0}_bytes_total{{{1}}} {2}'.format(METRIC_PREFIX, labels, metrics['bytes']),
+                '# TYPE {0}_phase_seconds_total counter'.format(METRIC_PREFIX)]
+      for name, phase in sorted(metrics['phases'].items()):
+         lines.append('{0}_phase_seconds_total{{{1},phase="{2}"}} {3}'.format(METRIC_PREFIX, labels, name, phase['seconds']))
+      lines.append('# TYPE {0}_request_duration_seconds histogram'.format(METRIC_PREFIX))
+      with self.lock:
+         histograms = sorted(self.histograms.items())
+         for request_type, histogram in histograms:
+            request_labels = '{0},request_type="{1}"'.format(labels, request_type)
+            for bound, count in histogram.cumulative_counts():
+               lines.append('{0}_request_duration_seconds_bucket{{{1},le="{2}"}} {3}'.format(METRIC_PREFIX, request_labels, bound, count))
+            lines.append('{0}_request_duration_seconds_bucket{{{1},le="+Inf"}} {2}'.format(METRIC_PREFIX, request_labels, histogram.count))
+            lines.append('{0}_request_duration_seconds_sum{{{1}}} {2}'.format(METRIC_PREFIX, request_labels, histogram.sum))
+            lines.append('{0}_request_duration_seconds_count{{{1}}} {2}'.format(METRIC_PREFIX, request_labels, histogram.count))
+      return '\n'.join(lines) + '\n'
+
+   def write(self, path):
+      '''
+      Prometheus text format for *.prom files, JSON otherwise.
+      '''
+      with open(path, 'w') as output_file:
+         if path.endswith('.prom'):
+            output_file.write(self.prometheus_text())
+         else:
+            json.dump(self.as_dict(), output_file, indent=2)
+
+def phase(metrics, name, request_type=None):
+   if metrics is None:
+      return contextlib.nullcontext()
+   return metrics.phase(name, request_type)
+
+def timed(metrics, name, request_type, function):
+   '''
+   function, timed as phase name on every call. Passed to a scheduler, every attempt
+   of a retried request is timed on its own, without the wait for a slot or the backoff.
+   '''
+   if metrics is None:
+      return function
+   @functools.wraps(function)
+   def timed_function(*args, **kwargs):
+      with metrics.phase(name, request_type):
+         return function(*args, **kwargs)
+   return timed_function
+
+def format_duration(seconds):
+   seconds = int(seconds)
+   return '{0:d}:{1:02d}:{2:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import logging as log
+import requests
+from requests.auth import AuthBase
+from simple_salesforce import Salesforce
+
+DEFAULT_CACHE_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'salesforce-file-export-import')
+# Salesforce ends a session after 2 hours without requests by default
+DEFAULT_MAX_AGE = 2 * 60 * 60
+# session_cache setting which turns the cache off
+CACHE_DISABLED = ('false', 'no', 'off', 'none')
+
+class SessionAuth(AuthBase):
+   '''
+   Authorization of a requests session from a SessionBroker. Every request is sent with
+   the current session Id, a request answered with 401 gets a new session from the broker
+   and is sent once more.
+   '''
+   def __init__(self, broker):
+      self.broker = broker
+
+   def __call__(self, request):
+      session_id = self.broker.session_id
+      request.headers['Authorization'] = 'Bearer ' + session_id
+      request.register_hook('response', lambda response, **kwargs: self.handle_401(response, session_id, **kwargs))
+      return request
+
+   def handle_401(self, response, session_id, **kwargs):
+      if response.status_code != 401:
+         return response
+      new_session_id = self.broker.refresh(session_id)
+      request = response.request.copy()
+      if hasattr(request.body, 'read'):
+         # a streamed body is sent again from its start, if it can go back there
+         if not hasattr(request.body, 'seek'):
+            return response
+         request.body.seek(0)
+      # release the connection of the rejected request
+      response.content
+      response.close()
+      request.headers['Authorization'] = 'Bearer ' + new_session_id
+      replay = response.connection.send(request, **kwargs)
+      replay.history.append(response)
+      replay.request = request
+      return replay
+
+class SessionBroker(object):
+   '''
+   One Salesforce session shared by all threads of a script and cached in a file across
+   runs, so a script doesn't sign in when the session of the previous run is still valid.
+   The clients get their credentials from the broker through the auth of their requests
+   session, and when the session expires in the middle of a run the first request to see
+   the 401 signs in again while the others wait for its new session.
+   '''
+   def __init__(self, username, password, security_token, domain='login', cache_file=None, max_age=DEFAULT_MAX_AGE):
+      self.username = username
+      self.password = password
+      self.security_token = security_token
+      self.domain = domain
+      self.cache_file = cache_file
+      self.max_age = max_age
+      self.lock = threading.Lock()
+      self.session_id = None
+      self.instance = None
+      self.sf = None
+      self.logins = 0
+
+   def connect(self):
+      '''
+      Salesforce client of the cached session, or of a new one.
+      '''
+      if self.load():
+         log.info('Using the cached session of {0}'.format(self.username))
+      else:
+         self.login()
+      session = requests.Session()
+      session.auth = SessionAuth(self)
+      self.sf = Salesforce(session_id=self.session_id, instance=self.instance, session=session, domain=self.domain)
+      return self.sf
+
+   def login(self):
+      # the login has its own requests session, outside of the auth of the broker
+      sf = Salesforce(username=self.username, password=self.password, security_token=self.security_token, domain=self.domain)
+      self.logins += 1
+      self.session_id, self.instance = sf.session_id, sf.sf_instance
+      self.save()
+      if self.sf is not None:
+         self.sf.session_id = self.session_id
+         self.sf.headers['Authorization'] = 'Bearer ' + self.session_id
+
+   def refresh(self, stale_session_id):
+      '''
+      Session Id to use after stale_session_id was rejected, signing in again only if
+      no other thread has done it already.
+      '''
+      with self.lock:
+         if self.session_id == stale_session_id:
+            log.info('The session of {0} expired, signing in again'.format(self.username))
+            self.login()
+         return self.session_id
+
+   def load(self):
+      if not self.cache_file or not os.path.isfile(self.cache_file):
+         return False
+      if time.time() - os.path.getmtime(self.cache_file) > self.max_age:
+         return False
+      try:
+         with open(self.cache_file) as cache:
+            cached = json.load(cache)
+      except (OSError, ValueError):
+         return False
+      if cached.get('username') != self.username or cached.get('domain') != self.domain:
+         return False
+      self.session_id, self.instance = cached['session_id'], cached['instance']
+      return True
+
+   def save(self):
+      if not self.cache_file:
+         return
+      folder = os.path.dirname(self.cache_file)
+      if folder and not os.path.isdir(folder):
+         os.makedirs(folder)
+      # the session Id is a credential, only the user may read it
+      temporary_file = self.cache_file + '.tmp'
+      with os.fdopen(os.open(temporary_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cache:
+         json.dump({'username': self.username, 'domain': self.domain, 'session_id': self.session_id, 'instance': self.instance}, cache)
+      os.replace(temporary_file, self.cache_file)
+
+def session_cache_file(session_cache, username, domain):
+   '''
+   Cache file of the session_cache setting of a credentials file: a path, empty for a file
+   per user in DEFAULT_CACHE_FOLDER or false to sign in on every run.
+   '''
+   if session_cache and session_cache.lower() in CACHE_DISABLED:
+      return None
+   if session_cache:
+      return os.path.expanduser(session_cache)
+   name = hashlib.sha1('{0}@{1}'.format(username, domain).encode('utf-8')).hexdigest()[:16]
+   return os.path.join(DEFAULT_CACHE_FOLDER, 'session_' + name + '.json')
+
+def login_count(sf):
+   '''
+   Number of times the broker of the client sf signed in, 0 if it used the cached session.
+   '''
+   return sf.session.auth.broker.logins
+
+def connect(username, password, security_token, domain='login', session_cache=None):
+   '''
+   Salesforce client of a SessionBroker, in place of Salesforce(username=..., ...).
+   '''
+   return SessionBroker(username, password, security_token, domain, session_cache_file(session_cache, username, domain)).connect()
@@ -0,0 +1,76 @@
+import pytest
+import requests
+from adaptive_scheduler import AdaptiveScheduler, TransientError, parse_limit_info, is_throttling_response, is_throttling_exception
+
+class SalesforceError(Exception):
+   '''
+   Like the exceptions of simple_salesforce: the status and content of the response.
+   '''
+   def __init__(self, status, content):
+      super(SalesforceError, self).__init__(content)
+      self.status = status
+      self.content = content
+
+def test_parse_limit_info():
+   assert parse_limit_info('api-usage=25/15000') == (25, 15000)
+   assert parse_limit_info('api-usage=25/15000, per-app-api-usage=17/250(appName=sample)') == (25, 15000)
+   assert parse_limit_info('per-app-api-usage=17/250') is None
+   assert parse_limit_info(None) is None
+
+def test_throttling_responses():
+   for status_code in (429, 500, 502, 503, 504):
+      assert is_throttling_response(status_code, '')
+   assert is_throttling_response(403, [{'errorCode': 'REQUEST_LIMIT_EXCEEDED', 'message': 'ConcurrentPerOrgLongTxn Limit exceeded'}])
+   assert is_throttling_response(400, '[{"errorCode": "UNABLE_TO_LOCK_ROW"}]')
+   assert not is_throttling_response(400, [{'errorCode': 'MALFORMED_QUERY', 'message': 'unexpected token'}])
+   assert not is_throttling_response(404, '')
+
+def test_inserts_are_only_retried_when_rejected():
+   assert is_throttling_response(429, '', idempotent=False)
+   assert is_throttling_response(503, '', idempotent=False)
+   assert is_throttling_response(403, [{'errorCode': 'REQUEST_LIMIT_EXCEEDED'}], idempotent=False)
+   assert is_throttling_response(400, [{'errorCode': 'UNABLE_TO_LOCK_ROW'}], idempotent=False)
+   # the record may have been created
+   for status_code in (500, 502, 504):
+      assert not is_throttling_response(status_code, '', idempotent=False)
+
+def test_throttling_exceptions():
+   assert is_throttling_exception(SalesforceError(503, ''))
+   assert is_throttling_exception(requests.exceptions.ConnectionError())
+   assert is_throttling_exception(requests.exceptions.ReadTimeout())
+   assert not is_throttling_exception(ValueError())
+   assert is_throttling_exception(SalesforceError(503, ''), idempotent=False)
+   assert not is_throttling_exception(SalesforceError(500, ''), idempotent=False)
+   assert not is_throttling_exception(requests.exceptions.ConnectionError(), idempotent=False)
+   assert not is_throttling_exception(requests.exceptions.ReadTimeout(), idempotent=False)
+
+def test_call_create_does_not_retry_ambiguous_failures():
+   scheduler = AdaptiveScheduler(2, base_delay=0)
+   calls = []
+   def create():
+      calls.append(1)
+      raise requests.exceptions.ReadTimeout()
+   with pytest.raises(requests.exceptions.ReadTimeout):
+      scheduler.call_create(create)
+   assert len(calls) == 1
+
+def test_call_api_retries_then_raises_the_original_exception():
+   scheduler = AdaptiveScheduler(2, max_retries=2, base_delay=0)
+   calls = []
+   def query():
+      calls.append(1)
+      raise SalesforceError(503, '')
+   with pytest.raises(SalesforceError):
+      scheduler.call_api(query)
+   assert len(calls) == 3
+
+def test_only_successful_calls_grow_the_limit():
+   scheduler = AdaptiveScheduler(4, initial_concurrency=2, max_retries=0, base_delay=0)
+   def fail():
+      raise TransientError('dropped connection', throttled=False)
+   with pytest.raises(TransientError):
+      scheduler.call(fail)
+   assert scheduler.limit == 2
+   assert scheduler.in_flight == 0
+   scheduler.call(lambda: None)
+   assert scheduler.limit == 2.5
@@ -0,0 +1,32 @@
+import csv
+from bulk_query import iter_lines
+
+class FakeResponse(object):
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def iter_content(self, chunk_size=None):
+        return iter(self.chunks)
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+RESULT = '"Id","Description"\n"1","first line\nsecond line"\n"2","café"\n"3",""\n'.encode('utf-8')
+
+def test_lines_keep_their_endings():
+    lines = list(iter_lines(FakeResponse([b'a,b\nc,', b'd\ne,f'])))
+    assert lines == ['a,b\n', 'c,d\n', 'e,f']
+
+def test_quoted_values_with_line_breaks():
+    for chunk_size in (1, 2, 3, 7, len(RESULT)):
+        rows = list(csv.DictReader(iter_lines(FakeResponse(split(RESULT, chunk_size)))))
+        assert rows == [{'Id': '1', 'Description': 'first line\nsecond line'},
+                        {'Id': '2', 'Description': 'café'},
+                        {'Id': '3', 'Description': ''}], chunk_size
+
+def test_multi_byte_character_split_across_chunks():
+    data = 'café\n'.encode('utf-8')
+    assert list(iter_lines(FakeResponse([data[:4], data[4:]]))) == ['café\n']
+
+def test_empty_response():
+    assert list(iter_lines(FakeResponse([]))) == []
@@ -0,0 +1,22 @@
+import json
+from capacity_plan import CapacityPlan
+
+def write_metrics(path, metrics):
+   with open(path, 'w') as output_file:
+      json.dump(metrics, output_file)
+
+def test_calibrate_from_the_transfer_phase(tmp_path):
+   metrics_file = str(tmp_path / 'metrics.json')
+   write_metrics(metrics_file, {'bytes': 1000, 'phases': {'download': {'seconds': 2.0, 'count': 10}}})
+   plan = CapacityPlan('export_attachments.py')
+   plan.observe_latency('limits', 0.1)
+   plan.calibrate(metrics_file, 'download')
+   assert plan.transfer_latency == 0.1
+   assert plan.bandwidth == 1000 / (2.0 - 10 * 0.1)
+
+def test_calibrate_without_transfer_time(tmp_path):
+   metrics_file = str(tmp_path / 'metrics.json')
+   write_metrics(metrics_file, {'bytes': 1000, 'phases': {'download': {'seconds': 0.0, 'count': 3}}})
+   plan = CapacityPlan('export_attachments.py')
+   plan.calibrate(metrics_file, 'download')
+   assert plan.bandwidth is None
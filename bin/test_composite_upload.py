@@ -0,0 +1,33 @@
+from composite_upload import group_small_files, encoded_size
+
+def sizes_of(sizes):
+   def file_size_of(row):
+      size = sizes[row]
+      if size is None:
+         raise OSError('missing file')
+      return size
+   return file_size_of
+
+def test_small_files_are_grouped():
+   sizes = {'a': 10, 'b': 20, 'c': 30}
+   assert list(group_small_files(['a', 'b', 'c'], sizes_of(sizes), 100)) == [['a', 'b', 'c']]
+
+def test_large_file_closes_the_group_before_it():
+   sizes = {'a': 10, 'big': 100, 'b': 20, 'c': 30}
+   assert list(group_small_files(['a', 'big', 'b', 'c'], sizes_of(sizes), 100)) == [['a'], 'big', ['b', 'c']]
+
+def test_missing_file_is_yielded_on_its_own():
+   sizes = {'a': 10, 'gone': None, 'b': 20}
+   assert list(group_small_files(['a', 'gone', 'b'], sizes_of(sizes), 100)) == [['a'], 'gone', ['b']]
+
+def test_groups_respect_the_record_limit():
+   rows = ['row{0}'.format(i) for i in range(7)]
+   sizes = dict((row, 1) for row in rows)
+   groups = list(group_small_files(rows, sizes_of(sizes), 100, max_records=3))
+   assert groups == [rows[0:3], rows[3:6], rows[6:7]]
+
+def test_groups_respect_the_payload_limit():
+   rows = ['a', 'b', 'c']
+   sizes = {'a': 3000, 'b': 3000, 'c': 3000}
+   max_payload = 2 * encoded_size(3000)
+   assert list(group_small_files(rows, sizes_of(sizes), 10000, max_payload=max_payload)) == [['a', 'b'], ['c']]
@@ -0,0 +1,107 @@
+import csv
+import datetime
+from delta_export import Watermark, merge_csv, parse_datetime, soql_datetime
+
+class FakeResponse(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+class FakeSalesforce(object):
+    '''
+    Just what server_time() uses: a session whose responses carry a Date header.
+    '''
+    base_url = 'https://example.my.salesforce.com/services/data/v59.0/'
+    headers = {}
+
+    def __init__(self, date):
+        self.session = self
+        self.date = date
+        self.urls = []
+
+    def get(self, url, headers=None):
+        self.urls.append(url)
+        return FakeResponse({'Date': self.date} if self.date else {})
+
+def write_csv(path, fields, rows):
+    with open(path, 'w', newline='') as output_file:
+        writer = csv.DictWriter(output_file, fields, quoting=csv.QUOTE_ALL)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def read_csv(path):
+    with open(path, newline='') as input_file:
+        return list(csv.DictReader(input_file))
+
+def test_first_export_has_no_condition(tmp_path):
+    watermark = Watermark(str(tmp_path / 'watermark.ini'), 'Attachment')
+    assert watermark.previous is None
+    assert watermark.condition() is None
+
+def test_start_takes_server_time_less_overlap(tmp_path):
+    sf = FakeSalesforce('Wed, 01 May 2024 12:30:00 GMT')
+    watermark = Watermark(str(tmp_path / 'watermark.ini'), 'Attachment', overlap=300)
+    watermark.start(sf)
+    assert sf.urls == [sf.base_url + 'limits/']
+    assert parse_datetime(watermark.latest) == datetime.datetime(2024, 5, 1, 12, 25, tzinfo=datetime.timezone.utc)
+
+def test_start_falls_back_to_local_time(tmp_path):
+    watermark = Watermark(str(tmp_path / 'watermark.ini'), 'Attachment', overlap=0)
+    before = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    watermark.start(FakeSalesforce(None))
+    assert parse_datetime(watermark.latest) >= before
+
+def test_saved_mark_is_the_condition_of_the_next_delta(tmp_path):
+    path = str(tmp_path / 'watermark.ini')
+    watermark = Watermark(path, 'ContentVersion', overlap=60)
+    watermark.start(FakeSalesforce('Wed, 01 May 2024 12:30:00 GMT'))
+    watermark.save()
+
+    delta = Watermark(path, 'ContentVersion')
+    assert delta.previous == watermark.latest
+    assert delta.condition() == 'SystemModstamp > 2024-05-01T12:29:00Z'
+    # the other sObjects of the file have no mark yet
+    assert Watermark(path, 'Attachment').condition() is None
+
+def test_save_without_start_keeps_the_previous_mark(tmp_path):
+    path = str(tmp_path / 'watermark.ini')
+    watermark = Watermark(path, 'Attachment')
+    watermark.start(FakeSalesforce('Wed, 01 May 2024 12:30:00 GMT'))
+    watermark.save()
+
+    Watermark(path, 'Attachment').save()
+    assert Watermark(path, 'Attachment').previous == watermark.latest
+
+def test_soql_datetime_converts_to_utc():
+    assert soql_datetime('2024-05-01T14:30:00.000+0200') == '2024-05-01T12:30:00Z'
+
+def test_merge_csv_replaces_and_appends_rows(tmp_path):
+    output_file = str(tmp_path / 'attachment.csv')
+    delta_file = output_file + '.delta'
+    write_csv(output_file, ['Id', 'Name'], [{'Id': '1', 'Name': 'a'}, {'Id': '2', 'Name': 'b'}])
+    write_csv(delta_file, ['Id', 'Name', 'Description'], [{'Id': '2', 'Name': 'b2', 'Description': 'new'},
+                                                         {'Id': '3', 'Name': 'c', 'Description': ''}])
+
+    merge_csv(output_file, delta_file)
+
+    assert read_csv(output_file) == [{'Id': '1', 'Name': 'a', 'Description': ''},
+                                     {'Id': '2', 'Name': 'b2', 'Description': 'new'},
+                                     {'Id': '3', 'Name': 'c', 'Description': ''}]
+    assert not (tmp_path / 'attachment.csv.delta').exists()
+
+def test_merge_csv_by_another_key(tmp_path):
+    output_file = str(tmp_path / 'content_version.csv')
+    delta_file = output_file + '.delta'
+    write_csv(output_file, ['Id', 'ContentDocumentId'], [{'Id': 'v1', 'ContentDocumentId': 'd1'}])
+    write_csv(delta_file, ['Id', 'ContentDocumentId'], [{'Id': 'v2', 'ContentDocumentId': 'd1'}])
+
+    merge_csv(output_file, delta_file, 'ContentDocumentId')
+
+    assert read_csv(output_file) == [{'Id': 'v2', 'ContentDocumentId': 'd1'}]
+
+def test_merge_csv_without_previous_export(tmp_path):
+    output_file = str(tmp_path / 'attachment.csv')
+    write_csv(output_file + '.delta', ['Id'], [{'Id': '1'}])
+
+    merge_csv(output_file, output_file + '.delta')
+
+    assert read_csv(output_file) == [{'Id': '1'}]
@@ -0,0 +1,53 @@
+import hashlib
+import os
+import pytest
+from file_store import create_store, open_store, LAYOUT_PACK
+
+class DownloadFailed(Exception):
+    pass
+
+def write_blob(store, record_id, data):
+    with store.writer(record_id) as output_file:
+        output_file.write(data)
+        output_file.checksum = hashlib.md5(data).hexdigest()
+
+def pack_sizes(folder):
+    return dict((name, os.path.getsize(os.path.join(folder, name))) for name in os.listdir(folder) if name.endswith('.pack'))
+
+def test_failed_write_is_cut_from_the_pack(tmp_path):
+    folder = str(tmp_path / 'Attachment')
+    with create_store(folder, LAYOUT_PACK) as store:
+        write_blob(store, 'a', b'first blob')
+        with pytest.raises(DownloadFailed):
+            with store.writer('b') as output_file:
+                output_file.write(b'part of the second blob')
+                raise DownloadFailed()
+        assert list(pack_sizes(folder).values()) == [len(b'first blob')]
+        assert store.checksum('b') is None
+
+        # the next blob starts where the failed one did
+        write_blob(store, 'c', b'third')
+        assert store.location('c').endswith('@{0}'.format(len(b'first blob')))
+
+    with open_store(folder) as store:
+        assert store.read('a') == b'first blob'
+        assert store.read('c') == b'third'
+        assert store.checksum('c') == hashlib.md5(b'third').hexdigest()
+        # a failed blob is not in the index
+        with pytest.raises(FileNotFoundError):
+            store.size('b')
+
+def test_retry_starts_the_blob_over(tmp_path):
+    folder = str(tmp_path / 'ContentVersion')
+    with create_store(folder, LAYOUT_PACK) as store:
+        write_blob(store, 'a', b'first')
+        with store.writer('b') as output_file:
+            output_file.write(b'truncated')
+            # what a retried download does before it starts again
+            output_file.seek(0)
+            output_file.truncate()
+            assert output_file.tell() == 0
+            output_file.write(b'complete')
+        assert store.read('b') == b'complete'
+        assert store.size('b') == len(b'complete')
+        assert list(pack_sizes(folder).values()) == [len(b'firstcomplete')]
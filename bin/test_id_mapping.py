@@ -0,0 +1,57 @@
+import csv
+import os
+from id_mapping import normalize_id, open_mapping, mapping_database_file
+
+def write_mapping(path, rows):
+   with open(path, 'w', newline='') as output_file:
+      writer = csv.writer(output_file)
+      writer.writerow(['OriginalId', 'NewId'])
+      writer.writerows(rows)
+
+def test_normalize_id_adds_the_case_suffix():
+   assert normalize_id('001D000000IRFma') == '001D000000IRFmaIAH'
+   assert normalize_id('001d000000irfma') == '001d000000irfmaAAA'
+
+def test_normalize_id_keeps_18_character_ids():
+   assert normalize_id('001D000000IRFmaIAH') == '001D000000IRFmaIAH'
+
+def test_normalize_id_keeps_other_values():
+   assert normalize_id('') == ''
+   assert normalize_id(' 001D000000IRFma ') == '001D000000IRFmaIAH'
+   assert normalize_id('not-an-id-value') == 'not-an-id-value'
+
+def test_mapping_matches_15_and_18_character_ids(tmp_path):
+   mapping_file = str(tmp_path / 'parent_mapping.csv')
+   write_mapping(mapping_file, [('001D000000IRFma', '001000000000001AAA'), ('001D000000IRFmbIAH', '')])
+   mapping = open_mapping(mapping_file, cache_folder=str(tmp_path / 'cache'))
+
+   assert mapping['001D000000IRFma'] == '001000000000001AAA'
+   assert mapping['001D000000IRFmaIAH'] == '001000000000001AAA'
+   # rows without a new Id are not mapped
+   assert '001D000000IRFmb' not in mapping
+   assert mapping.get('001D000000IRFmb', 'missing') == 'missing'
+   assert len(mapping) == 1
+
+def test_mapping_database_is_in_the_cache_folder(tmp_path):
+   mapping_file = str(tmp_path / 'parent_mapping.csv')
+   write_mapping(mapping_file, [])
+   cache_folder = str(tmp_path / 'cache')
+   open_mapping(mapping_file, cache_folder=cache_folder)
+
+   database_file = mapping_database_file(mapping_file, 'OriginalId', 'NewId', cache_folder)
+   assert os.path.dirname(database_file) == cache_folder
+   assert os.listdir(cache_folder) == [os.path.basename(database_file)]
+   assert not os.path.exists(mapping_file + '.sqlite')
+   # another CSV of the same name gets its own database
+   assert mapping_database_file(str(tmp_path / 'other' / 'parent_mapping.csv'), 'OriginalId', 'NewId', cache_folder) != database_file
+
+def test_mapping_is_rebuilt_when_the_csv_changes(tmp_path):
+   mapping_file = str(tmp_path / 'parent_mapping.csv')
+   cache_folder = str(tmp_path / 'cache')
+   write_mapping(mapping_file, [('001D000000IRFma', '001000000000001AAA')])
+   assert open_mapping(mapping_file, cache_folder=cache_folder)['001D000000IRFma'] == '001000000000001AAA'
+
+   write_mapping(mapping_file, [('001D000000IRFma', '001000000000002AAA'), ('001D000000IRFmb', '001000000000003AAA')])
+   mapping = open_mapping(mapping_file, cache_folder=cache_folder)
+   assert mapping['001D000000IRFma'] == '001000000000002AAA'
+   assert len(mapping) == 2
@@ -0,0 +1,36 @@
+from preflight import ExistingRecords, is_uploaded
+
+class FakeStore(object):
+   def __init__(self, sizes):
+      self.sizes = sizes
+
+   def size(self, record_id):
+      if record_id not in self.sizes:
+         raise FileNotFoundError(record_id)
+      return self.sizes[record_id]
+
+def test_every_record_is_kept():
+   with ExistingRecords() as existing:
+      existing.add_all([('parent/10/a.txt', 10, None), ('parent/10/a.txt', 10, None), ('parent/20/a.txt', 20, None)])
+      assert existing.count == 3
+      assert existing.is_current('parent/10/a.txt', 10)
+      assert existing.is_current('parent/20/a.txt', 20)
+      assert not existing.is_current('parent/30/a.txt', 30)
+
+def test_checksum_wins_over_size():
+   with ExistingRecords() as existing:
+      existing.add_all([('key', 10, 'ABC')])
+      assert existing.is_current('key', 10, 'abc')
+      assert not existing.is_current('key', 10, 'def')
+      assert existing.is_current('key', 10)
+
+def test_a_record_matches_one_file_only():
+   store = FakeStore({'first': 10, 'second': 10, 'third': 10, 'missing_parent': 10})
+   with ExistingRecords() as existing:
+      existing.add_all([('parent/10/a.txt', 10, None), ('parent/10/a.txt', 10, None)])
+      assert is_uploaded(existing, 'parent/10/a.txt', store, 'first', match=True)
+      assert is_uploaded(existing, 'parent/10/a.txt', store, 'second', match=True)
+      # two records in the target, the third file with the same key is uploaded
+      assert not is_uploaded(existing, 'parent/10/a.txt', store, 'third', match=True)
+      assert not is_uploaded(existing, None, store, 'missing_parent', match=True)
+      assert not is_uploaded(existing, 'parent/10/a.txt', store, 'not_in_store', match=True)
@@ -0,0 +1,76 @@
+import os
+import threading
+import pytest
+from urllib.parse import quote_plus
+from query_planner import plan_id_batches, build_id_query, RecordSpool, spool_records
+
+PREFIX = 'SELECT Id, Name FROM Attachment WHERE Id in ('
+
+def ids(count):
+   return ['00P{0:015d}'.format(i) for i in range(count)]
+
+def test_batches_keep_all_ids_in_order():
+   batches = list(plan_id_batches(PREFIX, ids(1000), max_ids=300))
+   assert [len(batch) for batch in batches] == [300, 300, 300, 100]
+   assert [record_id for batch in batches for record_id in batch] == ids(1000)
+
+def test_batches_fit_into_the_query_length():
+   max_query_length = 2000
+   batches = list(plan_id_batches(PREFIX, ids(500), max_query_length=max_query_length))
+   assert len(batches) > 1
+   for batch in batches:
+      assert len(quote_plus(build_id_query(PREFIX, batch))) <= max_query_length
+   # every batch but the last is full: one more id wouldn't fit
+   for batch, next_batch in zip(batches, batches[1:]):
+      assert len(quote_plus(build_id_query(PREFIX, batch + next_batch[:1]))) > max_query_length
+
+def test_query_suffix_counts_towards_the_length():
+   suffix = ') AND SystemModstamp > 2024-05-01T12:29:00Z'
+   batches = list(plan_id_batches(PREFIX, ids(200), query_suffix=suffix, max_query_length=1500))
+   for batch in batches:
+      assert len(quote_plus(build_id_query(PREFIX, batch, suffix))) <= 1500
+
+def test_no_ids_no_batches():
+   assert list(plan_id_batches(PREFIX, [])) == []
+
+def test_ids_are_consumed_lazily():
+   consumed = []
+   def stream():
+      for record_id in ids(10):
+         consumed.append(record_id)
+         yield record_id
+   batches = plan_id_batches(PREFIX, stream(), max_ids=3)
+   assert next(batches) == ids(3)
+   # the first batch is complete as soon as the id after it arrives
+   assert len(consumed) == 4
+
+def test_build_id_query():
+   assert build_id_query(PREFIX, ['a', 'b']) == PREFIX + "'a','b')"
+
+def test_spool_reads_the_query_without_the_consumer():
+   spool = RecordSpool({'Id': record_id} for record_id in ids(50))
+   spool.thread.join(5)
+   # the whole query was read although nothing was consumed yet
+   assert spool.done and spool.written == 50
+   assert [record['Id'] for record in spool] == ids(50)
+   assert not os.path.exists(spool.path)
+
+def test_spool_hands_out_records_while_the_query_runs():
+   more = threading.Event()
+   def records():
+      yield {'Id': 'first'}
+      more.wait(5)
+      yield {'Id': 'second'}
+   spooled = spool_records(records())
+   assert next(spooled) == {'Id': 'first'}
+   more.set()
+   assert list(spooled) == [{'Id': 'second'}]
+
+def test_spool_raises_the_query_error_after_its_records():
+   def records():
+      yield {'Id': 'first'}
+      raise ValueError('INVALID_QUERY_LOCATOR')
+   spooled = spool_records(records())
+   assert next(spooled) == {'Id': 'first'}
+   with pytest.raises(ValueError):
+      next(spooled)
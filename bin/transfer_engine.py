@@ -0,0 +1,243 @@
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from export_manifest import STATE_COMPLETE, STATE_FAILED
+from adaptive_scheduler import AdaptiveScheduler, TransientError, TRANSIENT_EXCEPTIONS, is_throttling_response, read_scheduler_config
+from run_metrics import phase, FILE_COMPLETE, FILE_FAILED, FILE_SKIPPED
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_HTTP_POOL_SIZE = 8
+DEFAULT_PREFETCH_DEPTH = 2
+# files of at least this size go to the large file lane
+DEFAULT_LARGE_FILE_THRESHOLD = 100 * 1024 * 1024
+DEFAULT_LARGE_FILE_WORKERS = 2
+
+class DownloadError(Exception):
+    pass
+
+# what a failed download can raise once its retries are exhausted
+DOWNLOAD_ERRORS = (TransientError, DownloadError, requests.exceptions.RequestException, OSError)
+
+class TransferEngine(object):
+    '''
+    Thread pool plus a keep-alive HTTP connection pool to the Salesforce instance.
+    One engine is created per run and shared by all batches, so neither worker
+    processes nor TLS connections are set up again for every batch.
+    Downloads run in two lanes: files of at least large_file_threshold bytes on their
+    own large_file_workers threads, all other files on max_workers threads, so a few
+    huge files never hold back the small ones.
+    Files the manifest lists as complete are skipped unless resume is False, e.g. for
+    the records of a delta export which were modified since they were downloaded.
+    '''
+    def __init__(self, sf, max_workers=DEFAULT_MAX_WORKERS, pool_size=DEFAULT_HTTP_POOL_SIZE, prefetch_depth=DEFAULT_PREFETCH_DEPTH, manifest=None, scheduler_config=None, metrics=None,
+                 large_file_threshold=DEFAULT_LARGE_FILE_THRESHOLD, large_file_workers=DEFAULT_LARGE_FILE_WORKERS, resume=True):
+        self.sf_instance = sf.sf_instance
+        self.manifest = manifest
+        self.resume = resume
+        self.metrics = metrics
+        self.max_workers = max_workers
+        self.large_file_threshold = large_file_threshold
+        self.large_file_workers = max(1, large_file_workers)
+        # the workers of each lane are its upper bound, the scheduler of the lane adapts the
+        # downloads in flight to the throttling of the org. Each lane has its own slots, so
+        # large files never take the slots of the small ones when the limit is reduced.
+        self.scheduler = AdaptiveScheduler(max_workers, metrics=metrics, **(scheduler_config or {}))
+        self.large_file_scheduler = AdaptiveScheduler(self.large_file_workers, metrics=metrics, **(scheduler_config or {}))
+        self.prefetch_depth = max(1, prefetch_depth)
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": "OAuth " + sf.session_id,
+                                     "Content-Type": "application/octet-stream"})
+        # with a session broker an expired session is refreshed for the downloads as well
+        self.session.auth = sf.session.auth
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size + self.large_file_workers, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.large_file_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.large_file_workers)
+        # metadata queries run on their own thread so they overlap with the downloads
+        self.query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.query_executor.shutdown(wait=True)
+        self.executor.shutdown(wait=True)
+        self.large_file_executor.shutdown(wait=True)
+        self.session.close()
+
+    def url(self, path):
+        return "https://%s%s" % (self.sf_instance, path)
+
+    def download_file(self, path, store, record_id, expected_size=None, expected_checksum=None, scheduler=None):
+        # the store only keeps the blob once the whole body arrived, so an interrupted
+        # transfer never leaves a complete-looking file
+        url = self.url(path)
+
+        logging.debug("Downloading from " + url)
+        try:
+            with store.writer(record_id) as output_file:
+                bytes_written, checksum = self.download_into(path, output_file, expected_size, expected_checksum, scheduler)
+                # recorded by the store, so the upload can verify the file without reading it twice
+                output_file.checksum = checksum
+        except DOWNLOAD_ERRORS as ex:
+            return None, "Couldn't download %s: %s" % (url, ex)
+
+        return bytes_written, "Saved file to %s (MD5 %s)" % (store.location(record_id), checksum)
+
+    def download_into(self, path, output_file, expected_size=None, expected_checksum=None, scheduler=None):
+        '''
+        Stream the blob at path into the open binary file output_file, e.g. a spool
+        for a direct org to org migration. Returns the number of bytes written and
+        their MD5 checksum, raises TransientError, DownloadError or requests exceptions
+        on failure. The download runs in the slots of scheduler, by default those of
+        the small file lane.
+        '''
+        def fetch():
+            # a retry starts over with an empty file
+            output_file.seek(0)
+            output_file.truncate()
+            # every attempt is timed on its own, the scheduler times the waits between them
+            with phase(self.metrics, 'download'):
+                return self.fetch_into(self.url(path), output_file, expected_size, expected_checksum)
+
+        return (scheduler or self.scheduler).call(fetch)
+
+    def fetch_into(self, url, output_file, expected_size=None, expected_checksum=None):
+        # throttling, dropped connections, truncated bodies and checksum mismatches raise
+        # TransientError, which makes the scheduler retry the download after a backoff.
+        # The MD5 is computed while the body streams, the file is never read again.
+        try:
+            with self.session.get(url, stream=True) as response:
+                # the API usage is the org's, both lanes stop growing near its limit
+                for scheduler in (self.scheduler, self.large_file_scheduler):
+                    scheduler.observe_limit_info(response.headers.get('Sforce-Limit-Info'))
+                if not response.ok:
+                    if is_throttling_response(response.status_code, response.text):
+                        raise TransientError("HTTP %d %s" % (response.status_code, response.text[:200]))
+                    raise DownloadError("HTTP %d %s" % (response.status_code, response.text[:200]))
+
+                bytes_written = 0
+                md5 = hashlib.md5()
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    output_file.write(chunk)
+                    md5.update(chunk)
+                    bytes_written += len(chunk)
+        except TRANSIENT_EXCEPTIONS as ex:
+            raise TransientError(str(ex), throttled=False)
+
+        if expected_size not in (None, '') and int(expected_size) != bytes_written:
+            raise TransientError("expected %s bytes, received %d" % (expected_size, bytes_written), throttled=False)
+        checksum = md5.hexdigest()
+        if expected_checksum and expected_checksum.lower() != checksum:
+            raise TransientError("expected MD5 %s, received %s" % (expected_checksum, checksum), throttled=False)
+        return bytes_written, checksum
+
+    def download_record(self, record, body_field, size_field, store, checksum_field=None):
+        expected_size = record.get(size_field)
+        if self.manifest and self.resume and self.manifest.is_complete(record['Id'], expected_size, store):
+            if self.metrics:
+                self.metrics.add_file(state=FILE_SKIPPED)
+            return "Skipped %s - already downloaded" % record['Id']
+
+        expected_checksum = record.get(checksum_field) if checksum_field else None
+        scheduler = self.large_file_scheduler if self.is_large(record, size_field) else self.scheduler
+        size, message = self.download_file(record[body_field], store, record['Id'], expected_size, expected_checksum, scheduler)
+        if self.metrics:
+            self.metrics.add_file(size, FILE_FAILED if size is None else FILE_COMPLETE)
+        if self.manifest:
+            if size is None:
+                self.manifest.record(record['Id'], expected_size, STATE_FAILED)
+            else:
+                self.manifest.record(record['Id'], size, STATE_COMPLETE)
+        return message
+
+    def is_large(self, record, size_field):
+        size = record.get(size_field)
+        return size not in (None, '') and int(size) >= self.large_file_threshold
+
+    def submit_record(self, record, body_field, size_field, store, checksum_field=None):
+        executor = self.large_file_executor if self.is_large(record, size_field) else self.executor
+        return executor.submit(self.download_record, record, body_field, size_field, store, checksum_field)
+
+    def submit_records(self, records, body_field, size_field, store, checksum_field=None):
+        '''
+        Queue the blob of every record for download into the file store
+        and return the futures in the order of the records. The MD5 of every
+        download is checked against checksum_field of its record, if given.
+        '''
+        return [self.submit_record(record, body_field, size_field, store, checksum_field) for record in records]
+
+    def download_records(self, records, body_field, size_field, store, checksum_field=None):
+        for future in self.submit_records(records, body_field, size_field, store, checksum_field):
+            yield future.result()
+
+    def prefetch(self, function, items):
+        '''
+        Call function for every item on the query thread, keeping up to prefetch_depth
+        calls ahead of the consumer. Results are yielded in the order of the items.
+        '''
+        pending = collections.deque()
+        items = iter(items)
+        for item in items:
+            pending.append(self.query_executor.submit(function, item))
+            if len(pending) >= self.prefetch_depth:
+                break
+        while pending:
+            result = pending.popleft().result()
+            for item in items:
+                pending.append(self.query_executor.submit(function, item))
+                break
+            yield result
+
+    def pipeline(self, function, items, body_field, size_field, store, on_records=None, checksum_field=None):
+        '''
+        Pipelined export: function(item) returns the records of one batch, on_records is
+        called with them in batch order (e.g. to write the CSV) and their blobs are queued
+        for download while the metadata of the next batches is being fetched.
+        There is no barrier between batches: the next batch is queued as soon as fewer
+        small files than its predecessor had are still waiting, files of the large lane
+        do not hold it back. Yields the download results as the files complete.
+        '''
+        small_files = set()
+        large_files = set()
+        for i, records in enumerate(self.prefetch(function, items), 1):
+            if not records:
+                continue
+            if on_records:
+                on_records(i, records)
+            for record in records:
+                future = self.submit_record(record, body_field, size_field, store, checksum_field)
+                (large_files if self.is_large(record, size_field) else small_files).add(future)
+            # keep at most about one batch of small files queued ahead of the workers
+            while len(small_files) > len(records):
+                for result in wait_for_any(small_files, large_files):
+                    yield result
+        while small_files or large_files:
+            for result in wait_for_any(small_files, large_files):
+                yield result
+
+def wait_for_any(*pending):
+    '''
+    Wait until at least one of the futures in the sets of pending is done, remove the
+    done futures from their sets and return their results.
+    '''
+    done, _ = concurrent.futures.wait(set().union(*pending), return_when=concurrent.futures.FIRST_COMPLETED)
+    for futures in pending:
+        futures.difference_update(done)
+    return [future.result() for future in done]
+
+def read_engine_config(config_section):
+    return {'max_workers': int(config_section.get('max_workers', DEFAULT_MAX_WORKERS)),
+            'pool_size': int(config_section.get('http_pool_size', DEFAULT_HTTP_POOL_SIZE)),
+            'prefetch_depth': int(config_section.get('prefetch_depth', DEFAULT_PREFETCH_DEPTH)),
+            'large_file_threshold': int(config_section.get('large_file_threshold', DEFAULT_LARGE_FILE_THRESHOLD)),
+            'large_file_workers': int(config_section.get('large_file_workers', DEFAULT_LARGE_FILE_WORKERS)),
+            'scheduler_config': read_scheduler_config(config_section)}
@@ -1,31 +1,199 @@
 #!/usr/bin/env python
-import base64, os, csv, argparse, sys, datetime, configparser
-from simple_salesforce import Salesforce
+import base64, hashlib, os, csv, argparse, sys, datetime, configparser, time
+from session_broker import connect, login_count
 import logging as log
 from simple_salesforce.exceptions import SalesforceMalformedRequest
+from upload_engine import UploadEngine, DEFAULT_MAX_IN_FLIGHT
+from adaptive_scheduler import call_create, DEFAULT_MAX_RETRIES
+from multipart_upload import insert_with_binary
+from file_store import open_store, verify_checksum, ChecksumError
+from id_mapping import open_mapping
+from preflight import query_existing_by_id, is_uploaded, as_int
+from bulk_query import unique_values
+from composite_upload import insert_collection, collection_error, collection_error_code, group_small_files, DEFAULT_BATCH_THRESHOLD
+from result_journal import open_journal, completed_rows, STATUS_SUCCESS, STATUS_FAILED, STATUS_SKIPPED
+from run_metrics import RunMetrics, phase, timed, FILE_COMPLETE, FILE_FAILED, FILE_SKIPPED
+from capacity_plan import CapacityPlan, plan_upload, finish_plan
 
 def create_attachment_request_body(attachment, base64_body, user_mapping, parent_mapping):
    attachment_request_body={'Body': base64_body, 'ContentType': attachment['ContentType'], 'Description': attachment['Description'], 'CreatedDate': attachment['CreatedDate'], 'IsPrivate': attachment['IsPrivate'].replace('False', 'false').replace('True', 'true'), 'LastModifiedDate': attachment['LastModifiedDate'], 'Name': attachment['Name']}
 
-   if attachment['ParentId'] not in parent_mapping:
+   # one lookup per Id, the mappings are indexes on disk
+   parent_id = parent_mapping.get(attachment['ParentId'])
+   if parent_id is None:
       log.info('Skipping upload of attachment with Id: ' + attachment['Id'] + ' due to missing parent (' + attachment['ParentId']  +')')
       return None
 
-   attachment_request_body['ParentId'] = parent_mapping[attachment['ParentId']]
-   if attachment['OwnerId'] in user_mapping:
-       attachment_request_body['OwnerId'] = user_mapping[attachment['OwnerId']]
-   if attachment['CreatedById'] in user_mapping:
-       attachment_request_body['OwnerId'] = user_mapping[attachment['CreatedById']]
-   if attachment['LastModifiedById'] in user_mapping:
-       attachment_request_body['LastModifiedById'] = user_mapping[attachment['LastModifiedById']]
+   attachment_request_body['ParentId'] = parent_id
+   owner_id = user_mapping.get(attachment['OwnerId'])
+   if owner_id is not None:
+       attachment_request_body['OwnerId'] = owner_id
+   created_by_id = user_mapping.get(attachment['CreatedById'])
+   if created_by_id is not None:
+       attachment_request_body['OwnerId'] = created_by_id
+   last_modified_by_id = user_mapping.get(attachment['LastModifiedById'])
+   if last_modified_by_id is not None:
+       attachment_request_body['LastModifiedById'] = last_modified_by_id
  
    return attachment_request_body
 
-def load_mapping(mapping_file, key_field_name, value_field_name):
-   mapping = {}
-   for row in csv.DictReader(mapping_file):
-      mapping[row[key_field_name]] = row[value_field_name]
-   return mapping
+def existing_attachment_key(parent_id, name, size):
+   # Attachments have no field for the source Id, they are matched by parent, name and size
+   if not parent_id or size is None:
+      return None
+   return '{0}/{1}/{2}'.format(parent_id, size, name)
+
+def uploaded_attachment_key(attachment, store, parent_mapping):
+   try:
+      size = store.size(attachment['Id'])
+   except OSError:
+      return None
+   return existing_attachment_key(parent_mapping.get(attachment['ParentId']), attachment['Name'], size)
+
+def mapped_parent_ids(attachments, parent_mapping):
+   # the distinct parents of the attachments in the target org, the ones seen are kept on disk
+   parent_ids = (parent_mapping.get(attachment['ParentId']) for attachment in attachments)
+   return unique_values(({'ParentId': parent_id} for parent_id in parent_ids if parent_id), 'ParentId')
+
+def skip_uploaded(attachments, existing, store, parent_mapping, metrics=None, journal=None):
+   '''
+   Drop the attachments which are already in the target org with a file of the same size.
+   Every Attachment of the target org accounts for one row only.
+   '''
+   for attachment in attachments:
+      key = uploaded_attachment_key(attachment, store, parent_mapping)
+      if is_uploaded(existing, key, store, attachment['Id'], match=True):
+         log.info('Skipping file with Id = \'{id}\', it is already in the target org'.format(id = attachment['Id']))
+         if metrics:
+            metrics.add_file(state=FILE_SKIPPED)
+         if journal:
+            journal.add(attachment['Id'], STATUS_SKIPPED, file_name=store.location(attachment['Id']))
+         continue
+      yield attachment
+
+def journal_missing_parent(journal, attachment, started, file_name):
+   if journal:
+      journal.add(attachment['Id'], STATUS_FAILED, error='No mapping for parent ' + attachment['ParentId'],
+                  elapsed=time.monotonic() - started, file_name=file_name, error_code='MISSING_PARENT')
+
+def upload_attachment(sf, attachment, store, user_mapping, parent_mapping, multipart=False, scheduler=None, metrics=None, journal=None):
+   error = ''
+   result = ''
+   started = time.monotonic()
+   attachment_id = attachment['Id']
+   log.info('Uploading file {body} with Id = \'{id}\''.format(body = attachment['Body'], id = attachment_id))
+
+   body = attachment_id
+   base64_body = None
+   # MD5 recorded by the export, verified while the file is read for the upload
+   checksum = store.checksum(attachment_id)
+   try:
+      body = store.location(attachment_id)
+      if multipart:
+         # the body is streamed from disk by the multipart request
+         size = store.size(attachment_id)
+      else:
+         with phase(metrics, 'encode'):
+            binary_file_body = store.read(attachment_id)
+            if checksum:
+               verify_checksum(attachment_id, hashlib.md5(binary_file_body).hexdigest(), checksum)
+            size = len(binary_file_body)
+            base64_encoded_body = base64.b64encode(binary_file_body)
+            base64_body = base64_encoded_body.decode('utf-8')
+   except (OSError, ChecksumError) as ex:
+      log.error('Cannot read file {0}: {1}'.format(body, ex))
+      if metrics:
+         metrics.add_file(state=FILE_FAILED)
+      if journal:
+         journal.add(attachment_id, STATUS_FAILED, error=ex, elapsed=time.monotonic() - started, file_name=body)
+      return None
+
+   attachment_request_body = create_attachment_request_body(attachment, base64_body, user_mapping, parent_mapping)
+   if attachment_request_body:
+      try:
+         if multipart:
+            del attachment_request_body['Body']
+            with store.open(attachment_id) as attachment_binary_file:
+               result = call_create(scheduler, timed(metrics, 'upload', 'multipart_create', insert_with_binary), sf, 'Attachment', attachment_request_body, 'Body', attachment_binary_file, attachment['Name'], checksum)
+         else:
+            result = call_create(scheduler, timed(metrics, 'upload', 'create', sf.Attachment.create), attachment_request_body)
+      except Exception as ex:
+         error = ex
+      if metrics:
+         metrics.add_file(size, FILE_FAILED if error else FILE_COMPLETE)
+      if journal:
+         journal.add(attachment_id, STATUS_FAILED if error else STATUS_SUCCESS, None if error else result.get('id'),
+                     error, time.monotonic() - started, body)
+      # add error key-value pair
+      if error is not None and hasattr(error, 'content'):
+         attachment_request_body['error'] = error.content[0]['message']
+      elif error is not None:
+         attachment_request_body['error'] = error
+      else:
+         attachment_request_body['error'] = ''
+
+      # replace base64 string by file path
+      attachment_request_body['Body'] = body
+   else:
+      if metrics:
+         metrics.add_file(state=FILE_SKIPPED)
+      journal_missing_parent(journal, attachment, started, body)
+   return attachment_request_body
+
+def upload_attachment_batch(sf, attachments, store, user_mapping, parent_mapping, scheduler=None, metrics=None, journal=None):
+   attachment_request_bodies = []
+   started = time.monotonic()
+   for attachment in attachments:
+      log.info('Uploading file {body} with Id = \'{id}\' in a batch'.format(body = attachment['Body'], id = attachment['Id']))
+      body = attachment['Id']
+      try:
+         body = store.location(attachment['Id'])
+         with phase(metrics, 'encode'):
+            binary_file_body = store.read(attachment['Id'])
+            checksum = store.checksum(attachment['Id'])
+            if checksum:
+               verify_checksum(attachment['Id'], hashlib.md5(binary_file_body).hexdigest(), checksum)
+            base64_body = base64.b64encode(binary_file_body).decode('utf-8')
+      except (OSError, ChecksumError) as ex:
+         log.error('Cannot read file {0}: {1}'.format(body, ex))
+         if metrics:
+            metrics.add_file(state=FILE_FAILED)
+         if journal:
+            journal.add(attachment['Id'], STATUS_FAILED, error=ex, elapsed=time.monotonic() - started, file_name=body)
+         continue
+      attachment_request_body = create_attachment_request_body(attachment, base64_body, user_mapping, parent_mapping)
+      if attachment_request_body:
+         attachment_request_bodies.append((attachment['Id'], body, len(binary_file_body), attachment_request_body))
+      else:
+         if metrics:
+            metrics.add_file(state=FILE_SKIPPED)
+         journal_missing_parent(journal, attachment, started, body)
+
+   if not attachment_request_bodies:
+      return []
+
+   try:
+      results = call_create(scheduler, timed(metrics, 'upload', 'collection', insert_collection), sf, 'Attachment', [request_body for (attachment_id, body, size, request_body) in attachment_request_bodies])
+      errors = [collection_error(result) for result in results]
+      journal_errors = [(result.get('id'), collection_error_code(result), error) for result, error in zip(results, errors)]
+   except Exception as ex:
+      # the whole request failed, e.g. because of the request size limit
+      error = ex.content[0]['message'] if hasattr(ex, 'content') else ex
+      errors = [error] * len(attachment_request_bodies)
+      journal_errors = [(None, None, ex)] * len(attachment_request_bodies)
+
+   elapsed = time.monotonic() - started
+   for (attachment_id, body, size, attachment_request_body), error, (new_id, error_code, journal_error) in zip(attachment_request_bodies, errors, journal_errors):
+      attachment_request_body['error'] = error
+      if metrics:
+         metrics.add_file(size, FILE_FAILED if error else FILE_COMPLETE)
+      if journal:
+         # the time of the collection request, shared by its records
+         journal.add(attachment_id, STATUS_FAILED if error else STATUS_SUCCESS, None if error else new_id,
+                     journal_error, elapsed, body, error_code)
+      # replace base64 string by file path
+      attachment_request_body['Body'] = body
+   return [request_body for (attachment_id, body, size, request_body) in attachment_request_bodies]
 
 def print_row_as_csv(row, csv_file = sys.stdout, write_header = True):
     writer = csv.DictWriter(csv_file, row.keys(), quoting=csv.QUOTE_ALL)
@@ -63,6 +231,50 @@ def main():
         "-v", "--verbose", dest="verbose", action='store_true',
         help="Verbose")
 
+   parser.add_argument(
+        "-t", "--max-in-flight", dest="max_in_flight", type=int, default=DEFAULT_MAX_IN_FLIGHT,
+        help="Maximum number of concurrent upload requests (default: %(default)s)")
+
+   parser.add_argument(
+        "-r", "--max-retries", dest="max_retries", type=int, default=DEFAULT_MAX_RETRIES,
+        help="Retries of a request throttled by Salesforce (REQUEST_LIMIT_EXCEEDED, 503, ...) (default: %(default)s)")
+
+   parser.add_argument(
+        "-m", "--multipart", dest="multipart", action='store_true',
+        help="Stream the binary from disk in a multipart request instead of sending it base64 encoded in JSON")
+
+   parser.add_argument(
+        "-b", "--batch-threshold", dest="batch_threshold", type=int, default=DEFAULT_BATCH_THRESHOLD,
+        help="Files smaller than this number of bytes are inserted up to 200 at a time with one sObject Collections request (default: %(default)s - disabled)")
+
+   parser.add_argument(
+        "--skip-existing", dest="skip_existing", action='store_true',
+        help="Query the attachments already in the target org first and skip the ones with the same parent, name and size")
+
+   parser.add_argument(
+        "--result-file", dest="result_file",
+        help="Write the Id, new Id, status, error and time of every row to this file, as JSON lines for *.jsonl, CSV otherwise")
+
+   parser.add_argument(
+        "--retry-failed", dest="retry_failed",
+        help="Result file of a previous run: only upload the rows of the input CSV which failed or are missing in it")
+
+   parser.add_argument(
+        "--metrics-file", dest="metrics_file",
+        help="Write timing and throughput metrics of the run to this file, in the Prometheus text format for *.prom files, JSON otherwise")
+
+   parser.add_argument(
+        "--dry-run", dest="dry_run", action='store_true',
+        help="Only read the input CSV and folder and print a plan with the files, bytes, API calls and estimated runtime of the upload")
+
+   parser.add_argument(
+        "--plan-metrics", dest="plan_metrics",
+        help="JSON metrics file (--metrics-file) of a previous run, the dry run estimates the upload bandwidth from it")
+
+   parser.add_argument(
+        "--plan-file", dest="plan_file",
+        help="Also write the plan of the dry run to this file as JSON")
+
    args = parser.parse_args()
 
    # Get SF credentials from config file
@@ -79,58 +291,100 @@ def main():
    else:
       domain = 'login'
 
-   # Output
-   log.info('Upload Attachments (Files) from Salesforce')
-   log.info('Username: ' + username)
-   log.info('Signing in at: https://'+ domain + '.salesforce.com')
-
    if args.verbose:
       log.basicConfig(format="%(levelname)s: %(message)s", level=log.DEBUG)
    else:
       log.basicConfig(format="%(levelname)s: %(message)s", level=log.INFO)
 
+   # Output
+   log.info('Upload Attachments (Files) from Salesforce')
+   log.info('Username: ' + username)
+   log.info('Signing in at: https://'+ domain + '.salesforce.com')
+
    if(args.input_file is not None and args.input_folder is not None):
-      sf = Salesforce(username = username,  password = password, security_token = token, domain = domain)
+      metrics = RunMetrics(os.path.basename(__file__))
+      with phase(metrics, 'login'):
+         sf = connect(username, password, token, domain, salesforce_config['salesforce'].get('session_cache'))
 
-      user_mappping = {}
-      parent_mapping = {}
-      with open(args.parent_mapping, mode='r') as parent_mapping_csv_file:
-         parent_mapping = load_mapping(parent_mapping_csv_file, 'OriginalId', 'NewId')
-      with open(args.user_mapping, mode='r') as user_mapping_csv_file:
-         user_mapping = load_mapping(user_mapping_csv_file, 'OriginalId', 'NewId')
+      plan = None
+      if args.dry_run:
+         plan = CapacityPlan(os.path.basename(__file__), args.max_in_flight)
+         plan.count_requests(sf.session)
+         # a cached session was used without signing in
+         if login_count(sf):
+            plan.add_calls('login', login_count(sf))
+         plan.probe(sf)
 
+      # indexed into the mapping cache folder on the first run, later runs reuse the index
+      parent_mapping = open_mapping(args.parent_mapping, 'OriginalId', 'NewId')
+      user_mapping = open_mapping(args.user_mapping, 'OriginalId', 'NewId')
+
+      completed = None
+      if args.retry_failed:
+         # a retry reads the input CSV again but only uploads what the previous run didn't
+         completed = completed_rows(args.retry_failed)
+         log.info('Retrying the rows which are not complete in {0}, {1} rows are complete'.format(args.retry_failed, completed.count))
+      def pending(attachments):
+         if completed is None:
+            return attachments
+         return (attachment for attachment in attachments if attachment['Id'] not in completed)
+
+      # the rows are counted up front for the ETA of the progress line
       with open(args.input_file, mode='r') as input_csv_file:
-          for attachment in csv.DictReader(input_csv_file):
-            error = ''
-            result = ''
-            attachment_id = attachment['Id']
-            log.info('Uploading file {body} with Id = \'{id}\''.format(body = attachment['Body'], id = attachment_id))
-            
-            body = os.path.join(args.input_folder, attachment_id)
-            with open(body, 'rb') as attachment_binary_file:
-               binary_file_body = attachment_binary_file.read()
-               base64_encoded_body = base64.b64encode(binary_file_body)
-               base64_body = base64_encoded_body.decode('utf-8')
-               attachment_request_body = create_attachment_request_body(attachment, base64_body, user_mapping, parent_mapping)
-               if attachment_request_body:
-                  try:
-                     result = sf.Attachment.create(attachment_request_body)
-                  except Exception as ex:
-                     error = ex
-                  # add error key-value pair
-                  if error is not None and hasattr(error, 'content'):
-                     attachment_request_body['error'] = error.content[0]['message']
-                  elif error is not None:
-                     attachment_request_body['error'] = error
-                  else:
-                     attachment_request_body['error'] = ''
-
-                  # replace base64 string by file path
-                  attachment_request_body['Body'] = body
-                  result_row = ', '.join("{!s}={!r}".format(key, val) for (key, val) in attachment_request_body.items())
-
-                  #print_row_as_csv(attachment_request_body, write_header = False)
-                  print(result_row)
+         metrics.set_total(sum(1 for attachment in pending(csv.DictReader(input_csv_file))))
+
+      existing = None
+      journal = None
+      if args.skip_existing:
+         # pre-flight: a rerun only sends the files which are missing or differ in the target,
+         # only the Attachments of the parents of the input rows are queried
+         with phase(metrics, 'preflight'), open(args.input_file, mode='r') as input_csv_file:
+            existing = query_existing_by_id(sf, 'SELECT ParentId, Name, BodyLength FROM Attachment WHERE ParentId IN (',
+                                            mapped_parent_ids(pending(csv.DictReader(input_csv_file)), parent_mapping),
+                                            lambda attachment: existing_attachment_key(attachment['ParentId'], attachment['Name'], as_int(attachment['BodyLength'])), 'BodyLength')
+
+      try:
+         if plan:
+            def planned_skip(attachment):
+               # rows without a parent in the target org or already uploaded send no request
+               parent_id = parent_mapping.get(attachment['ParentId'])
+               return parent_id is None or is_uploaded(existing, uploaded_attachment_key(attachment, store, parent_mapping), store, attachment['Id'], match=True)
+            with open(args.input_file, mode='r') as input_csv_file, open_store(args.input_folder) as store:
+               plan_upload(plan, pending(csv.DictReader(input_csv_file)), store, 'multipart_create' if args.multipart else 'create', args.batch_threshold, planned_skip)
+            finish_plan(plan, args.plan_metrics, 'upload', args.plan_file)
+            return
+         if args.result_file:
+            journal = open_journal(args.result_file, args.retry_failed)
+         with open(args.input_file, mode='r') as input_csv_file:
+            with metrics, open_store(args.input_folder) as store, UploadEngine(args.max_in_flight, args.max_retries, metrics) as engine:
+               def upload(attachments):
+                  # a list of attachments is a group of small files sent in one collection request
+                  if isinstance(attachments, list):
+                     return upload_attachment_batch(sf, attachments, store, user_mapping, parent_mapping, engine.scheduler, metrics, journal)
+                  return [upload_attachment(sf, attachments, store, user_mapping, parent_mapping, args.multipart, engine.scheduler, metrics, journal)]
+
+               attachments = pending(csv.DictReader(input_csv_file))
+               if existing:
+                  attachments = skip_uploaded(attachments, existing, store, parent_mapping, metrics, journal)
+               if args.batch_threshold > 0:
+                  attachments = group_small_files(attachments, lambda attachment: store.size(attachment['Id']), args.batch_threshold)
+               for attachment_request_bodies in engine.map(upload, attachments):
+                  for attachment_request_body in attachment_request_bodies:
+                     if attachment_request_body:
+                        result_row = ', '.join("{!s}={!r}".format(key, val) for (key, val) in attachment_request_body.items())
+
+                        #print_row_as_csv(attachment_request_body, write_header = False)
+                        print(result_row)
+      finally:
+         if journal:
+            journal.close()
+         if existing:
+            existing.close()
+         if completed:
+            completed.close()
+
+      if args.metrics_file:
+         metrics.write(args.metrics_file)
 
 if __name__ == "__main__":
    main()
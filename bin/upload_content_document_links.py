@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+import os, csv, argparse, configparser, tempfile, time
+from session_broker import connect
+import logging as log
+from upload_engine import UploadEngine, DEFAULT_MAX_IN_FLIGHT
+from adaptive_scheduler import call_create, DEFAULT_MAX_RETRIES
+from bulk_query import BulkQuery, DEFAULT_MAX_RECORDS
+from id_mapping import open_mapping, MAPPING_DATABASE_SUFFIX
+from composite_upload import insert_collection, collection_error, collection_error_code, group_rows, COLLECTION_MAX_RECORDS
+from result_journal import open_journal, completed_rows, STATUS_SUCCESS, STATUS_FAILED
+from run_metrics import RunMetrics, phase, timed, FILE_COMPLETE, FILE_FAILED
+
+MAPPING_FIELDS = ['OriginalId', 'NewId']
+
+def link_key(content_document_link):
+   # ContentDocumentLinks are exported without their Id, a link is its document and record
+   return content_document_link['ContentDocumentId'] + '/' + content_document_link['LinkedEntityId']
+
+def build_document_mapping(sf, upsert_key, content_version_file, document_mapping_file, max_records=DEFAULT_MAX_RECORDS):
+   '''
+   Write the source ContentDocumentId -> target ContentDocumentId mapping CSV and return
+   it as an IdMapping. The ContentVersions uploaded by upload_content_versions.py carry the
+   source ContentVersion Id in upsert_key, one Bulk API query of the target org finds their
+   documents and content_version.csv the source document of every source version.
+   '''
+   with tempfile.TemporaryDirectory(prefix='content_document_links_') as temporary_folder:
+      version_mapping_file = os.path.join(temporary_folder, 'content_version_mapping.csv')
+      query = 'SELECT {0}, ContentDocumentId FROM ContentVersion WHERE {0} != null'.format(upsert_key)
+      with open(version_mapping_file, 'w', newline='') as output_file:
+         writer = csv.DictWriter(output_file, MAPPING_FIELDS, quoting=csv.QUOTE_ALL)
+         writer.writeheader()
+         for content_version in BulkQuery(sf.base_url, sf.session_id, session=sf.session, max_records=max_records).query(query):
+            writer.writerow({'OriginalId': content_version[upsert_key], 'NewId': content_version['ContentDocumentId']})
+      # the index of this throwaway mapping is removed with the folder
+      version_mapping = open_mapping(version_mapping_file, database_file=version_mapping_file + MAPPING_DATABASE_SUFFIX)
+
+      documents = 0
+      with open(content_version_file, 'r', newline='') as input_file, open(document_mapping_file, 'w', newline='') as output_file:
+         writer = csv.DictWriter(output_file, MAPPING_FIELDS, quoting=csv.QUOTE_ALL)
+         writer.writeheader()
+         for content_version in csv.DictReader(input_file):
+            content_document_id = version_mapping.get(content_version['Id'])
+            if content_document_id:
+               writer.writerow({'OriginalId': content_version['ContentDocumentId'], 'NewId': content_document_id})
+               documents += 1
+   log.info('Found {0} uploaded documents in the target org'.format(documents))
+   return open_mapping(document_mapping_file)
+
+def create_content_document_link_request_body(content_document_link, document_mapping, parent_mapping, user_mapping=None):
+   '''
+   Request body of the link in the target org, or the error code and message if its
+   document or record isn't there.
+   '''
+   content_document_id = document_mapping.get(content_document_link['ContentDocumentId'])
+   if content_document_id is None:
+      return None, 'MISSING_DOCUMENT', 'No uploaded document for ' + content_document_link['ContentDocumentId']
+   # links to users and groups are mapped with the user mapping
+   linked_entity_id = parent_mapping.get(content_document_link['LinkedEntityId'])
+   if linked_entity_id is None and user_mapping is not None:
+      linked_entity_id = user_mapping.get(content_document_link['LinkedEntityId'])
+   if linked_entity_id is None:
+      return None, 'MISSING_PARENT', 'No mapping for record ' + content_document_link['LinkedEntityId']
+
+   content_document_link_request_body = {'ContentDocumentId': content_document_id, 'LinkedEntityId': linked_entity_id}
+   for field in ('ShareType', 'Visibility'):
+      if content_document_link.get(field):
+         content_document_link_request_body[field] = content_document_link[field]
+   return content_document_link_request_body, None, None
+
+def upload_content_document_link_batch(sf, content_document_links, document_mapping, parent_mapping, user_mapping=None, scheduler=None, metrics=None, journal=None):
+   '''
+   Insert up to 200 links with one sObject Collections request, every link gets its own result.
+   '''
+   started = time.monotonic()
+   results = []
+   request_bodies = []
+   for content_document_link in content_document_links:
+      request_body, error_code, error = create_content_document_link_request_body(content_document_link, document_mapping, parent_mapping, user_mapping)
+      if request_body is None:
+         log.info('Skipping link {0}: {1}'.format(link_key(content_document_link), error))
+         if metrics:
+            metrics.add_file(state=FILE_FAILED)
+         if journal:
+            journal.add(link_key(content_document_link), STATUS_FAILED, error=error, elapsed=time.monotonic() - started, error_code=error_code)
+         results.append(dict(content_document_link, Id='', error=error))
+      else:
+         request_bodies.append((content_document_link, request_body))
+
+   if not request_bodies:
+      return results
+
+   try:
+      collection_results = call_create(scheduler, timed(metrics, 'upload', 'collection', insert_collection), sf, 'ContentDocumentLink', [request_body for (content_document_link, request_body) in request_bodies])
+      errors = [(collection_error_code(result), collection_error(result)) for result in collection_results]
+   except Exception as ex:
+      # the whole request failed
+      collection_results = [{}] * len(request_bodies)
+      errors = [(None, ex)] * len(request_bodies)
+
+   elapsed = time.monotonic() - started
+   for (content_document_link, request_body), result, (error_code, error) in zip(request_bodies, collection_results, errors):
+      new_id = None if error else result.get('id')
+      if metrics:
+         metrics.add_file(state=FILE_FAILED if error else FILE_COMPLETE)
+      if journal:
+         # the time of the collection request, shared by its links
+         journal.add(link_key(content_document_link), STATUS_FAILED if error else STATUS_SUCCESS, new_id, error, elapsed, error_code=error_code)
+      results.append(dict(request_body, Id=new_id or '', error=error or ''))
+   return results
+
+def main():
+   parser = argparse.ArgumentParser(description='Script which links uploaded content documents to records in Salesforce:\n' +
+                                                'Example:\n' +
+                                                '\t' + os.path.basename(__file__) + ' -u Source_Original_Id__c -s ~/Workspace/salesforce-file-export-import/etc/sf_credentials_myproject_dev.ini -i content_version_account_dev/content_document_link.csv -c content_version_account_dev/content_version.csv -p parent_mapping.csv',
+						formatter_class=argparse.RawTextHelpFormatter)
+
+   parser.add_argument(
+        "-i", "--input-file", dest="input_file",
+        help="Input CSV file with ContentDocumentLink info", required=True)
+
+   parser.add_argument(
+        "-c", "--content-version-file", dest="content_version_file",
+        help="CSV file with the exported ContentVersions of the links (content_version.csv)", required=True)
+
+   parser.add_argument(
+        "-s", "--salesforce-config-file", dest="salesforce_config_file",
+        help="Salesforce config file with login info", required=True)
+
+   parser.add_argument(
+        "-u", "--upsert-key", dest="upsert_key",
+        help="Upsert key used by upload_content_versions.py", required=True)
+
+   parser.add_argument(
+        "-p", "--parent-mapping", dest="parent_mapping",
+        help="Parent ID mapping in CSV format", required=True)
+
+   parser.add_argument(
+        "--user-mapping", dest="user_mapping",
+        help="User ID mapping in CSV format for links to users and groups")
+
+   parser.add_argument(
+        "-d", "--document-mapping", dest="document_mapping",
+        help="Write the ContentDocumentId mapping to this CSV file (default: content_document_mapping.csv next to the input file)")
+
+   parser.add_argument(
+        "-v", "--verbose", dest="verbose", action='store_true',
+        help="Verbose")
+
+   parser.add_argument(
+        "-t", "--max-in-flight", dest="max_in_flight", type=int, default=DEFAULT_MAX_IN_FLIGHT,
+        help="Maximum number of concurrent upload requests (default: %(default)s)")
+
+   parser.add_argument(
+        "-r", "--max-retries", dest="max_retries", type=int, default=DEFAULT_MAX_RETRIES,
+        help="Retries of a request throttled by Salesforce (REQUEST_LIMIT_EXCEEDED, 503, ...) (default: %(default)s)")
+
+   parser.add_argument(
+        "-b", "--batch-size", dest="batch_size", type=int, default=COLLECTION_MAX_RECORDS,
+        help="Links inserted with one sObject Collections request (default: %(default)s)")
+
+   parser.add_argument(
+        "--result-file", dest="result_file",
+        help="Write the link, new Id, status, error and time of every row to this file, as JSON lines for *.jsonl, CSV otherwise")
+
+   parser.add_argument(
+        "--retry-failed", dest="retry_failed",
+        help="Result file of a previous run: only insert the links of the input CSV which failed or are missing in it")
+
+   parser.add_argument(
+        "--metrics-file", dest="metrics_file",
+        help="Write timing and throughput metrics of the run to this file, in the Prometheus text format for *.prom files, JSON otherwise")
+
+   args = parser.parse_args()
+
+   # Get SF credentials from config file
+   salesforce_config = configparser.ConfigParser(allow_no_value=True)
+   salesforce_config.read(args.salesforce_config_file)
+
+   username = salesforce_config['salesforce']['username']
+   password = salesforce_config['salesforce']['password']
+   token = salesforce_config['salesforce']['security_token']
+   is_sandbox = salesforce_config['salesforce']['connect_to_sandbox']
+
+   if is_sandbox == 'True':
+      domain = 'test'
+   else:
+      domain = 'login'
+
+   if args.verbose:
+      log.basicConfig(format="%(levelname)s: %(message)s", level=log.DEBUG)
+   else:
+      log.basicConfig(format="%(levelname)s: %(message)s", level=log.INFO)
+
+   log.info('Upload ContentDocumentLinks to Salesforce')
+   log.info('Username: ' + username)
+   log.info('Signing in at: https://'+ domain + '.salesforce.com')
+
+   metrics = RunMetrics(os.path.basename(__file__))
+   with phase(metrics, 'login'):
+      sf = connect(username, password, token, domain, salesforce_config['salesforce'].get('session_cache'))
+
+   document_mapping_file = args.document_mapping or os.path.join(os.path.dirname(args.input_file), 'content_document_mapping.csv')
+   with phase(metrics, 'preflight', 'bulk_query'):
+      document_mapping = build_document_mapping(sf, args.upsert_key, args.content_version_file, document_mapping_file)
+   # indexed into the mapping cache folder on the first run, later runs reuse the index
+   parent_mapping = open_mapping(args.parent_mapping, 'OriginalId', 'NewId')
+   user_mapping = open_mapping(args.user_mapping, 'OriginalId', 'NewId') if args.user_mapping else None
+
+   completed = None
+   if args.retry_failed:
+      # a retry reads the input CSV again but only inserts what the previous run didn't
+      completed = completed_rows(args.retry_failed)
+      log.info('Retrying the rows which are not complete in {0}, {1} rows are complete'.format(args.retry_failed, completed.count))
+   def pending(content_document_links):
+      if completed is None:
+         return content_document_links
+      return (content_document_link for content_document_link in content_document_links if link_key(content_document_link) not in completed)
+
+   # the rows are counted up front for the ETA of the progress line
+   with open(args.input_file, mode='r') as input_csv_file:
+      metrics.set_total(sum(1 for content_document_link in pending(csv.DictReader(input_csv_file))))
+
+   journal = None
+   try:
+      if args.result_file:
+         journal = open_journal(args.result_file, args.retry_failed)
+      with open(args.input_file, mode='r') as input_csv_file:
+         with metrics, UploadEngine(args.max_in_flight, args.max_retries, metrics) as engine:
+            upload = lambda content_document_links: upload_content_document_link_batch(sf, content_document_links, document_mapping, parent_mapping, user_mapping, engine.scheduler, metrics, journal)
+            batches = group_rows(pending(csv.DictReader(input_csv_file)), min(args.batch_size, COLLECTION_MAX_RECORDS))
+            for results in engine.map(upload, batches):
+               for result in results:
+                  print(', '.join("{!s}={!r}".format(key, val) for (key, val) in result.items()))
+   finally:
+      if journal:
+         journal.close()
+      if completed:
+         completed.close()
+
+   if args.metrics_file:
+      metrics.write(args.metrics_file)
+
+if __name__ == "__main__":
+   main()
@@ -1,13 +1,99 @@
 #!/usr/bin/env python
-import base64, os, csv, argparse, sys, datetime, configparser
-from simple_salesforce import Salesforce
+import base64, hashlib, os, csv, argparse, sys, datetime, configparser, time
+from session_broker import connect, login_count
 import logging as log
 from simple_salesforce.exceptions import SalesforceMalformedRequest
+from upload_engine import UploadEngine, DEFAULT_MAX_IN_FLIGHT
+from adaptive_scheduler import call_api, call_create, DEFAULT_MAX_RETRIES
+from multipart_upload import insert_with_binary
+from file_store import open_store, verify_checksum, ChecksumError
+from preflight import query_existing, is_uploaded
+from result_journal import open_journal, completed_rows, STATUS_SUCCESS, STATUS_FAILED, STATUS_SKIPPED
+from run_metrics import RunMetrics, phase, timed, FILE_COMPLETE, FILE_FAILED, FILE_SKIPPED
+from capacity_plan import CapacityPlan, plan_upload, finish_plan
 
 def create_content_version_request_body(content_version, base64_version_data):
    content_version_request_body={'Title':content_version['Title'], 'Description':content_version['Description'], 'PathOnClient':content_version['PathOnClient'], 'VersionData':base64_version_data, 'CreatedDate':content_version['CreatedDate'], 'LastModifiedDate':content_version['LastModifiedDate'], 'ContentUrl':content_version['ContentUrl'], 'ReasonForChange':content_version['ReasonForChange'], 'SharingOption':content_version['SharingOption'], 'SharingPrivacy':content_version['SharingPrivacy'], 'Origin':content_version['Origin'], 'ContentLocation':content_version['ContentLocation'], 'ExternalDocumentInfo1':content_version['ExternalDocumentInfo1'], 'ExternalDocumentInfo2':content_version['ExternalDocumentInfo2'], 'IsMajorVersion':content_version['IsMajorVersion'].replace('1', 'true').replace('0', 'false').replace('False', 'false').replace('True', 'true')}
    return content_version_request_body
 
+def upload_content_version(sf, content_version, store, upsert_key, multipart=False, scheduler=None, metrics=None, existing=None, journal=None):
+   error = ''
+   result = ''
+   started = time.monotonic()
+   content_version_id=content_version['Id']
+   log.info('Uploading file {path_on_client} with Id = \'{id}\''.format(path_on_client=content_version['PathOnClient'],id=content_version_id))
+   version_data = content_version_id
+   base64_version_data = None
+   # Checksum exported from Salesforce or the MD5 recorded while the file was downloaded,
+   # verified while the file is read for the upload
+   checksum = content_version.get('Checksum') or store.checksum(content_version_id)
+   if is_uploaded(existing, content_version_id, store, content_version_id, checksum):
+      log.info('Skipping file with Id = \'{id}\', it is already in the target org'.format(id=content_version_id))
+      if metrics:
+         metrics.add_file(state=FILE_SKIPPED)
+      if journal:
+         journal.add(content_version_id, STATUS_SKIPPED, elapsed=time.monotonic() - started, file_name=store.location(content_version_id))
+      return None
+   if multipart and existing is not None and content_version_id in existing:
+      # a multipart insert would add a second ContentVersion with the same upsert key
+      log.error('Not uploading file with Id = \'{id}\', it is already in the target org with a different file'.format(id=content_version_id))
+      if metrics:
+         metrics.add_file(state=FILE_FAILED)
+      if journal:
+         journal.add(content_version_id, STATUS_FAILED, error='Already in the target org with a different file, upload it without -m to update it',
+                     elapsed=time.monotonic() - started, file_name=store.location(content_version_id), error_code='DUPLICATE_VALUE')
+      return None
+   try:
+      version_data = store.location(content_version_id)
+      if multipart:
+         # the version data is streamed from disk by the multipart request
+         size = store.size(content_version_id)
+      else:
+         with phase(metrics, 'encode'):
+            binary_file_version_data = store.read(content_version_id)
+            if checksum:
+               verify_checksum(content_version_id, hashlib.md5(binary_file_version_data).hexdigest(), checksum)
+            size = len(binary_file_version_data)
+            base64_encoded_version_data = base64.b64encode(binary_file_version_data)
+            base64_version_data = base64_encoded_version_data.decode('utf-8')
+   except (OSError, ChecksumError) as ex:
+      log.error('No valid file for Id: {0}: {1}'.format(content_version_id, ex))
+      if metrics:
+         metrics.add_file(state=FILE_FAILED)
+      if journal:
+         journal.add(content_version_id, STATUS_FAILED, error=ex, elapsed=time.monotonic() - started, file_name=version_data)
+      return None
+
+   content_version_request_body = create_content_version_request_body(content_version, base64_version_data)
+   try:
+      if multipart:
+         # multipart requests can only insert, so the upsert key is sent as a field of the new record
+         del content_version_request_body['VersionData']
+         content_version_request_body[upsert_key] = content_version_id
+         with store.open(content_version_id) as content_version_binary_file:
+            result=call_create(scheduler, timed(metrics, 'upload', 'multipart_create', insert_with_binary), sf, 'ContentVersion', content_version_request_body, 'VersionData', content_version_binary_file, content_version['PathOnClient'] or content_version_id, checksum)
+      else:
+         # the raw response has the Id of the created or updated record
+         response=call_api(scheduler, timed(metrics, 'upload', 'upsert', sf.ContentVersion.upsert), upsert_key + '/' + content_version_id, content_version_request_body, raw_response=True)
+         result=response.json() if response.content else {}
+   except Exception as ex:
+      error=ex
+   if metrics:
+      metrics.add_file(size, FILE_FAILED if error else FILE_COMPLETE)
+   if journal:
+      journal.add(content_version_id, STATUS_FAILED if error else STATUS_SUCCESS, None if error else result.get('id'),
+                  error, time.monotonic() - started, version_data)
+
+   if error is not None and hasattr(error, 'content'):
+      content_version_request_body['error'] = error.content[0]['message']
+   elif error is not None:
+      content_version_request_body['error'] = error
+   else:
+      content_version_request_body['error'] = ''
+   # replace base64 string by file path
+   content_version_request_body['VersionData'] = version_data
+   return content_version_request_body
+
 def main():
    parser = argparse.ArgumentParser(description='Script which loads content versions to Salesforce:\n' +
                                                 'Example:\n' +
@@ -34,6 +120,50 @@ def main():
         "-u", "--upsert-key", dest="upsert_key",
         help="Upsert key", required=True)
 
+   parser.add_argument(
+        "-t", "--max-in-flight", dest="max_in_flight", type=int, default=DEFAULT_MAX_IN_FLIGHT,
+        help="Maximum number of concurrent upload requests (default: %(default)s)")
+
+   parser.add_argument(
+        "-r", "--max-retries", dest="max_retries", type=int, default=DEFAULT_MAX_RETRIES,
+        help="Retries of a request throttled by Salesforce (REQUEST_LIMIT_EXCEEDED, 503, ...) (default: %(default)s)")
+
+   parser.add_argument(
+        "-m", "--multipart", dest="multipart", action='store_true',
+        help="Stream the binary from disk in a multipart request instead of sending it base64 encoded in JSON.\n" +
+             "Multipart requests insert new ContentVersions, the upsert key is stored on the inserted record.\n" +
+             "The upsert keys in the target org are queried first like with --skip-existing, rows whose key is\n" +
+             "there with a different file fail instead of being inserted a second time")
+
+   parser.add_argument(
+        "--skip-existing", dest="skip_existing", action='store_true',
+        help="Query the upsert key values already in the target org first and skip the rows whose file is\n" +
+             "already there with the same checksum or size")
+
+   parser.add_argument(
+        "--result-file", dest="result_file",
+        help="Write the Id, new Id, status, error and time of every row to this file, as JSON lines for *.jsonl, CSV otherwise")
+
+   parser.add_argument(
+        "--retry-failed", dest="retry_failed",
+        help="Result file of a previous run: only upload the rows of the input CSV which failed or are missing in it")
+
+   parser.add_argument(
+        "--metrics-file", dest="metrics_file",
+        help="Write timing and throughput metrics of the run to this file, in the Prometheus text format for *.prom files, JSON otherwise")
+
+   parser.add_argument(
+        "--dry-run", dest="dry_run", action='store_true',
+        help="Only read the input CSV and folder and print a plan with the files, bytes, API calls and estimated runtime of the upload")
+
+   parser.add_argument(
+        "--plan-metrics", dest="plan_metrics",
+        help="JSON metrics file (--metrics-file) of a previous run, the dry run estimates the upload bandwidth from it")
+
+   parser.add_argument(
+        "--plan-file", dest="plan_file",
+        help="Also write the plan of the dry run to this file as JSON")
+
    args = parser.parse_args()
 
    # Get SF credentials from config file
@@ -53,46 +183,76 @@ def main():
    if args.verbose:
       log.basicConfig(format="%(levelname)s: %(message)s", level=log.DEBUG)
    else:
-      log.basicConfig(format="%(levelname)s: %(message)s")
+      log.basicConfig(format="%(levelname)s: %(message)s", level=log.INFO)
 
    if(args.input_file is not None and args.input_folder is not None):
-      sf = Salesforce(username = username,  password = password, security_token = token, domain = domain)
+      metrics = RunMetrics(os.path.basename(__file__))
+      with phase(metrics, 'login'):
+         sf = connect(username, password, token, domain, salesforce_config['salesforce'].get('session_cache'))
+
+      plan = None
+      if args.dry_run:
+         plan = CapacityPlan(os.path.basename(__file__), args.max_in_flight)
+         plan.count_requests(sf.session)
+         # a cached session was used without signing in
+         if login_count(sf):
+            plan.add_calls('login', login_count(sf))
+         plan.probe(sf)
+
       # contact = sf.Contact.get('0037R00002TNL6eQAH')
+      completed = None
+      if args.retry_failed:
+         # a retry reads the input CSV again but only uploads what the previous run didn't
+         completed = completed_rows(args.retry_failed)
+         log.info('Retrying the rows which are not complete in {0}, {1} rows are complete'.format(args.retry_failed, completed.count))
+      def pending(content_versions):
+         if completed is None:
+            return content_versions
+         return (content_version for content_version in content_versions if content_version['Id'] not in completed)
+
+      # the rows are counted up front for the ETA of the progress line
       with open(args.input_file, mode='r') as input_csv_file:
-          for content_version in csv.DictReader(input_csv_file):
-            error = ''
-            result = ''
-            content_version_id=content_version['Id']
-            print('Uploading file {path_on_client} with Id = \'{id}\''.format(path_on_client=content_version['PathOnClient'],id=content_version_id))
-            #if int(content_version['ContentSize']) > 0:
-            if True:
-               version_data = os.path.join(args.input_folder, content_version_id)
-               with open(version_data, 'rb') as content_version_binary_file:
-                  binary_file_version_data = content_version_binary_file.read()
-                  base64_encoded_version_data = base64.b64encode(binary_file_version_data)
-                  base64_version_data = base64_encoded_version_data.decode('utf-8')
-                  content_version_request_body = create_content_version_request_body(content_version, base64_version_data)
-                  # set the Content-Disposition header otherwise the limit for the file upload will be 37,5 MB
-                  sf.headers['Content-Type'] = 'multipart/form-data; boundary="boundary_string"'
-                  try:
-                     result=sf.ContentVersion.upsert(args.upsert_key + '/' + content_version_id, content_version_request_body)
-                  except Exception as ex:
-                     error=ex
-
-                  if error is not None and hasattr(error, 'content'):
-                     content_version_request_body['error'] = error.content[0]['message']
-                  elif error is not None:
-                     content_version_request_body['error'] = error
-                  else:
-                     content_version_request_body['error'] = ''
-                  # replace base64 string by file path
-                  content_version_request_body['VersionData'] = version_data
-                  result_row = ', '.join("{!s}={!r}".format(key,val) for (key,val) in content_version_request_body.items())
-
-                  print(result_row)
-            else:
-                print('No file for Id: ', content_version['Id'])
-                print(result)
+         metrics.set_total(sum(1 for content_version in pending(csv.DictReader(input_csv_file))))
+
+      existing = None
+      journal = None
+      if args.multipart and not args.skip_existing:
+         log.info('Multipart requests insert ContentVersions, querying the upsert keys in the target org first')
+      if args.skip_existing or args.multipart:
+         # pre-flight: a rerun only sends the files which are missing or differ in the target,
+         # and a multipart insert never duplicates a record of the same upsert key
+         existing_query = 'SELECT {0}, ContentSize, Checksum FROM ContentVersion WHERE IsLatest = True AND {0} != null'.format(args.upsert_key)
+         with phase(metrics, 'preflight', 'bulk_query'):
+            existing = query_existing(sf, existing_query, lambda content_version: content_version[args.upsert_key], 'ContentSize', 'Checksum')
+
+      try:
+         if plan:
+            with open(args.input_file, mode='r') as input_csv_file, open_store(args.input_folder) as store:
+               planned_skip = lambda content_version: is_uploaded(existing, content_version['Id'], store, content_version['Id'], content_version.get('Checksum') or store.checksum(content_version['Id'])) \
+                                                      or (args.multipart and content_version['Id'] in existing)
+               plan_upload(plan, pending(csv.DictReader(input_csv_file)), store, 'multipart_create' if args.multipart else 'upsert', skip=planned_skip)
+            finish_plan(plan, args.plan_metrics, 'upload', args.plan_file)
+            return
+         if args.result_file:
+            journal = open_journal(args.result_file, args.retry_failed)
+         with open(args.input_file, mode='r') as input_csv_file:
+            with metrics, open_store(args.input_folder) as store, UploadEngine(args.max_in_flight, args.max_retries, metrics) as engine:
+               upload = lambda content_version: upload_content_version(sf, content_version, store, args.upsert_key, args.multipart, engine.scheduler, metrics, existing, journal)
+               for content_version_request_body in engine.map(upload, pending(csv.DictReader(input_csv_file))):
+                  if content_version_request_body:
+                     result_row = ', '.join("{!s}={!r}".format(key,val) for (key,val) in content_version_request_body.items())
+
+                     print(result_row)
+      finally:
+         if journal:
+            journal.close()
+         if existing:
+            existing.close()
+         if completed:
+            completed.close()
+
+      if args.metrics_file:
+         metrics.write(args.metrics_file)
 
 if __name__ == "__main__":
    main()
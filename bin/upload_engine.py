@@ -0,0 +1,40 @@
+import collections
+import concurrent.futures
+from adaptive_scheduler import AdaptiveScheduler, DEFAULT_MAX_RETRIES
+
+DEFAULT_MAX_IN_FLIGHT = 1
+
+class UploadEngine(object):
+   '''
+   Runs the upload of CSV rows on a bounded number of threads.
+   At most max_in_flight requests are sent to Salesforce at the same time and only
+   a small window of rows is read ahead, so memory stays bounded by the number of
+   in-flight requests. Results are returned in the order of the input rows.
+   '''
+   def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT, max_retries=DEFAULT_MAX_RETRIES, metrics=None):
+      self.max_in_flight = max(1, max_in_flight)
+      # requests go through the scheduler, which retries throttled requests and
+      # lowers the number of requests in flight while Salesforce is throttling
+      self.scheduler = AdaptiveScheduler(self.max_in_flight, max_retries=max_retries, metrics=metrics)
+      self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_in_flight)
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      self.close()
+
+   def close(self):
+      self.executor.shutdown(wait=True)
+
+   def map(self, function, rows):
+      # keep twice as many rows queued as there are workers so that a worker never
+      # waits for the consumer, while the window still bounds what is held in memory
+      window = 2 * self.max_in_flight
+      pending = collections.deque()
+      for row in rows:
+         pending.append(self.executor.submit(function, row))
+         if len(pending) >= window:
+            yield pending.popleft().result()
+      while pending:
+         yield pending.popleft().result()